@@ -1,12 +1,29 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, stream_with_context, g
+import json
 import sqlite3
 import os
 from datetime import datetime, timedelta
 import secrets
+import time
 import uuid
-from models import init_db, get_db_connection
-from auth import send_security_code, verify_security_code, require_login, cleanup_expired_codes
-from scoring import calculate_round_points, calculate_round_points_with_flags, parse_bid, format_bid_display, format_made_display, get_score_breakdown_detailed, calculate_detailed_round_scoring
+from models import init_db, get_db_connection, db_pool, generate_share_code, transactional, DatabaseBusy
+from auth import send_security_code, verify_security_code, require_login, require_internal_token
+from export import FORMATS, stream_export
+from importer import file_format, import_games, read_games
+from live import spectator_events
+from mailer import mailer
+from maintenance import janitor
+from metrics import (collect_db_stats, db_stats_prometheus, render_cache_prometheus, request_queries, request_metrics,
+                     request_metrics_prometheus)
+from players import autocomplete, find_player, head_to_head, player_history, sync_game
+from render_cache import spectator_cache
+from recalculate import (recalculate_from_round, score_round, seed_state, game_rounds, stored_values,
+                         DERIVED_COLUMNS, UPDATE_DERIVED_SQL)
+from rescore import rescore_games, RULE_COLUMNS
+import round_log
+from search import search_games
+from scoring import format_bid_display, format_made_display, get_score_breakdown_detailed
+from stats import tracking, user_stats
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
@@ -14,9 +31,78 @@ app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-producti
 # Make sessions permanent (never expire unless user logs out)
 app.permanent_session_lifetime = timedelta(days=365)  # 1 year
 
+# Add a Server-Timing header (total time, SQL time and statement count) to every response
+app.config['SERVER_TIMING'] = os.environ.get('SPADES_SERVER_TIMING') == '1'
+
 # Initialize database on startup
 init_db()
 
+# Deliver any email left in the outbox by a previous run
+if mailer.api_key:
+    mailer.start()
+
+# Expired codes, WAL checkpoints and vacuuming happen here rather than in requests
+janitor.start()
+
+@app.before_request
+def start_janitor():
+    """A worker forked after import has no janitor thread of its own yet"""
+    janitor.start()
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    request_queries.start(request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.after_request
+def record_request_metrics(response):
+    """Latency and SQL usage per route. For streamed responses this covers the
+    time to the first byte, not the whole stream."""
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    queries, query_seconds = request_queries.stop()
+    request_metrics.record(request_queries.route, request.method, response.status_code, elapsed, queries, query_seconds)
+    if app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = 'app;dur={:.2f}, db;dur={:.2f};desc="{} queries"'.format(
+            elapsed * 1000, query_seconds * 1000, queries)
+    return response
+
+@app.teardown_appcontext
+def release_db_connections(exception):
+    """Hand back any pooled connection a route left checked out (e.g. after an exception)"""
+    db_pool.release_thread()
+
+class Redirect(Exception):
+    """Raised inside a unit of work to roll it back, flash `message` and redirect"""
+
+    def __init__(self, message, endpoint, **values):
+        super().__init__(message)
+        self.message = message
+        self.endpoint = endpoint
+        self.values = values
+
+    def __reduce__(self):
+        # Units of work may run in the writer process; their redirects come back pickled
+        return (Redirect._rebuild, (self.message, self.endpoint, self.values))
+
+    @staticmethod
+    def _rebuild(message, endpoint, values):
+        return Redirect(message, endpoint, **values)
+
+@app.errorhandler(Redirect)
+def handle_redirect(e):
+    flash(e.message)
+    return redirect(url_for(e.endpoint, **e.values))
+
+@app.errorhandler(DatabaseBusy)
+def database_busy(e):
+    """Every retry of a write hit a held lock; ask the client to come back shortly"""
+    print("Database busy on {}: {}".format(request.path, e))
+    response = app.make_response((render_template('busy.html'), 503))
+    response.headers['Retry-After'] = '2'
+    return response
+
 # Template filter for datetime formatting
 @app.template_filter('datetime')
 def datetime_filter(date_string):
@@ -85,124 +171,254 @@ def homepage():
     
     return render_template('homepage.html')
 
+# Card columns for the dashboard lists; all of them are in idx_games_dashboard
+DASHBOARD_COLUMNS = """id, status, team1_player1, team1_player2, team2_player1, team2_player2,
+    team1_final_score, team2_final_score, max_score, winner, created_date, completed_date"""
+
+DASHBOARD_PAGE_SIZE = 12
+
+# Active and abandoned games page newest first through (created_date, id);
+# each branch reads one page (plus one row to tell if there is more) and its total
+DASHBOARD_SQL = """
+    SELECT * FROM (
+        SELECT 'active' AS section, {columns},
+               (SELECT COUNT(*) FROM games WHERE created_by_user_id = :user_id AND status = 'active') AS section_total
+        FROM games WHERE created_by_user_id = :user_id AND status = 'active'
+        ORDER BY created_date DESC, id DESC LIMIT :page_size + 1)
+    UNION ALL
+    SELECT * FROM (
+        SELECT 'completed' AS section, {columns}, NULL AS section_total
+        FROM games WHERE created_by_user_id = :user_id AND status = 'completed'
+        ORDER BY completed_date DESC LIMIT 5)
+    UNION ALL
+    SELECT * FROM (
+        SELECT 'abandoned' AS section, {columns},
+               (SELECT COUNT(*) FROM games WHERE created_by_user_id = :user_id AND status = 'abandoned') AS section_total
+        FROM games WHERE created_by_user_id = :user_id AND status = 'abandoned'
+        ORDER BY created_date DESC, id DESC LIMIT :page_size + 1)
+""".format(columns=DASHBOARD_COLUMNS)
+
+DASHBOARD_PAGE_SQL = """
+    SELECT {columns} FROM games
+    WHERE created_by_user_id = ? AND status = ? AND (created_date, id) < (?, ?)
+    ORDER BY created_date DESC, id DESC LIMIT ?
+""".format(columns=DASHBOARD_COLUMNS)
+
+def dashboard_cursor(games):
+    """Cursor for the page after `games`, or None if that was the last page"""
+    if len(games) <= DASHBOARD_PAGE_SIZE:
+        return None
+    last = games[DASHBOARD_PAGE_SIZE - 1]
+    return '{}|{}'.format(last['created_date'], last['id'])
+
 @app.route('/dashboard')
 @require_login
 def dashboard():
     conn = get_db_connection()
-    
-    # Get user's active games
-    active_games = conn.execute('''
-        SELECT g.*, 
-               CASE WHEN g.team1_final_score >= g.max_score OR g.team2_final_score >= g.max_score 
-                    THEN 'completed' ELSE 'active' END as display_status
-        FROM games g 
-        WHERE g.created_by_user_id = ? AND g.status = 'active'
-        ORDER BY g.created_date DESC
-    ''', (session['user_id'],)).fetchall()
-    
-    # Get recent completed games
-    completed_games = conn.execute('''
-        SELECT * FROM games 
-        WHERE created_by_user_id = ? AND status = 'completed'
-        ORDER BY completed_date DESC LIMIT 5
-    ''', (session['user_id'],)).fetchall()
-
-    # Get abandoned games
-    abandoned_games = conn.execute('''
-        SELECT * FROM games
-        WHERE created_by_user_id = ? AND status = 'abandoned'
-        ORDER BY created_date DESC
-    ''', (session['user_id'],)).fetchall()
-    
+    rows = conn.execute(DASHBOARD_SQL, {'user_id': session['user_id'], 'page_size': DASHBOARD_PAGE_SIZE}).fetchall()
     conn.close()
-    
+
+    sections = {'active': [], 'completed': [], 'abandoned': []}
+    totals = {}
+    for row in rows:
+        sections[row['section']].append(row)
+        totals[row['section']] = row['section_total']
+
     return render_template('dashboard.html', 
-                         active_games=active_games, 
-                         completed_games=completed_games,
-                         abandoned_games=abandoned_games)
+                         active_games=sections['active'][:DASHBOARD_PAGE_SIZE],
+                         active_total=totals.get('active', 0),
+                         active_cursor=dashboard_cursor(sections['active']),
+                         completed_games=sections['completed'],
+                         abandoned_games=sections['abandoned'][:DASHBOARD_PAGE_SIZE],
+                         abandoned_total=totals.get('abandoned', 0),
+                         abandoned_cursor=dashboard_cursor(sections['abandoned']))
+
+@app.route('/dashboard/<any(active, abandoned):status>')
+@require_login
+def dashboard_more(status):
+    """"Load more" fragment: the next page of active or abandoned game cards"""
+    try:
+        created_date, game_id = request.args['before'].rsplit('|', 1)
+        game_id = int(game_id)
+    except (KeyError, ValueError):
+        return 'Invalid cursor', 400
+
+    conn = get_db_connection()
+    games = conn.execute(DASHBOARD_PAGE_SQL, (session['user_id'], status, created_date, game_id,
+                                              DASHBOARD_PAGE_SIZE + 1)).fetchall()
+    conn.close()
+
+    return render_template('_dashboard_{}_cards.html'.format(status),
+                           games=games[:DASHBOARD_PAGE_SIZE],
+                           cursor=dashboard_cursor(games),
+                           status=status)
+
+@app.route('/stats')
+@require_login
+def player_stats():
+    """Per-player and per-partnership statistics, read from the maintained aggregates"""
+    conn = get_db_connection()
+    stats = user_stats(conn, session['user_id'])
+    conn.close()
+    return render_template('stats.html', players=stats['player'], partnerships=stats['partnership'])
+
+@app.route('/search')
+@require_login
+def search():
+    """Find any of the user's games by player, winner, share code or date"""
+    query = request.args.get('q', '').strip()
+    page = max(1, request.args.get('page', 1, type=int))
+    games, has_more = [], False
+    if query:
+        conn = get_db_connection()
+        games, has_more = search_games(conn, session['user_id'], query, page)
+        conn.close()
+    return render_template('search.html', query=query, games=games, page=page, has_more=has_more)
+
+@app.route('/export.<fmt>')
+@require_login
+def export_games(fmt):
+    """All of the user's games and rounds as a CSV or NDJSON download, streamed
+    (and gzipped when the client accepts it) without loading the history"""
+    if fmt not in FORMATS:
+        return 'Unknown export format', 404
+    compress = 'gzip' in request.accept_encodings
+    headers = {
+        'Content-Disposition': 'attachment; filename=spades-games.{}'.format(fmt),
+        'Vary': 'Accept-Encoding',
+    }
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(stream_export(session['user_id'], fmt, compress)),
+                    mimetype=FORMATS[fmt], headers=headers)
+
+@app.route('/import', methods=['GET', 'POST'])
+@require_login
+def import_history():
+    """Upload past games as CSV or JSON; each is re-scored and the good ones saved in one go"""
+    result = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Choose a CSV or JSON file to import')
+            return redirect(url_for('import_history'))
+        try:
+            text = upload.read().decode('utf-8-sig')
+        except UnicodeDecodeError:
+            flash('The file must be UTF-8 text')
+            return redirect(url_for('import_history'))
+        games, errors = read_games(text, file_format(upload.filename))
+        imported_games, imported_rounds = import_games(session['user_id'], games)
+        result = {'games': imported_games, 'rounds': imported_rounds, 'errors': errors}
+    return render_template('import.html', result=result)
+
+@app.route('/players/autocomplete')
+@require_login
+def player_autocomplete():
+    """Names of the user's players starting with ?q=, for the game forms"""
+    conn = get_db_connection()
+    names = autocomplete(conn, session['user_id'], request.args.get('q', ''))
+    conn.close()
+    return jsonify(names)
+
+@app.route('/players/<name>')
+@require_login
+def player_games(name):
+    """A player's games, or with ?vs= their games against another player"""
+    conn = get_db_connection()
+    player = find_player(conn, session['user_id'], name)
+    if not player:
+        conn.close()
+        flash('Player not found')
+        return redirect(url_for('player_stats'))
+
+    opponent = record = None
+    if request.args.get('vs'):
+        opponent = find_player(conn, session['user_id'], request.args['vs'])
+        if not opponent:
+            conn.close()
+            flash('Player not found')
+            return redirect(url_for('player_games', name=player['name']))
+        games, record = head_to_head(conn, player, opponent)
+    else:
+        games = player_history(conn, player)
+    conn.close()
+    return render_template('player.html', player=player, opponent=opponent, record=record, games=games)
 
 # Registration route removed - users are created automatically on first login
 
+@transactional
+def issue_security_code(conn, email):
+    """Find or create the user for `email` and store a new 6-digit code. Returns (user_id, code)."""
+    user = conn.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()
+    if user:
+        user_id = user['id']
+    else:
+        # Create user automatically with email as name (can be ignored later)
+        name = email.split('@')[0]  # Use part before @ as default name
+        user_id = conn.execute('INSERT INTO users (name, email) VALUES (?, ?)', (name, email)).lastrowid
+
+    code = secrets.randbelow(900000) + 100000  # 6-digit code
+    expires_at = datetime.now() + timedelta(minutes=15)
+    conn.execute('''
+        INSERT INTO auth_codes (user_id, code, expires_at)
+        VALUES (?, ?, ?)
+    ''', (user_id, str(code), expires_at))
+    return user_id, code
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         email = request.form['email']
-        
+
         try:
-            conn = get_db_connection()
-            user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
-            
-            if not user:
-                # Create user automatically with email as name (can be ignored later)
-                name = email.split('@')[0]  # Use part before @ as default name
-                cursor = conn.execute('INSERT INTO users (name, email) VALUES (?, ?)', (name, email))
-                user_id = cursor.lastrowid
-                conn.commit()  # Commit the user creation immediately
-                user = {'id': user_id, 'name': name, 'email': email}
-            
-            # Clean up old codes periodically
-            cleanup_expired_codes()
-            
-            # Generate and send security code
-            code = secrets.randbelow(900000) + 100000  # 6-digit code
-            expires_at = datetime.now() + timedelta(minutes=15)
-            
-            conn.execute('''
-                INSERT INTO auth_codes (user_id, code, expires_at) 
-                VALUES (?, ?, ?)
-            ''', (user['id'], str(code), expires_at))
-            conn.commit()
-            
+            user_id, code = issue_security_code(email)
+
             # Send email (for now, just flash the code for development)
             if send_security_code(email, code):
-                session['pending_user_id'] = user['id']
+                session['pending_user_id'] = user_id
                 flash('Security code sent to {}'.format(email))
                 return redirect(url_for('verify'))
             else:
                 flash('Failed to send security code. Please try again.')
-                
-        except sqlite3.OperationalError as e:
-            if "database is locked" in str(e):
-                flash('Database is temporarily busy. Please try again in a moment.')
-            else:
-                flash('Database error occurred. Please try again.')
+
+        except DatabaseBusy as e:
+            flash('Database is temporarily busy. Please try again in a moment.')
+            print("Database busy in login: {}".format(e))
+        except sqlite3.Error as e:
+            flash('Database error occurred. Please try again.')
             print("Database error in login: {}".format(e))
         except Exception as e:
             flash('An error occurred. Please try again.')
             print("Unexpected error in login: {}".format(e))
-        finally:
-            try:
-                conn.close()
-            except:
-                pass
-    
+
     return render_template('login.html')
 
+@transactional
+def record_login(conn, user_id):
+    conn.execute('UPDATE users SET last_login = ? WHERE id = ?', (datetime.now(), user_id))
+
 @app.route('/verify', methods=['GET', 'POST'])
 def verify():
     if 'pending_user_id' not in session:
         return redirect(url_for('login'))
-    
+
     if request.method == 'POST':
         code = request.form['code']
-        
+
         if verify_security_code(session['pending_user_id'], code):
             session['user_id'] = session['pending_user_id']
             session.permanent = True  # Make session persistent
             del session['pending_user_id']
-            
+
             # Update last login
-            conn = get_db_connection()
-            conn.execute('UPDATE users SET last_login = ? WHERE id = ?', 
-                        (datetime.now(), session['user_id']))
-            conn.commit()
-            conn.close()
-            
+            record_login(session['user_id'])
+
             flash('Login successful!')
             return redirect(url_for('dashboard'))
         else:
             flash('Invalid or expired security code')
-    
+
     return render_template('verify.html')
 
 @app.route('/logout')
@@ -211,43 +427,173 @@ def logout():
     flash('Logged out successfully')
     return redirect(url_for('login'))
 
+def game_settings(form):
+    """Player names, score limit and scoring rules from a new/edit game form"""
+    return {
+        'team1_player1': form['team1_player1'],
+        'team1_player2': form['team1_player2'],
+        'team2_player1': form['team2_player1'],
+        'team2_player2': form['team2_player2'],
+        'max_score': int(form.get('max_score', 500)),
+        'nil_penalty': int(form.get('nil_penalty', 100)),
+        'blind_nil_penalty': int(form.get('blind_nil_penalty', 200)),
+        'bag_penalty_threshold': int(form.get('bag_penalty_threshold', 10)),
+        'bag_penalty_points': int(form.get('bag_penalty_points', 100)),
+    }
+
+@transactional
+def create_game(conn, user_id, settings):
+    """Insert a game with a fresh share code. Returns its id."""
+    # Generate 5-digit share code
+    share_code = generate_share_code(conn)
+
+    cursor = conn.execute('''
+        INSERT INTO games (
+            created_by_user_id, team1_player1, team1_player2,
+            team2_player1, team2_player2, max_score, nil_penalty,
+            blind_nil_penalty, bag_penalty_threshold, bag_penalty_points, share_code
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, settings['team1_player1'], settings['team1_player2'],
+          settings['team2_player1'], settings['team2_player2'], settings['max_score'], settings['nil_penalty'],
+          settings['blind_nil_penalty'], settings['bag_penalty_threshold'], settings['bag_penalty_points'], share_code))
+    sync_game(conn, cursor.lastrowid)
+    return cursor.lastrowid
+
 @app.route('/new-game', methods=['GET', 'POST'])
 @require_login
 def new_game():
     if request.method == 'POST':
-        team1_player1 = request.form['team1_player1']
-        team1_player2 = request.form['team1_player2']
-        team2_player1 = request.form['team2_player1']
-        team2_player2 = request.form['team2_player2']
-        max_score = int(request.form.get('max_score', 500))
-        nil_penalty = int(request.form.get('nil_penalty', 100))
-        blind_nil_penalty = int(request.form.get('blind_nil_penalty', 200))
-        bag_penalty_threshold = int(request.form.get('bag_penalty_threshold', 10))
-        bag_penalty_points = int(request.form.get('bag_penalty_points', 100))
-        
-        # Generate 5-digit share code
-        share_code = str(secrets.randbelow(90000) + 10000)  # 10000-99999
-        
-        conn = get_db_connection()
-        cursor = conn.execute('''
-            INSERT INTO games (
-                created_by_user_id, team1_player1, team1_player2, 
-                team2_player1, team2_player2, max_score, nil_penalty, 
-                blind_nil_penalty, bag_penalty_threshold, bag_penalty_points, share_code
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (session['user_id'], team1_player1, team1_player2, 
-              team2_player1, team2_player2, max_score, nil_penalty, 
-              blind_nil_penalty, bag_penalty_threshold, bag_penalty_points, share_code))
-        
-        game_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
+        game_id = create_game(session['user_id'], game_settings(request.form))
+
         flash('Game created successfully!')
         return redirect(url_for('game', game_id=game_id))
-    
+
     return render_template('new_game.html')
 
+def game_versions(conn, game_ids):
+    """Current version of several games in one query"""
+    placeholders = ','.join('?' * len(game_ids))
+    rows = conn.execute('SELECT id, version FROM games WHERE id IN ({})'.format(placeholders),
+                        list(game_ids)).fetchall()
+    return {row['id']: row['version'] for row in rows}
+
+def build_spectator_update(conn, game_id, from_round=1, reload=False):
+    """Compact delta for live spectators: totals, pending bids and rounds from from_round onwards"""
+    game = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+    if not game:
+        return None
+
+    rounds = game_rounds(conn, game, from_round)
+    completed_count = conn.execute('''
+        SELECT COUNT(*) FROM rounds WHERE game_id = ? AND team1_actual IS NOT NULL
+    ''', (game_id,)).fetchone()[0]
+
+    completed = [r for r in rounds if r['team1_actual'] is not None]
+    pending_round = next((r for r in rounds if r['team1_actual'] is None), None)
+
+    def to_win(score):
+        # Mirrors the team_scores macro in base.html
+        return game['max_score'] - score if score < 500 else None
+
+    return {
+        'version': game['version'],
+        'status': game['status'],
+        # The completed-game summary and renamed players are easier to show with a full page load
+        'reload': reload or game['status'] == 'completed',
+        'scores': {
+            'team1': score_with_bags_filter(game['team1_final_score'], game['team1_bags']),
+            'team2': score_with_bags_filter(game['team2_final_score'], game['team2_bags']),
+            'team1_to_win': to_win(game['team1_final_score']),
+            'team2_to_win': to_win(game['team2_final_score']),
+        },
+        'lead_html': render_template('_spectator_lead.html', game=game),
+        'pending_html': render_template('_spectator_pending.html', game=game, pending_round=pending_round),
+        'rounds': [{'round_number': r['round_number'],
+                    'html': render_template('_spectator_round.html', game=game, round=r)}
+                   for r in completed],
+        'completed_rounds': completed_count,
+    }
+
+def publish_spectator_update(game_id, from_round=1, reload=False):
+    """Push a live update to anyone spectating game_id (no-op when nobody is watching)"""
+    if not spectator_events.is_watched(game_id):
+        return
+    conn = get_db_connection()
+    try:
+        update = build_spectator_update(conn, game_id, from_round, reload)
+    finally:
+        conn.close()
+    if update:
+        spectator_events.publish(game_id, update)
+
+def game_changed(game_id, from_round=1, reload=False):
+    """Call after committing a write to a game: drops its cached renderings
+    and pushes the change to live spectators"""
+    spectator_cache.invalidate_game(game_id)
+    publish_spectator_update(game_id, from_round, reload)
+
+def _watched_versions(game_ids):
+    conn = get_db_connection()
+    try:
+        return game_versions(conn, game_ids)
+    finally:
+        conn.close()
+
+def _publish_external_change(game_id):
+    # Another worker wrote to this game; we don't know which rounds changed
+    with app.app_context():
+        publish_spectator_update(game_id)
+
+spectator_events.start_watcher(_watched_versions, _publish_external_change)
+
+# An open stream holds a worker (a whole one under gunicorn's default sync
+# workers), so each one ends after this long; EventSource reconnects after the
+# `retry` delay and sends Last-Event-ID, the version it last showed
+SPECTATOR_STREAM_SECONDS = 25
+
+def format_sse(update):
+    return 'id: {}\nevent: update\ndata: {}\n\n'.format(update['version'], json.dumps(update))
+
+# Lets a deploy with changed templates invalidate ETags issued for the same game version
+RENDER_REVISION = '{:x}'.format(int(max(
+    os.path.getmtime(os.path.join(root, name))
+    for root, _, files in os.walk(os.path.join(app.root_path, app.template_folder))
+    for name in files
+)))
+
+def game_etag(kind, game):
+    """ETag for a rendering of a game; the viewer matters because the nav bar differs.
+    None while a flash message is waiting: that rendering shows it once and must
+    not be revalidated later, so it gets no ETag."""
+    if '_flashes' in session:
+        return None
+    return '{}-{}-v{}-u{}-{}'.format(kind, game['id'], game['version'],
+                                     session.get('user_id', 0), RENDER_REVISION)
+
+def not_modified(etag, cache_control):
+    """304 response when the client already has this ETag, otherwise None"""
+    if etag is None or etag not in request.if_none_match:
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def cacheable(response, etag, cache_control):
+    response = app.make_response(response)
+    if etag is not None:
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def spectator_cache_control():
+    # Anonymous spectator pages are identical for everyone, so a shared cache
+    # can serve a crowd watching one table and revalidate in the background -
+    # unless this visitor has a flash message waiting, which is theirs alone
+    if 'user_id' in session or '_flashes' in session:
+        return 'private, no-cache'
+    return 'public, max-age=2, stale-while-revalidate=30'
+
 @app.route('/view/<share_code>')
 def view_game(share_code):
     """Public spectator view - no authentication required"""
@@ -260,16 +606,94 @@ def view_game(share_code):
         flash('Game not found or invalid share code')
         conn.close()
         return render_template('homepage.html')
-    
-    # Get rounds
-    rounds = conn.execute('''
-        SELECT * FROM rounds WHERE game_id = ? ORDER BY round_number
-    ''', (game['id'],)).fetchall()
+
+    etag = game_etag('view', game)
+    cache_control = spectator_cache_control()
+    unchanged = not_modified(etag, cache_control)
+    if unchanged:
+        conn.close()
+        return unchanged
+
+    # Anonymous renderings are the same for every spectator of this version
+    shared = 'user_id' not in session and '_flashes' not in session
+    html = spectator_cache.get('view', game) if shared else None
+    if html is None:
+        # Get rounds
+        rounds = game_rounds(conn, game)
+
+        # Render spectator template (read-only version of game.html)
+        html = render_template('spectator.html', game=game, rounds=rounds)
+        if shared:
+            spectator_cache.put('view', game, html)
     
     conn.close()
-    
-    # Render spectator template (read-only version of game.html)
-    return render_template('spectator.html', game=game, rounds=rounds)
+    return cacheable(html, etag, cache_control)
+
+@app.route('/view/<share_code>/json')
+def view_game_json(share_code):
+    """Spectator view as JSON - same data and caching as /view/<share_code>"""
+    conn = get_db_connection()
+    game = conn.execute('SELECT * FROM games WHERE share_code = ?', (share_code,)).fetchone()
+    if not game:
+        conn.close()
+        return jsonify({'error': 'Game not found'}), 404
+
+    etag = game_etag('json', game)
+    cache_control = spectator_cache_control()
+    unchanged = not_modified(etag, cache_control)
+    if unchanged:
+        conn.close()
+        return unchanged
+
+    body = spectator_cache.get('json', game)
+    if body is None:
+        rounds = game_rounds(conn, game)
+
+        game_data = dict(game)
+        del game_data['created_by_user_id']
+        body = json.dumps({'game': game_data, 'rounds': [dict(r) for r in rounds]})
+        spectator_cache.put('json', game, body)
+    conn.close()
+
+    return cacheable(Response(body, mimetype='application/json'), etag, cache_control)
+
+@app.route('/view/<share_code>/stream')
+def view_game_stream(share_code):
+    """Server-Sent Events stream of live updates for the spectator view"""
+    conn = get_db_connection()
+    game = conn.execute('SELECT id, version FROM games WHERE share_code = ?', (share_code,)).fetchone()
+    if not game:
+        conn.close()
+        return 'Game not found', 404
+
+    game_id = game['id']
+    current = game['version']
+    # The page (or the last event before a reconnect) tells us which version the client shows
+    seen = request.headers.get('Last-Event-ID') or request.args.get('v')
+    initial = build_spectator_update(conn, game_id) if seen != str(current) else None
+    conn.close()
+
+    def stream():
+        yield 'retry: 3000\n\n'
+        if initial:
+            yield format_sse(initial)
+        for updates in spectator_events.listen(game_id, current, duration=SPECTATOR_STREAM_SECONDS):
+            if updates is None:
+                yield ': keepalive\n\n'
+            elif updates == 'resync':
+                resync_conn = get_db_connection()
+                try:
+                    update = build_spectator_update(resync_conn, game_id)
+                finally:
+                    resync_conn.close()
+                if update:
+                    yield format_sse(update)
+            else:
+                for update in updates:
+                    yield format_sse(update)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/game/<int:game_id>')
 @require_login
@@ -284,204 +708,144 @@ def game(game_id):
         flash('Game not found')
         conn.close()
         return redirect(url_for('dashboard'))
+
+    etag = game_etag('game', game)
+    unchanged = not_modified(etag, 'private, no-cache')
+    if unchanged:
+        conn.close()
+        return unchanged
     
     # Get rounds
-    rounds = conn.execute('''
-        SELECT * FROM rounds WHERE game_id = ? ORDER BY round_number
-    ''', (game_id,)).fetchall()
+    rounds = game_rounds(conn, game)
+    can_undo = round_log.can_undo(conn, game_id)
     
     conn.close()
     
-    return render_template('game.html', game=game, rounds=rounds)
+    return cacheable(render_template('game.html', game=game, rounds=rounds, can_undo=can_undo), etag,
+                     'private, no-cache')
+
+SUCCESS_FLAGS = ('team1_nil_success', 'team1_blind_nil_success', 'team1_blind_success',
+                 'team2_nil_success', 'team2_blind_nil_success', 'team2_blind_success')
+
+PENDING_ROUND_SQL = '''
+    SELECT * FROM rounds WHERE game_id = ? AND team1_actual IS NULL
+    ORDER BY round_number DESC LIMIT 1
+'''
+
+def success_flags(form):
+    return {flag: form.get(flag) == 'on' for flag in SUCCESS_FLAGS}
+
+def owned_game(conn, user_id, game_id):
+    """The current user's game, or back to the dashboard"""
+    game = conn.execute('SELECT * FROM games WHERE id = ? AND created_by_user_id = ?',
+                        (game_id, user_id)).fetchone()
+    if not game:
+        raise Redirect('Game not found', 'dashboard')
+    return game
+
+def scored_round(conn, game_id, round_id):
+    """A round of the game that already has scores, or back to the game"""
+    round_data = conn.execute(
+        'SELECT * FROM rounds WHERE id = ? AND game_id = ? AND team1_actual IS NOT NULL',
+        (round_id, game_id)
+    ).fetchone()
+    if not round_data:
+        raise Redirect('Round not found', 'game', game_id=game_id)
+    return round_data
+
+def pending_bids_round(conn, game_id, round_id):
+    """A round of the game whose bids can still be changed, or back to the game"""
+    round_data = conn.execute('SELECT * FROM rounds WHERE id = ? AND game_id = ?',
+                              (round_id, game_id)).fetchone()
+    if not round_data:
+        raise Redirect('Round not found', 'game', game_id=game_id)
+    # Check if scores have already been entered (prevent editing if scores exist)
+    if round_data['team1_actual'] is not None:
+        raise Redirect('Cannot edit bids after scores have been entered', 'game', game_id=game_id)
+    return round_data
+
+@transactional
+def save_bids(conn, user_id, game_id, team1_bid, team2_bid):
+    """Bids for the pending round, starting a new round if there isn't one. Returns its number."""
+    owned_game(conn, user_id, game_id)
+    pending_round = conn.execute(PENDING_ROUND_SQL, (game_id,)).fetchone()
+    if pending_round:
+        # Update existing round with bids
+        conn.execute('''
+            UPDATE rounds SET team1_bid = ?, team2_bid = ? WHERE id = ?
+        ''', (team1_bid, team2_bid, pending_round['id']))
+        round_log.record(conn, game_id, 'bids', pending_round['round_number'], round_log.image(pending_round),
+                         round_log.round_image(conn, pending_round['id']))
+        return pending_round['round_number']
+
+    # Create new round with just bids
+    round_number = conn.execute('SELECT COUNT(*) as count FROM rounds WHERE game_id = ?',
+                                (game_id,)).fetchone()['count'] + 1
+    cursor = conn.execute('''
+        INSERT INTO rounds (game_id, round_number, team1_bid, team2_bid)
+        VALUES (?, ?, ?, ?)
+    ''', (game_id, round_number, team1_bid, team2_bid))
+    round_log.record(conn, game_id, 'bids', round_number, None, round_log.round_image(conn, cursor.lastrowid))
+    return round_number
 
 @app.route('/game/<int:game_id>/round', methods=['GET', 'POST'])
 @require_login
 def add_round(game_id):
-    conn = get_db_connection()
-    
-    # Get game details
-    game = conn.execute('SELECT * FROM games WHERE id = ? AND created_by_user_id = ?', 
-                       (game_id, session['user_id'])).fetchone()
-    
-    if not game:
-        flash('Game not found')
-        conn.close()
-        return redirect(url_for('dashboard'))
-    
-    # Get current round number
-    round_count = conn.execute('SELECT COUNT(*) as count FROM rounds WHERE game_id = ?', 
-                              (game_id,)).fetchone()['count']
-    round_number = round_count + 1
-    
-    # Check if there's already a pending round (bids entered but no scores)
-    pending_round = conn.execute('''
-        SELECT * FROM rounds WHERE game_id = ? AND team1_actual IS NULL 
-        ORDER BY round_number DESC LIMIT 1
-    ''', (game_id,)).fetchone()
-    
     if request.method == 'POST':
-        team1_bid = request.form['team1_bid']
-        team2_bid = request.form['team2_bid']
-        
-        if pending_round:
-            # Update existing round with bids
-            conn.execute('''
-                UPDATE rounds SET team1_bid = ?, team2_bid = ? WHERE id = ?
-            ''', (team1_bid, team2_bid, pending_round['id']))
-        else:
-            # Create new round with just bids
-            conn.execute('''
-                INSERT INTO rounds (game_id, round_number, team1_bid, team2_bid) 
-                VALUES (?, ?, ?, ?)
-            ''', (game_id, round_number, team1_bid, team2_bid))
-        
-        conn.commit()
-        conn.close()
-        
+        round_number = save_bids(session['user_id'], game_id, request.form['team1_bid'], request.form['team2_bid'])
+        game_changed(game_id, round_number)
+
         flash('Bids saved! Now enter the actual scores.')
         return redirect(url_for('enter_scores', game_id=game_id))
-    
-    conn.close()
-    return render_template('bid_form.html', game=game, round_number=round_number)
 
-@app.route('/game/<int:game_id>/scores', methods=['GET', 'POST'])
-@require_login
-def enter_scores(game_id):
     conn = get_db_connection()
-    
-    # Get game details
-    game = conn.execute('SELECT * FROM games WHERE id = ? AND created_by_user_id = ?', 
-                       (game_id, session['user_id'])).fetchone()
-    
-    if not game:
-        flash('Game not found')
-        conn.close()
-        return redirect(url_for('dashboard'))
-    
-    # Get the pending round (with bids but no scores)
-    pending_round = conn.execute('''
-        SELECT * FROM rounds WHERE game_id = ? AND team1_actual IS NULL 
-        ORDER BY round_number DESC LIMIT 1
-    ''', (game_id,)).fetchone()
-    
-    if not pending_round:
-        flash('No pending round found. Please enter bids first.')
-        conn.close()
-        return redirect(url_for('add_round', game_id=game_id))
-    
-    if request.method == 'POST':
-        team1_actual = int(request.form['team1_actual'])
-        team2_actual = int(request.form['team2_actual'])
-        
-        # Validate totals equal 13
-        if team1_actual + team2_actual != 13:
-            flash('Team totals must equal 13')
-            conn.close()
-            return render_template('score_form.html', game=game, round=pending_round)
-        
-        # Get special bid success flags
-        team1_nil_success = request.form.get('team1_nil_success') == 'on'
-        team1_blind_nil_success = request.form.get('team1_blind_nil_success') == 'on'
-        team1_blind_success = request.form.get('team1_blind_success') == 'on'
-        
-        team2_nil_success = request.form.get('team2_nil_success') == 'on'
-        team2_blind_nil_success = request.form.get('team2_blind_nil_success') == 'on'
-        team2_blind_success = request.form.get('team2_blind_success') == 'on'
-        
-        # Calculate detailed scoring components for both teams
-        team1_scoring = calculate_detailed_round_scoring(
-            pending_round['team1_bid'], team1_actual, game,
-            team1_nil_success, team1_blind_nil_success, team1_blind_success
-        )
-        team2_scoring = calculate_detailed_round_scoring(
-            pending_round['team2_bid'], team2_actual, game,
-            team2_nil_success, team2_blind_nil_success, team2_blind_success
-        )
-        
-        # Get current totals
-        last_completed_round = conn.execute('''
-            SELECT team1_total, team2_total, team1_bags_total, team2_bags_total 
-            FROM rounds WHERE game_id = ? AND team1_actual IS NOT NULL 
-            ORDER BY round_number DESC LIMIT 1
-        ''', (game_id,)).fetchone()
-        
-        if last_completed_round:
-            team1_bags_total = last_completed_round['team1_bags_total']
-            team2_bags_total = last_completed_round['team2_bags_total']
-        else:
-            team1_bags_total = 0
-            team2_bags_total = 0
-        
-        # Calculate bags earned this round
-        team1_bags_earned = max(0, team1_actual - int(parse_bid(pending_round['team1_bid'])[0]))
-        team2_bags_earned = max(0, team2_actual - int(parse_bid(pending_round['team2_bid'])[0]))
-        
-        # Store bags before penalty for tracking
-        team1_bags_before_penalty = team1_bags_total + team1_bags_earned
-        team2_bags_before_penalty = team2_bags_total + team2_bags_earned
-        
-        # Update bag totals
-        team1_bags_total += team1_bags_earned
-        team2_bags_total += team2_bags_earned
-        
-        # Check for bag penalties and apply them (multiple penalties if needed)
-        team1_bag_penalty = 0
-        team2_bag_penalty = 0
-
-        # Apply penalty for each complete set of bags (e.g., 23 bags = 2 penalties, 3 remaining)
-        while team1_bags_total >= game['bag_penalty_threshold']:
-            team1_bag_penalty += game['bag_penalty_points']
-            team1_bags_total -= game['bag_penalty_threshold']
-
-        while team2_bags_total >= game['bag_penalty_threshold']:
-            team2_bag_penalty += game['bag_penalty_points']
-            team2_bags_total -= game['bag_penalty_threshold']
-        
-        # Calculate final round points including bag penalties
-        team1_points = team1_scoring['total_points'] - team1_bag_penalty
-        team2_points = team2_scoring['total_points'] - team2_bag_penalty
-        
-        # Calculate new totals
-        if last_completed_round:
-            team1_total = last_completed_round['team1_total'] + team1_points
-            team2_total = last_completed_round['team2_total'] + team2_points
-        else:
-            team1_total = team1_points
-            team2_total = team2_points
-        
-        # Update round with all detailed scoring data
+    game = owned_game(conn, session['user_id'], game_id)
+
+    # Get current round number
+    round_count = conn.execute('SELECT COUNT(*) as count FROM rounds WHERE game_id = ?',
+                              (game_id,)).fetchone()['count']
+    conn.close()
+    return render_template('bid_form.html', game=game, round_number=round_count + 1)
+
+@transactional
+def score_pending_round(conn, user_id, game_id, team1_actual, team2_actual, flags):
+    """Store the tricks taken in the pending round, score it and update the game totals.
+    Returns the round number."""
+    game = owned_game(conn, user_id, game_id)
+    with tracking(conn, game_id) as changed_rounds:
+        pending_round = conn.execute(PENDING_ROUND_SQL, (game_id,)).fetchone()
+        if not pending_round:
+            raise Redirect('No pending round found. Please enter bids first.', 'add_round', game_id=game_id)
+
+        # Score this round on top of the last completed round's totals and bags
+        raw = dict(flags, team1_bid=pending_round['team1_bid'], team2_bid=pending_round['team2_bid'],
+                   team1_actual=team1_actual, team2_actual=team2_actual)
+        state = seed_state(conn, game_id, pending_round['round_number'])
+        derived, (team1_total, team2_total, team1_bags_total, team2_bags_total) = score_round(game, raw, state)
+
+        # Update round with the scores entered and all detailed scoring data
         conn.execute('''
-            UPDATE rounds SET 
-                team1_actual = ?, team2_actual = ?, team1_points = ?, team2_points = ?,
-                team1_total = ?, team2_total = ?, team1_bags_earned = ?, team2_bags_earned = ?,
-                team1_bags_total = ?, team2_bags_total = ?,
+            UPDATE rounds SET
+                team1_actual = ?, team2_actual = ?,
                 team1_nil_success = ?, team1_blind_nil_success = ?, team1_blind_success = ?,
-                team2_nil_success = ?, team2_blind_nil_success = ?, team2_blind_success = ?,
-                team1_bid_points = ?, team1_nil_bonus = ?, team1_blind_nil_bonus = ?, 
-                team1_blind_bonus = ?, team1_bag_points = ?, team1_bag_penalty = ?,
-                team2_bid_points = ?, team2_nil_bonus = ?, team2_blind_nil_bonus = ?, 
-                team2_blind_bonus = ?, team2_bag_points = ?, team2_bag_penalty = ?,
-                team1_bags_before_penalty = ?, team2_bags_before_penalty = ?
+                team2_nil_success = ?, team2_blind_nil_success = ?, team2_blind_success = ?
             WHERE id = ?
-        ''', (team1_actual, team2_actual, team1_points, team2_points,
-              team1_total, team2_total, team1_bags_earned, team2_bags_earned,
-              team1_bags_total, team2_bags_total,
-              team1_nil_success, team1_blind_nil_success, team1_blind_success,
-              team2_nil_success, team2_blind_nil_success, team2_blind_success,
-              team1_scoring['bid_points'], team1_scoring['nil_bonus'], team1_scoring['blind_nil_bonus'],
-              team1_scoring['blind_bonus'], team1_scoring['bag_points'], team1_bag_penalty,
-              team2_scoring['bid_points'], team2_scoring['nil_bonus'], team2_scoring['blind_nil_bonus'],
-              team2_scoring['blind_bonus'], team2_scoring['bag_points'], team2_bag_penalty,
-              team1_bags_before_penalty, team2_bags_before_penalty, pending_round['id']))
-        
+        ''', (team1_actual, team2_actual) + tuple(flags[flag] for flag in SUCCESS_FLAGS) + (pending_round['id'],))
+        conn.execute(UPDATE_DERIVED_SQL, stored_values(pending_round['round_number'],
+                                                       tuple(derived[column] for column in DERIVED_COLUMNS)) +
+                     (pending_round['id'],))
+        round_log.record(conn, game_id, 'scores', pending_round['round_number'], round_log.image(pending_round),
+                         round_log.round_image(conn, pending_round['id']))
+        changed_rounds.append((pending_round, raw))
+
         # Update game totals
         conn.execute('''
-            UPDATE games SET 
+            UPDATE games SET
                 team1_final_score = ?, team2_final_score = ?,
                 team1_bags = ?, team2_bags = ?
             WHERE id = ?
         ''', (team1_total, team2_total, team1_bags_total, team2_bags_total, game_id))
-        
+
         # Check for game completion
         if team1_total >= game['max_score'] or team2_total >= game['max_score']:
             if team1_total >= game['max_score']:
@@ -492,226 +856,77 @@ def enter_scores(game_id):
                 UPDATE games SET status = 'completed', winner = ?, completed_date = ?
                 WHERE id = ?
             ''', (winner, datetime.now(), game_id))
-        
-        conn.commit()
-        conn.close()
-        
-        flash('Round completed successfully!')
-        return redirect(url_for('game', game_id=game_id))
-    
-    conn.close()
-    return render_template('score_form.html', game=game, round=pending_round)
+        return pending_round['round_number']
 
-@app.route('/game/<int:game_id>/round/<int:round_id>/edit-bids', methods=['GET', 'POST'])
+@app.route('/game/<int:game_id>/scores', methods=['GET', 'POST'])
 @require_login
-def edit_bids(game_id, round_id):
-    conn = get_db_connection()
-    
-    # Get game details
-    game = conn.execute('SELECT * FROM games WHERE id = ? AND created_by_user_id = ?', 
-                       (game_id, session['user_id'])).fetchone()
-    
-    if not game:
-        flash('Game not found')
-        conn.close()
-        return redirect(url_for('dashboard'))
-    
-    # Get the specific round
-    round_data = conn.execute('SELECT * FROM rounds WHERE id = ? AND game_id = ?', 
-                             (round_id, game_id)).fetchone()
-    
-    if not round_data:
-        flash('Round not found')
-        conn.close()
-        return redirect(url_for('game', game_id=game_id))
-    
-    # Check if scores have already been entered (prevent editing if scores exist)
-    if round_data['team1_actual'] is not None:
-        flash('Cannot edit bids after scores have been entered')
-        conn.close()
-        return redirect(url_for('game', game_id=game_id))
-    
+def enter_scores(game_id):
     if request.method == 'POST':
-        team1_bid = request.form['team1_bid']
-        team2_bid = request.form['team2_bid']
-        
-        # Update the round with new bids
-        conn.execute('''
-            UPDATE rounds SET team1_bid = ?, team2_bid = ? WHERE id = ?
-        ''', (team1_bid, team2_bid, round_id))
-        
-        conn.commit()
-        conn.close()
-        
-        flash('Bids updated successfully!')
-        return redirect(url_for('enter_scores', game_id=game_id))
-    
-    conn.close()
-    return render_template('edit_bids.html', game=game, round=round_data)
+        team1_actual = int(request.form['team1_actual'])
+        team2_actual = int(request.form['team2_actual'])
 
-def recalculate_from_round(conn, game_id, start_round_number):
-    """Recalculate all round totals from a given round number onwards.
-    Call this after editing or deleting a round."""
-    game = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
-    all_rounds = conn.execute(
-        'SELECT * FROM rounds WHERE game_id = ? AND team1_actual IS NOT NULL ORDER BY round_number',
-        (game_id,)
-    ).fetchall()
-
-    # Seed cumulative state from the round just before start_round_number
-    team1_running_total = 0
-    team2_running_total = 0
-    team1_bags_total = 0
-    team2_bags_total = 0
-
-    for r in all_rounds:
-        if r['round_number'] < start_round_number:
-            team1_running_total = r['team1_total']
-            team2_running_total = r['team2_total']
-            team1_bags_total = r['team1_bags_total']
-            team2_bags_total = r['team2_bags_total']
-
-    # Now recalculate every round from start_round_number onwards
-    for r in all_rounds:
-        if r['round_number'] < start_round_number:
-            continue
-
-        t1_scoring = calculate_detailed_round_scoring(
-            r['team1_bid'], r['team1_actual'], game,
-            bool(r['team1_nil_success']), bool(r['team1_blind_nil_success']), bool(r['team1_blind_success'])
-        )
-        t2_scoring = calculate_detailed_round_scoring(
-            r['team2_bid'], r['team2_actual'], game,
-            bool(r['team2_nil_success']), bool(r['team2_blind_nil_success']), bool(r['team2_blind_success'])
-        )
-
-        t1_bags_earned = max(0, r['team1_actual'] - int(parse_bid(r['team1_bid'])[0]))
-        t2_bags_earned = max(0, r['team2_actual'] - int(parse_bid(r['team2_bid'])[0]))
-
-        t1_bags_before = team1_bags_total + t1_bags_earned
-        t2_bags_before = team2_bags_total + t2_bags_earned
-
-        team1_bags_total += t1_bags_earned
-        team2_bags_total += t2_bags_earned
-
-        t1_bag_penalty = 0
-        t2_bag_penalty = 0
-        while team1_bags_total >= game['bag_penalty_threshold']:
-            t1_bag_penalty += game['bag_penalty_points']
-            team1_bags_total -= game['bag_penalty_threshold']
-        while team2_bags_total >= game['bag_penalty_threshold']:
-            t2_bag_penalty += game['bag_penalty_points']
-            team2_bags_total -= game['bag_penalty_threshold']
-
-        t1_points = t1_scoring['total_points'] - t1_bag_penalty
-        t2_points = t2_scoring['total_points'] - t2_bag_penalty
-
-        team1_running_total += t1_points
-        team2_running_total += t2_points
+        # Validate totals equal 13
+        if team1_actual + team2_actual == 13:
+            round_number = score_pending_round(session['user_id'], game_id, team1_actual, team2_actual,
+                                               success_flags(request.form))
+            game_changed(game_id, round_number)
 
-        conn.execute('''
-            UPDATE rounds SET
-                team1_points = ?, team2_points = ?,
-                team1_total = ?, team2_total = ?,
-                team1_bags_earned = ?, team2_bags_earned = ?,
-                team1_bags_total = ?, team2_bags_total = ?,
-                team1_bag_penalty = ?, team2_bag_penalty = ?,
-                team1_bags_before_penalty = ?, team2_bags_before_penalty = ?,
-                team1_bid_points = ?, team1_nil_bonus = ?, team1_blind_nil_bonus = ?,
-                team1_blind_bonus = ?, team1_bag_points = ?,
-                team2_bid_points = ?, team2_nil_bonus = ?, team2_blind_nil_bonus = ?,
-                team2_blind_bonus = ?, team2_bag_points = ?
-            WHERE id = ?
-        ''', (
-            t1_points, t2_points,
-            team1_running_total, team2_running_total,
-            t1_bags_earned, t2_bags_earned,
-            team1_bags_total, team2_bags_total,
-            t1_bag_penalty, t2_bag_penalty,
-            t1_bags_before, t2_bags_before,
-            t1_scoring['bid_points'], t1_scoring['nil_bonus'], t1_scoring['blind_nil_bonus'],
-            t1_scoring['blind_bonus'], t1_scoring['bag_points'],
-            t2_scoring['bid_points'], t2_scoring['nil_bonus'], t2_scoring['blind_nil_bonus'],
-            t2_scoring['blind_bonus'], t2_scoring['bag_points'],
-            r['id']
-        ))
-
-    # Update game-level totals and completion status
-    last = conn.execute(
-        'SELECT * FROM rounds WHERE game_id = ? AND team1_actual IS NOT NULL ORDER BY round_number DESC LIMIT 1',
-        (game_id,)
-    ).fetchone()
+            flash('Round completed successfully!')
+            return redirect(url_for('game', game_id=game_id))
+        flash('Team totals must equal 13')
 
-    if last:
-        conn.execute('''
-            UPDATE games SET team1_final_score = ?, team2_final_score = ?,
-                             team1_bags = ?, team2_bags = ?
-            WHERE id = ?
-        ''', (last['team1_total'], last['team2_total'],
-              last['team1_bags_total'], last['team2_bags_total'], game_id))
+    conn = get_db_connection()
+    game = owned_game(conn, session['user_id'], game_id)
 
-        # Re-evaluate completion
-        if last['team1_total'] >= game['max_score'] or last['team2_total'] >= game['max_score']:
-            if last['team1_total'] >= game['max_score']:
-                winner = '{} & {}'.format(game['team1_player1'], game['team1_player2'])
-            else:
-                winner = '{} & {}'.format(game['team2_player1'], game['team2_player2'])
-            conn.execute(
-                "UPDATE games SET status = 'completed', winner = ?, completed_date = ? WHERE id = ?",
-                (winner, datetime.now(), game_id)
-            )
-        else:
-            # Game may have been completed before the edit — reopen it
-            conn.execute(
-                "UPDATE games SET status = 'active', winner = NULL, completed_date = NULL WHERE id = ? AND status = 'completed'",
-                (game_id,)
-            )
-    else:
-        # All rounds deleted — reset game totals
-        conn.execute(
-            'UPDATE games SET team1_final_score = 0, team2_final_score = 0, team1_bags = 0, team2_bags = 0, status = \'active\', winner = NULL, completed_date = NULL WHERE id = ?',
-            (game_id,)
-        )
+    # Get the pending round (with bids but no scores)
+    pending_round = conn.execute(PENDING_ROUND_SQL, (game_id,)).fetchone()
+    conn.close()
 
+    if not pending_round:
+        flash('No pending round found. Please enter bids first.')
+        return redirect(url_for('add_round', game_id=game_id))
 
-@app.route('/game/<int:game_id>/round/<int:round_id>/edit', methods=['GET', 'POST'])
-@require_login
-def edit_round(game_id, round_id):
-    conn = get_db_connection()
-    game = conn.execute('SELECT * FROM games WHERE id = ? AND created_by_user_id = ?',
-                        (game_id, session['user_id'])).fetchone()
-    if not game:
-        flash('Game not found')
-        conn.close()
-        return redirect(url_for('dashboard'))
+    return render_template('score_form.html', game=game, round=pending_round)
 
-    round_data = conn.execute(
-        'SELECT * FROM rounds WHERE id = ? AND game_id = ? AND team1_actual IS NOT NULL',
-        (round_id, game_id)
-    ).fetchone()
-    if not round_data:
-        flash('Round not found')
-        conn.close()
-        return redirect(url_for('game', game_id=game_id))
+@transactional
+def update_bids(conn, user_id, game_id, round_id, team1_bid, team2_bid):
+    """Change the bids of a round that has no scores yet. Returns its round number."""
+    owned_game(conn, user_id, game_id)
+    round_data = pending_bids_round(conn, game_id, round_id)
+
+    # Update the round with new bids
+    conn.execute('''
+        UPDATE rounds SET team1_bid = ?, team2_bid = ? WHERE id = ?
+    ''', (team1_bid, team2_bid, round_id))
+    round_log.record(conn, game_id, 'bids', round_data['round_number'], round_log.image(round_data),
+                     round_log.round_image(conn, round_id))
+    return round_data['round_number']
 
+@app.route('/game/<int:game_id>/round/<int:round_id>/edit-bids', methods=['GET', 'POST'])
+@require_login
+def edit_bids(game_id, round_id):
     if request.method == 'POST':
-        team1_actual = int(request.form['team1_actual'])
-        team2_actual = int(request.form['team2_actual'])
+        round_number = update_bids(session['user_id'], game_id, round_id,
+                                   request.form['team1_bid'], request.form['team2_bid'])
+        game_changed(game_id, round_number)
 
-        if team1_actual + team2_actual != 13:
-            flash('Team totals must equal 13')
-            conn.close()
-            return render_template('edit_round.html', game=game, round=round_data)
+        flash('Bids updated successfully!')
+        return redirect(url_for('enter_scores', game_id=game_id))
 
-        team1_bid = request.form.get('team1_bid', round_data['team1_bid'])
-        team2_bid = request.form.get('team2_bid', round_data['team2_bid'])
+    conn = get_db_connection()
+    game = owned_game(conn, session['user_id'], game_id)
+    round_data = pending_bids_round(conn, game_id, round_id)
+    conn.close()
+    return render_template('edit_bids.html', game=game, round=round_data)
 
-        team1_nil_success = request.form.get('team1_nil_success') == 'on'
-        team1_blind_nil_success = request.form.get('team1_blind_nil_success') == 'on'
-        team1_blind_success = request.form.get('team1_blind_success') == 'on'
-        team2_nil_success = request.form.get('team2_nil_success') == 'on'
-        team2_blind_nil_success = request.form.get('team2_blind_nil_success') == 'on'
-        team2_blind_success = request.form.get('team2_blind_success') == 'on'
+@transactional
+def update_round(conn, user_id, game_id, round_id, bids, team1_actual, team2_actual, flags):
+    """Replace a scored round's raw data and recalculate from it. Returns its round number."""
+    owned_game(conn, user_id, game_id)
+    with tracking(conn, game_id) as changed_rounds:
+        round_data = scored_round(conn, game_id, round_id)
+        team1_bid = bids.get('team1_bid', round_data['team1_bid'])
+        team2_bid = bids.get('team2_bid', round_data['team2_bid'])
 
         # Update the raw data for this round; recalculate will handle derived fields
         conn.execute('''
@@ -721,71 +936,105 @@ def edit_round(game_id, round_id):
                 team1_nil_success = ?, team1_blind_nil_success = ?, team1_blind_success = ?,
                 team2_nil_success = ?, team2_blind_nil_success = ?, team2_blind_success = ?
             WHERE id = ?
-        ''', (team1_bid, team2_bid, team1_actual, team2_actual,
-              team1_nil_success, team1_blind_nil_success, team1_blind_success,
-              team2_nil_success, team2_blind_nil_success, team2_blind_success,
-              round_id))
+        ''', (team1_bid, team2_bid, team1_actual, team2_actual) +
+             tuple(flags[flag] for flag in SUCCESS_FLAGS) + (round_id,))
+        updated = round_log.round_image(conn, round_id)
+        round_log.record(conn, game_id, 'edit', round_data['round_number'], round_log.image(round_data), updated)
+        changed_rounds.append((round_data, updated))
 
         recalculate_from_round(conn, game_id, round_data['round_number'])
-        conn.commit()
-        conn.close()
-        flash('Round {} updated and scores recalculated.'.format(round_data['round_number']))
-        return redirect(url_for('game', game_id=game_id))
+        return round_data['round_number']
 
-    conn.close()
-    return render_template('edit_round.html', game=game, round=round_data)
+@app.route('/game/<int:game_id>/round/<int:round_id>/edit', methods=['GET', 'POST'])
+@require_login
+def edit_round(game_id, round_id):
+    if request.method == 'POST':
+        team1_actual = int(request.form['team1_actual'])
+        team2_actual = int(request.form['team2_actual'])
 
+        if team1_actual + team2_actual == 13:
+            bids = {field: request.form[field] for field in ('team1_bid', 'team2_bid') if field in request.form}
+            round_number = update_round(session['user_id'], game_id, round_id, bids, team1_actual, team2_actual,
+                                        success_flags(request.form))
+            game_changed(game_id, round_number)
+            flash('Round {} updated and scores recalculated.'.format(round_number))
+            return redirect(url_for('game', game_id=game_id))
+        flash('Team totals must equal 13')
 
-@app.route('/game/<int:game_id>/round/<int:round_id>/delete', methods=['POST'])
-@require_login
-def delete_round(game_id, round_id):
     conn = get_db_connection()
-    game = conn.execute('SELECT * FROM games WHERE id = ? AND created_by_user_id = ?',
-                        (game_id, session['user_id'])).fetchone()
-    if not game:
-        flash('Game not found')
-        conn.close()
-        return redirect(url_for('dashboard'))
+    game = owned_game(conn, session['user_id'], game_id)
+    round_data = scored_round(conn, game_id, round_id)
+    conn.close()
+    return render_template('edit_round.html', game=game, round=round_data)
 
-    round_data = conn.execute(
-        'SELECT * FROM rounds WHERE id = ? AND game_id = ? AND team1_actual IS NOT NULL',
-        (round_id, game_id)
-    ).fetchone()
-    if not round_data:
-        flash('Round not found')
-        conn.close()
-        return redirect(url_for('game', game_id=game_id))
 
-    deleted_round_number = round_data['round_number']
-    conn.execute('DELETE FROM rounds WHERE id = ?', (round_id,))
+@transactional
+def remove_round(conn, user_id, game_id, round_id):
+    """Delete a scored round, renumber the ones after it and recalculate. Returns its old number."""
+    owned_game(conn, user_id, game_id)
+    with tracking(conn, game_id) as changed_rounds:
+        round_data = scored_round(conn, game_id, round_id)
+        deleted_round_number = round_data['round_number']
+        conn.execute('DELETE FROM rounds WHERE id = ?', (round_id,))
 
-    # Re-number all subsequent rounds to close the gap
-    conn.execute('''
-        UPDATE rounds SET round_number = round_number - 1
-        WHERE game_id = ? AND round_number > ?
-    ''', (game_id, deleted_round_number))
+        # Re-number all subsequent rounds to close the gap
+        conn.execute('''
+            UPDATE rounds SET round_number = round_number - 1
+            WHERE game_id = ? AND round_number > ?
+        ''', (game_id, deleted_round_number))
+        round_log.record(conn, game_id, 'delete', deleted_round_number, round_log.image(round_data), None)
+        changed_rounds.append((round_data, None))
 
-    recalculate_from_round(conn, game_id, deleted_round_number)
-    conn.commit()
-    conn.close()
+        recalculate_from_round(conn, game_id, deleted_round_number)
+        return deleted_round_number
+
+@app.route('/game/<int:game_id>/round/<int:round_id>/delete', methods=['POST'])
+@require_login
+def delete_round(game_id, round_id):
+    deleted_round_number = remove_round(session['user_id'], game_id, round_id)
+    game_changed(game_id, deleted_round_number)
     flash('Round {} deleted and scores recalculated.'.format(deleted_round_number))
     return redirect(url_for('game', game_id=game_id))
 
+UNDO_MESSAGES = {
+    'bids': 'Bids for round {} undone.',
+    'scores': 'Scores for round {} undone.',
+    'edit': 'Edit of round {} undone.',
+    'delete': 'Round {} restored.',
+}
+
+@transactional
+def undo_last_change(conn, user_id, game_id):
+    """Revert the last round change that hasn't been undone. Returns (action, round number)."""
+    owned_game(conn, user_id, game_id)
+    with tracking(conn, game_id) as changed_rounds:
+        undone = round_log.undo(conn, game_id)
+        if undone is None:
+            raise Redirect('Nothing to undo', 'game', game_id=game_id)
+        action, round_number, before, after = undone
+        changed_rounds.append((before, after))
+    return action, round_number
+
+@app.route('/game/<int:game_id>/undo', methods=['POST'])
+@require_login
+def undo_change(game_id):
+    action, round_number = undo_last_change(session['user_id'], game_id)
+    game_changed(game_id, round_number)
+    flash(UNDO_MESSAGES[action].format(round_number))
+    return redirect(url_for('game', game_id=game_id))
+
+
+@transactional
+def set_game_status(conn, user_id, game_id, status):
+    owned_game(conn, user_id, game_id)
+    with tracking(conn, game_id):
+        conn.execute('UPDATE games SET status = ? WHERE id = ?', (status, game_id))
 
 @app.route('/game/<int:game_id>/abandon', methods=['POST'])
 @require_login
 def abandon_game(game_id):
-    conn = get_db_connection()
-    game = conn.execute('SELECT * FROM games WHERE id = ? AND created_by_user_id = ?',
-                        (game_id, session['user_id'])).fetchone()
-    if not game:
-        flash('Game not found')
-        conn.close()
-        return redirect(url_for('dashboard'))
-
-    conn.execute("UPDATE games SET status = 'abandoned' WHERE id = ?", (game_id,))
-    conn.commit()
-    conn.close()
+    set_game_status(session['user_id'], game_id, 'abandoned')
+    game_changed(game_id)
 
     flash('Game abandoned.')
     return redirect(url_for('dashboard'))
@@ -794,50 +1043,35 @@ def abandon_game(game_id):
 @app.route('/game/<int:game_id>/recover', methods=['POST'])
 @require_login
 def recover_game(game_id):
-    conn = get_db_connection()
-    game = conn.execute('SELECT * FROM games WHERE id = ? AND created_by_user_id = ?',
-                        (game_id, session['user_id'])).fetchone()
-    if not game:
-        flash('Game not found')
-        conn.close()
-        return redirect(url_for('dashboard'))
-
-    conn.execute("UPDATE games SET status = 'active' WHERE id = ?", (game_id,))
-    conn.commit()
-    conn.close()
+    set_game_status(session['user_id'], game_id, 'active')
+    game_changed(game_id)
 
     flash('Game restored to active.')
     return redirect(url_for('game', game_id=game_id))
 
 
+@transactional
+def remove_game(conn, user_id, game_id):
+    owned_game(conn, user_id, game_id)
+    with tracking(conn, game_id, whole_game=True):
+        conn.execute('DELETE FROM rounds WHERE game_id = ?', (game_id,))
+        round_log.forget(conn, game_id)
+        conn.execute('DELETE FROM games WHERE id = ?', (game_id,))
+        sync_game(conn, game_id)
+
 @app.route('/game/<int:game_id>/delete', methods=['POST'])
 @require_login
 def delete_game(game_id):
-    conn = get_db_connection()
-    game = conn.execute('SELECT * FROM games WHERE id = ? AND created_by_user_id = ?',
-                        (game_id, session['user_id'])).fetchone()
-    if not game:
-        flash('Game not found')
-        conn.close()
-        return redirect(url_for('dashboard'))
-
-    conn.execute('DELETE FROM rounds WHERE game_id = ?', (game_id,))
-    conn.execute('DELETE FROM games WHERE id = ?', (game_id,))
-    conn.commit()
-    conn.close()
+    remove_game(session['user_id'], game_id)
+    game_changed(game_id)
 
     flash('Game permanently deleted.')
     return redirect(url_for('dashboard'))
 
 
-@app.route('/games/bulk-abandon', methods=['POST'])
-@require_login
-def bulk_abandon_old_games():
-    days = int(request.form.get('days', 30))
-    cutoff = datetime.now() - timedelta(days=days)
-
-    conn = get_db_connection()
-    # Abandon active games with no round activity since the cutoff
+@transactional
+def abandon_stale_games(conn, user_id, cutoff):
+    """Abandon active games with no round activity since the cutoff. Returns how many."""
     result = conn.execute('''
         UPDATE games
         SET status = 'abandoned'
@@ -848,32 +1082,27 @@ def bulk_abandon_old_games():
               WHERE created_date >= ?
           )
           AND created_date < ?
-    ''', (session['user_id'], cutoff, cutoff))
+    ''', (user_id, cutoff, cutoff))
+    return result.rowcount
 
-    abandoned_count = result.rowcount
-    conn.commit()
-    conn.close()
+@app.route('/games/bulk-abandon', methods=['POST'])
+@require_login
+def bulk_abandon_old_games():
+    days = int(request.form.get('days', 30))
+    cutoff = datetime.now() - timedelta(days=days)
+
+    abandoned_count = abandon_stale_games(session['user_id'], cutoff)
 
     flash('Abandoned {} stale game{} (no activity in {} days).'.format(
         abandoned_count, 's' if abandoned_count != 1 else '', days))
     return redirect(url_for('dashboard'))
 
 
-@app.route('/game/<int:game_id>/rematch', methods=['POST'])
-@require_login
-def rematch(game_id):
-    conn = get_db_connection()
-    original = conn.execute(
-        'SELECT * FROM games WHERE id = ? AND created_by_user_id = ?',
-        (game_id, session['user_id'])
-    ).fetchone()
-
-    if not original:
-        flash('Game not found')
-        conn.close()
-        return redirect(url_for('dashboard'))
-
-    share_code = str(secrets.randbelow(90000) + 10000)
+@transactional
+def copy_game(conn, user_id, game_id):
+    """New game with the same players and rules as one of the user's games. Returns its id."""
+    original = owned_game(conn, user_id, game_id)
+    share_code = generate_share_code(conn)
 
     cursor = conn.execute('''
         INSERT INTO games (
@@ -884,67 +1113,88 @@ def rematch(game_id):
             share_code
         ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     ''', (
-        session['user_id'],
+        user_id,
         original['team1_player1'], original['team1_player2'],
         original['team2_player1'], original['team2_player2'],
         original['max_score'], original['nil_penalty'], original['blind_nil_penalty'],
         original['bag_penalty_threshold'], original['bag_penalty_points'],
         original['failed_nil_handling'], share_code
     ))
+    sync_game(conn, cursor.lastrowid)
+    return cursor.lastrowid
 
-    new_game_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+@app.route('/game/<int:game_id>/rematch', methods=['POST'])
+@require_login
+def rematch(game_id):
+    new_game_id = copy_game(session['user_id'], game_id)
 
     flash('Rematch started — same players, same rules, fresh scores!')
     return redirect(url_for('game', game_id=new_game_id))
 
 
-@app.route('/game/<int:game_id>/edit', methods=['GET', 'POST'])
-@require_login
-def edit_game(game_id):
-    conn = get_db_connection()
-    
-    # Get game details
-    game = conn.execute('SELECT * FROM games WHERE id = ? AND created_by_user_id = ?', 
-                       (game_id, session['user_id'])).fetchone()
-    
-    if not game:
-        flash('Game not found')
-        conn.close()
-        return redirect(url_for('dashboard'))
-    
-    if request.method == 'POST':
-        team1_player1 = request.form['team1_player1']
-        team1_player2 = request.form['team1_player2']
-        team2_player1 = request.form['team2_player1']
-        team2_player2 = request.form['team2_player2']
-        max_score = int(request.form.get('max_score', 500))
-        nil_penalty = int(request.form.get('nil_penalty', 100))
-        blind_nil_penalty = int(request.form.get('blind_nil_penalty', 200))
-        bag_penalty_threshold = int(request.form.get('bag_penalty_threshold', 10))
-        bag_penalty_points = int(request.form.get('bag_penalty_points', 100))
-        
+@transactional
+def update_game_settings(conn, user_id, game_id, settings):
+    """Save edited players and rules, re-scoring the stored rounds if the rules changed"""
+    game = owned_game(conn, user_id, game_id)
+    with tracking(conn, game_id, whole_game=True):
         # Update game settings
         conn.execute('''
-            UPDATE games SET 
+            UPDATE games SET
                 team1_player1 = ?, team1_player2 = ?, team2_player1 = ?, team2_player2 = ?,
                 max_score = ?, nil_penalty = ?, blind_nil_penalty = ?, bag_penalty_threshold = ?,
                 bag_penalty_points = ?
             WHERE id = ?
-        ''', (team1_player1, team1_player2, team2_player1, team2_player2,
-              max_score, nil_penalty, blind_nil_penalty, bag_penalty_threshold,
-              bag_penalty_points, game_id))
-        
-        conn.commit()
-        conn.close()
-        
+        ''', (settings['team1_player1'], settings['team1_player2'], settings['team2_player1'], settings['team2_player2'],
+              settings['max_score'], settings['nil_penalty'], settings['blind_nil_penalty'],
+              settings['bag_penalty_threshold'], settings['bag_penalty_points'], game_id))
+
+        # Stored round scores depend on the rules, so rebuild them when those change
+        updated = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+        if any(updated[column] != game[column] for column in RULE_COLUMNS + ('max_score',)):
+            rescore_games(conn, [game_id])
+        sync_game(conn, game_id)
+
+@app.route('/game/<int:game_id>/edit', methods=['GET', 'POST'])
+@require_login
+def edit_game(game_id):
+    if request.method == 'POST':
+        update_game_settings(session['user_id'], game_id, game_settings(request.form))
+        game_changed(game_id, reload=True)
+
         flash('Game settings updated successfully!')
         return redirect(url_for('game', game_id=game_id))
-    
+
+    conn = get_db_connection()
+    game = owned_game(conn, session['user_id'], game_id)
     conn.close()
     return render_template('edit_game.html', game=game)
 
+@app.route('/internal/db-stats')
+@require_internal_token
+def db_stats():
+    """Database health for this worker process. ?format=prometheus for the text exposition format."""
+    conn = get_db_connection()
+    try:
+        stats = collect_db_stats(conn, db_pool)
+    finally:
+        conn.close()
+    if request.args.get('format') == 'prometheus':
+        return Response(db_stats_prometheus(stats), mimetype='text/plain; version=0.0.4')
+    return jsonify(stats)
+
+@app.route('/metrics')
+@require_internal_token
+def prometheus_metrics():
+    """Prometheus scrape endpoint: request metrics, database stats and render cache of this worker"""
+    conn = get_db_connection()
+    try:
+        stats = collect_db_stats(conn, db_pool)
+    finally:
+        conn.close()
+    body = (request_metrics_prometheus(request_metrics.snapshot()) + db_stats_prometheus(stats)
+            + render_cache_prometheus(spectator_cache.stats()))
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     # For local development only
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for scoring, recalculation and request throughput.
+
+Everything runs against a throwaway SQLite file. Results are written as JSON
+so runs can be compared, and --compare flags anything slower than the stored
+baseline by more than --tolerance:
+
+    python bench.py                     # run, write bench_results.json
+    python bench.py --save-baseline     # run and store as bench_baseline.json
+    python bench.py --compare           # run and exit 1 on regressions
+    python bench.py --quick             # fewer iterations, for a smoke run
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+RESULTS_FILE = 'bench_results.json'
+BASELINE_FILE = 'bench_baseline.json'
+RECALC_GAME_SIZES = (10, 50, 200)
+ROUND_LOG_GAME_SIZES = (50, 200)
+
+# Bids in the mix a real game sees: regular, blind, nil, blind nil and combinations
+BID_MIX = ('4', '5', '3', '6', '4b', '0n', '0bn', '4n', '3bn', '7')
+
+def use_temp_database():
+    """Point models (and app, if imported afterwards) at a fresh temp file"""
+    path = os.path.join(tempfile.mkdtemp(prefix='spades-bench-'), 'bench.db')
+    os.environ['SPADES_DATABASE'] = path
+    import models
+    models.configure_database(path)
+    models.init_db()
+    return path
+
+def measure(fn, number, repeat=5):
+    """Best and median time per call in microseconds"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number * 1e6)
+    samples.sort()
+    return {'us_per_op': round(samples[0], 3), 'median_us': round(samples[len(samples) // 2], 3)}
+
+def bench_scoring(quick):
+    from scoring import parse_bid, calculate_detailed_round_scoring
+    game = {'nil_penalty': 100, 'blind_nil_penalty': 200, 'bag_penalty_threshold': 10, 'bag_penalty_points': 100}
+    number = 2000 if quick else 20000
+
+    def parse_all():
+        for bid in BID_MIX:
+            parse_bid(bid)
+
+    def parse_all_uncached():
+        for bid in BID_MIX:
+            parse_bid.__wrapped__(bid)
+
+    def score_all():
+        for i, bid in enumerate(BID_MIX):
+            calculate_detailed_round_scoring(bid, i % 14, game, True, False, i % 2 == 0)
+
+    results = {}
+    for name, fn in (('parse_bid', parse_all), ('parse_bid_uncached', parse_all_uncached),
+                     ('calculate_detailed_round_scoring', score_all)):
+        timing = measure(fn, number // len(BID_MIX))
+        results[name] = {key: round(value / len(BID_MIX), 3) for key, value in timing.items()}
+    return results
+
+def make_game(conn, rounds, user_id=1):
+    """Game with `rounds` completed rounds, scored through the real engine"""
+    from recalculate import recalculate_from_round
+    game_id = conn.execute("""INSERT INTO games (created_by_user_id, team1_player1, team1_player2,
+                              team2_player1, team2_player2, max_score)
+                              VALUES (?, 'Al', 'Bo', 'Cy', 'Di', 100000)""", (user_id,)).lastrowid
+    conn.executemany('''INSERT INTO rounds (game_id, round_number, team1_bid, team2_bid, team1_actual, team2_actual,
+                                            team1_nil_success, team2_blind_success)
+                        VALUES (?, ?, ?, ?, ?, ?, 1, 1)''',
+                     [(game_id, n, BID_MIX[n % len(BID_MIX)], BID_MIX[(n * 3) % len(BID_MIX)], n % 14, 13 - n % 14)
+                      for n in range(1, rounds + 1)])
+    recalculate_from_round(conn, game_id, 1, converge=False)
+    conn.commit()
+    return game_id
+
+def bench_recalculate(quick):
+    """Edit round 2 of games of several lengths and recalculate from there"""
+    from models import get_db_connection
+    from recalculate import recalculate_from_round
+
+    results = {}
+    conn = get_db_connection()
+    for size in RECALC_GAME_SIZES:
+        game_id = make_game(conn, size)
+        round_id = conn.execute('SELECT id FROM rounds WHERE game_id = ? AND round_number = 2', (game_id,)).fetchone()[0]
+
+        def edit_and_recalculate():
+            conn.execute('UPDATE rounds SET team1_actual = 13 - team1_actual, team2_actual = 13 - team2_actual WHERE id = ?',
+                         (round_id,))
+            recalculate_from_round(conn, game_id, 2)
+            conn.commit()
+
+        def recalculate_unchanged():
+            recalculate_from_round(conn, game_id, 2)
+            conn.rollback()
+
+        number = max(3, (200 if quick else 2000) // size)
+        results['recalculate_from_round_{}'.format(size)] = measure(edit_and_recalculate, number)
+        results['recalculate_converged_{}'.format(size)] = measure(recalculate_unchanged, number)
+    conn.close()
+    return results
+
+def bench_round_storage(quick):
+    """Stored vs derived-on-read round columns: table size, WAL written by an
+    edit near the start of a 30-round game, and reading a game's rounds"""
+    import recalculate
+    from models import get_db_connection
+    from recalculate import game_rounds, recalculate_from_round
+
+    games = 50 if quick else 500
+    number = 20 if quick else 200
+    results = {}
+    saved = recalculate.DERIVED_ON_READ
+    try:
+        for mode in ('stored', 'derived'):
+            recalculate.DERIVED_ON_READ = mode == 'derived'
+            path = use_temp_database()
+            conn = get_db_connection()
+            game_ids = [make_game(conn, 30) for _ in range(games)]
+            kib = conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = 'rounds'").fetchone()[0] / 1024
+            game_id = game_ids[0]
+            round_id = conn.execute('SELECT id FROM rounds WHERE game_id = ? AND round_number = 2',
+                                    (game_id,)).fetchone()[0]
+
+            def edit_and_recalculate():
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('UPDATE rounds SET team1_actual = 13 - team1_actual, team2_actual = 13 - team2_actual '
+                             'WHERE id = ?', (round_id,))
+                recalculate_from_round(conn, game_id, 2)
+                conn.commit()
+
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            for _ in range(10):
+                edit_and_recalculate()
+            wal_kib = os.path.getsize(path + '-wal') / 10 / 1024
+            results['round_storage_{}_edit'.format(mode)] = dict(
+                measure(edit_and_recalculate, number), rounds_table_kib=round(kib), wal_kib_per_edit=round(wal_kib, 1))
+
+            game = conn.execute('SELECT * FROM games WHERE id = ?', (game_ids[1],)).fetchone()
+
+            def read_cold():
+                recalculate._rounds_cache.clear()
+                game_rounds(conn, game)
+
+            def read_warm():
+                game_rounds(conn, game)
+
+            results['round_storage_{}_read'.format(mode)] = measure(read_cold, number * 5)
+            results['round_storage_{}_read_cached'.format(mode)] = measure(read_warm, number * 5)
+            conn.close()
+    finally:
+        recalculate.DERIVED_ON_READ = saved
+    return results
+
+def bench_round_log(quick):
+    """Replaying long games from the round log, with and without snapshots, and undo"""
+    import round_log
+    from app import SUCCESS_FLAGS, save_bids, score_pending_round
+    from models import get_db_connection
+
+    def logged_game(rounds):
+        """Game played through the app's units: a bids and a scores event per round"""
+        game_id = make_game(conn, 0)
+        for n in range(rounds):
+            save_bids(1, game_id, BID_MIX[n % len(BID_MIX)], '4')
+            score_pending_round(1, game_id, n % 14, 13 - n % 14, flags)
+        return game_id
+
+    conn = get_db_connection()
+    flags = dict.fromkeys(SUCCESS_FLAGS, True)
+    number = 20 if quick else 200
+    results = {}
+    interval = round_log.SNAPSHOT_INTERVAL
+    for size in ROUND_LOG_GAME_SIZES[:1] if quick else ROUND_LOG_GAME_SIZES:
+        game_id = logged_game(size)
+        round_log.SNAPSHOT_INTERVAL = 10 ** 9
+        try:
+            unsnapshotted_id = logged_game(size)
+        finally:
+            round_log.SNAPSHOT_INTERVAL = interval
+        middle = size  # halfway through the log's 2 * size events
+
+        def undo_last():
+            conn.execute('BEGIN IMMEDIATE')
+            round_log.undo(conn, game_id)
+            conn.rollback()
+
+        results['round_log_replay_{}'.format(size)] = measure(lambda: round_log.replay(conn, game_id), number)
+        results['round_log_replay_no_snapshots_{}'.format(size)] = measure(
+            lambda: round_log.replay(conn, unsnapshotted_id), number)
+        results['round_log_replay_middle_{}'.format(size)] = measure(
+            lambda: round_log.replay(conn, game_id, middle), number)
+        results['round_log_undo_{}'.format(size)] = measure(undo_last, number)
+    conn.close()
+    return results
+
+def login(client, email):
+    from models import get_db_connection
+    client.post('/login', data={'email': email})
+    conn = get_db_connection()
+    code = conn.execute('''SELECT a.code FROM auth_codes a JOIN users u ON u.id = a.user_id
+                           WHERE u.email = ? ORDER BY a.id DESC LIMIT 1''', (email,)).fetchone()[0]
+    conn.close()
+    client.post('/verify', data={'code': code})
+
+def bench_requests(quick):
+    """Flask test-client throughput for the hot pages and the bid-then-score flow"""
+    from app import app
+    from models import get_db_connection
+
+    app.config['TESTING'] = True
+    client = app.test_client()
+    login(client, 'bench@example.com')
+
+    conn = get_db_connection()
+    user_id = conn.execute("SELECT id FROM users WHERE email = 'bench@example.com'").fetchone()[0]
+    for _ in range(10):
+        make_game(conn, 12, user_id)
+    game_id = make_game(conn, 20, user_id)
+    share_code = conn.execute('SELECT share_code FROM games WHERE id = ?', (game_id,)).fetchone()[0]
+    flow_game_id = make_game(conn, 0, user_id)
+    conn.close()
+
+    spectator = app.test_client()
+
+    def get(client, path):
+        def request():
+            response = client.get(path)
+            assert response.status_code == 200, '{} returned {}'.format(path, response.status_code)
+        return request
+
+    def bid_then_score():
+        response = client.post('/game/{}/round'.format(flow_game_id), data={'team1_bid': '4', 'team2_bid': '0n'})
+        assert response.status_code == 302
+        response = client.post('/game/{}/scores'.format(flow_game_id),
+                               data={'team1_actual': '6', 'team2_actual': '7', 'team2_nil_success': 'on'})
+        assert response.status_code == 302
+
+    number = 20 if quick else 200
+    results = {}
+    for name, fn in (('GET /dashboard', get(client, '/dashboard')),
+                     ('GET /game/<id>', get(client, '/game/{}'.format(game_id))),
+                     ('GET /view/<code>', get(spectator, '/view/{}'.format(share_code))),
+                     ('POST bid then score', bid_then_score)):
+        timing = measure(fn, number, repeat=3)
+        timing['requests_per_sec'] = round(1e6 / timing['us_per_op'], 1)
+        results[name] = timing
+    return results
+
+def bench_search(quick):
+    """/search queries over 100k games (10k with --quick), against a LIKE scan for scale"""
+    import random
+    from models import get_db_connection
+    from search import search_games
+
+    names = ('Alice', 'Bob', 'Carmen', 'Dev', 'Erin', 'Femi', 'Grace', 'Hiro', 'Ines', 'Jamal',
+             'Kai', 'Lena', 'Marco', 'Nia', 'Omar', 'Priya', 'Quinn', 'Rosa', 'Sam', 'Tess')
+    games = 10000 if quick else 100000
+    users = games // 1000
+    rng = random.Random(7)
+    rows = []
+    for n in range(games):
+        players = rng.sample(names, 4)
+        completed = rng.random() < 0.8
+        rows.append((n % users + 1, *players, 'completed' if completed else 'active',
+                     '{} & {}'.format(*players[:2]) if completed else None,
+                     '20{:02d}-{:02d}-{:02d} 20:00:00'.format(rng.randint(20, 25), rng.randint(1, 12), rng.randint(1, 28))))
+    conn = get_db_connection()
+    start = time.perf_counter()
+    conn.executemany('''INSERT INTO games (created_by_user_id, team1_player1, team1_player2, team2_player1,
+                                           team2_player2, status, winner, created_date)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+    conn.commit()
+    results = {'search_index_{}_games_us_per_game'.format(games):
+               {'us_per_op': round((time.perf_counter() - start) / games * 1e6, 3)}}
+
+    def query(text, page=1):
+        def run_query():
+            search_games(conn, 1, text, page)
+        return run_query
+
+    def like_scan():
+        conn.execute('''SELECT id FROM games WHERE created_by_user_id = 1 AND
+                        (team1_player1 LIKE ? OR team1_player2 LIKE ? OR team2_player1 LIKE ? OR team2_player2 LIKE ?)
+                        ORDER BY created_date DESC LIMIT 21''', ('ali%',) * 4).fetchall()
+
+    number = 20 if quick else 100
+    for name, fn in (('search_prefix', query('ali')),
+                     ('search_two_players', query('alice grace')),
+                     ('search_player_and_month', query('tess 2024-05')),
+                     ('search_page_5', query('alice', 5)),
+                     ('search_like_scan', like_scan)):
+        results['{}_{}_games'.format(name, games)] = measure(fn, number)
+    conn.close()
+    return results
+
+def run(quick=False):
+    database = use_temp_database()
+    results = {}
+    for section in (bench_scoring, bench_recalculate, bench_round_storage, bench_round_log, bench_requests,
+                    bench_search):
+        print("Running {}...".format(section.__name__))
+        results.update(section(quick))
+
+    return {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'quick': quick,
+            'database': database,
+        },
+        'results': results,
+    }
+
+def compare(current, baseline, tolerance):
+    """Names whose time per op grew by more than `tolerance` (0.25 = 25%)"""
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        before = baseline['results'].get(name)
+        if not before:
+            continue
+        ratio = result['us_per_op'] / before['us_per_op'] if before['us_per_op'] else 1.0
+        marker = 'REGRESSION' if ratio > 1 + tolerance else ''
+        print("  {:<40} {:>10.2f} us  {:>10.2f} us  {:>6.2f}x  {}".format(
+            name, before['us_per_op'], result['us_per_op'], ratio, marker))
+        if marker:
+            regressions.append(name)
+    return regressions
+
+def print_results(report):
+    for name, result in sorted(report['results'].items()):
+        extra = '  ({} req/s)'.format(result['requests_per_sec']) if 'requests_per_sec' in result else ''
+        print("  {:<40} {:>10.2f} us/op{}".format(name, result['us_per_op'], extra))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark scoring, recalculation and request throughput')
+    parser.add_argument('--quick', action='store_true', help='Fewer iterations')
+    parser.add_argument('--output', default=RESULTS_FILE, help='Where to write the results JSON')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline JSON to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='Also store these results as the baseline')
+    parser.add_argument('--compare', action='store_true', help='Exit 1 if anything regressed against the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown before flagging (default 0.25)')
+    args = parser.parse_args()
+
+    report = run(args.quick)
+    print_results(report)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to {}".format(args.output))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Baseline saved to {}".format(args.baseline))
+
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print("No baseline at {} - run with --save-baseline first".format(args.baseline))
+            sys.exit(1)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("\nAgainst {} ({}):".format(args.baseline, baseline['meta']['date']))
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("{} benchmark(s) regressed by more than {:.0%}".format(len(regressions), args.tolerance))
+            sys.exit(1)
+        print("No regressions")
@@ -0,0 +1,51 @@
+"""Shared pytest fixtures: a database of the test's own, and signed-in clients"""
+
+import pytest
+
+import models
+
+@pytest.fixture
+def database_path(tmp_path, monkeypatch):
+    """Point the app (and anything reading SPADES_DATABASE) at an empty file in
+    the test's temporary directory; both are put back after the test"""
+    path = str(tmp_path / 'spades.db')
+    monkeypatch.setenv('SPADES_DATABASE', path)
+    previous = models.DATABASE
+    models.configure_database(path)
+    yield path
+    models.configure_database(previous)
+
+@pytest.fixture
+def database(database_path):
+    """database_path with every migration applied"""
+    models.init_db()
+    return database_path
+
+@pytest.fixture
+def switch_database(database, tmp_path, monkeypatch):
+    """Call with a file name to move the rest of the test onto a second migrated
+    database beside the first; database_path puts the original back afterwards"""
+    def switch(name):
+        path = str(tmp_path / name)
+        monkeypatch.setenv('SPADES_DATABASE', path)
+        models.configure_database(path)
+        models.init_db()
+        return path
+
+    return switch
+
+@pytest.fixture
+def logged_in_client(database):
+    """Call with an email address for a test client signed in as that user"""
+    from app import app
+
+    def login(email='player@example.com'):
+        client = app.test_client()
+        client.post('/login', data={'email': email})
+        conn = models.get_db_connection()
+        code = conn.execute('SELECT code FROM auth_codes ORDER BY id DESC').fetchone()['code']
+        conn.close()
+        client.post('/verify', data={'code': code})
+        return client
+
+    return login
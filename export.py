@@ -0,0 +1,147 @@
+"""
+Streaming export of a scorekeeper's games and rounds.
+
+One query walks the user's games in id order (idx_games_user) with their
+rounds in round order (idx_rounds_game_round), so SQLite never sorts and
+nothing is materialised: rows come off the cursor EXPORT_BATCH at a time
+with fetchmany() and are written out as they arrive. Memory stays the same
+whether the user has ten games or ten thousand.
+
+CSV has one line per round (a game without rounds gets one line with empty
+round columns); NDJSON has one object per game with its rounds nested.
+Every stored scoring column is included: points, totals, bags, penalties,
+special-bid flags and the per-component breakdown. Either format can be
+gzipped on the fly. With derived-on-read round storage the scoring columns
+are replayed from the raw inputs as the rows stream past.
+
+    python export.py alice@example.com > alice.csv
+    python export.py alice@example.com --format ndjson --gzip > alice.ndjson.gz
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import zlib
+
+import recalculate
+from models import get_db_connection
+from recalculate import DERIVED_COLUMNS, score_round
+
+EXPORT_BATCH = 500
+
+GAME_COLUMNS = (
+    'id', 'status', 'team1_player1', 'team1_player2', 'team2_player1', 'team2_player2',
+    'max_score', 'nil_penalty', 'blind_nil_penalty', 'bag_penalty_threshold', 'bag_penalty_points',
+    'failed_nil_handling', 'team1_final_score', 'team2_final_score', 'team1_bags', 'team2_bags',
+    'winner', 'share_code', 'created_date', 'completed_date',
+)
+
+ROUND_COLUMNS = (
+    'round_number', 'team1_bid', 'team2_bid', 'team1_actual', 'team2_actual',
+    'team1_nil_success', 'team1_blind_nil_success', 'team1_blind_success',
+    'team2_nil_success', 'team2_blind_nil_success', 'team2_blind_success',
+) + DERIVED_COLUMNS + ('created_date',)
+
+EXPORT_SQL = '''
+    SELECT {games}, {rounds}
+    FROM games g LEFT JOIN rounds r ON r.game_id = g.id
+    WHERE g.created_by_user_id = ?
+    ORDER BY g.id, r.round_number
+'''.format(games=', '.join('g.' + column for column in GAME_COLUMNS),
+           rounds=', '.join('r.' + column for column in ROUND_COLUMNS))
+
+# CSV headings: game_* for the game, round_* for the round
+CSV_HEADER = (['game_' + column for column in GAME_COLUMNS] +
+              [column if column.startswith('round_') else 'round_' + column for column in ROUND_COLUMNS])
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+def export_rows(conn, user_id):
+    """Every (game, round) row of the user's history, EXPORT_BATCH rows per fetch"""
+    cursor = conn.execute(EXPORT_SQL, (user_id,))
+    rows = (row for batch in iter(lambda: cursor.fetchmany(EXPORT_BATCH), []) for row in batch)
+    return replayed(rows) if recalculate.DERIVED_ON_READ else rows
+
+def replayed(rows):
+    """Rows with the derived round columns worked out from the raw inputs, one
+    game at a time (derived-on-read storage keeps only checkpoints)"""
+    positions = [len(GAME_COLUMNS) + ROUND_COLUMNS.index(column) for column in DERIVED_COLUMNS]
+    game_id = None
+    for row in rows:
+        if row[0] != game_id:
+            game_id, state = row[0], (0, 0, 0, 0)
+        values = list(row)
+        if row['team1_actual'] is not None:
+            # The row has the game's rules and the round's inputs under their own names
+            derived, state = score_round(row, row, state)
+            for column, position in zip(DERIVED_COLUMNS, positions):
+                values[position] = derived[column]
+        yield values
+
+def csv_chunks(rows):
+    """The CSV text, a header and then one chunk per EXPORT_BATCH rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADER)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(tuple(row))
+        if count % EXPORT_BATCH == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def ndjson_chunks(rows):
+    """One JSON line per game, with its rounds in a list"""
+    split = len(GAME_COLUMNS)
+    game = None
+    for row in rows:
+        values = tuple(row)
+        if game is None or values[0] != game['id']:
+            if game is not None:
+                yield json.dumps(game) + '\n'
+            game = dict(zip(GAME_COLUMNS, values[:split]), rounds=[])
+        if values[split] is not None:
+            game['rounds'].append(dict(zip(ROUND_COLUMNS, values[split:])))
+    if game is not None:
+        yield json.dumps(game) + '\n'
+
+def gzip_chunks(chunks):
+    """gzip-compress a stream of text chunks as it goes"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def stream_export(user_id, fmt, compress=False):
+    """The user's export as a stream of chunks (bytes when compressed), on its own connection"""
+    conn = get_db_connection()
+    try:
+        chunks = (csv_chunks if fmt == 'csv' else ndjson_chunks)(export_rows(conn, user_id))
+        yield from (gzip_chunks(chunks) if compress else chunks)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a scorekeeper's games and rounds")
+    parser.add_argument('email', help='Email of the scorekeeper')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+    parser.add_argument('--gzip', action='store_true', help='Compress the output')
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    user = conn.execute('SELECT id FROM users WHERE email = ?', (args.email,)).fetchone()
+    conn.close()
+    if not user:
+        sys.exit("No user with email {}".format(args.email))
+
+    out = sys.stdout.buffer
+    for chunk in stream_export(user['id'], args.format, args.gzip):
+        out.write(chunk if args.gzip else chunk.encode('utf-8'))
+    out.flush()
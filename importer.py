@@ -0,0 +1,286 @@
+"""
+Bulk import of historical games.
+
+Takes the games of a paper or spreadsheet score sheet as CSV or JSON and
+stores them as if every round had been entered through the app. Only the
+raw inputs are read - player names, rules, and for each round the bids,
+tricks taken and nil/blind success flags - and each game is replayed
+through recalculate.score_round() in memory to get the points, running
+totals, bags, penalties, final scores and winner.
+
+The accepted layouts are the ones export.py writes, so an export can be
+imported elsewhere:
+
+- CSV with one line per round and game_*/round_* headings; consecutive
+  lines with the same game_id are one game, a line with no round_team1_bid
+  is a game without rounds.
+- JSON: a list of game objects, or NDJSON with one per line, each with
+  team1_player1 ... and a `rounds` list.
+
+A last round with bids but blank tricks is an active game's pending round:
+it is stored with its bids only, ready for the scores to be entered.
+
+Every game is validated on its own. A game with a bad bid, trick count or
+date is reported (with its line or position) and left out; the rest are
+inserted together by import_games() with executemany() in one transaction,
+along with their players, seats and statistics.
+
+    python importer.py alice@example.com history.csv
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+from datetime import datetime
+
+import players
+import stats
+from models import generate_share_code, transactional
+from recalculate import DERIVED_COLUMNS, score_round, stored_values
+from scoring import MAX_TRICKS, parse_bid
+
+SEAT_COLUMNS = ('team1_player1', 'team1_player2', 'team2_player1', 'team2_player2')
+
+# Game rules and their defaults, as on the new game form
+RULE_DEFAULTS = (
+    ('max_score', 500),
+    ('nil_penalty', 100),
+    ('blind_nil_penalty', 200),
+    ('bag_penalty_threshold', 10),
+    ('bag_penalty_points', 100),
+)
+
+FLAG_COLUMNS = ('team1_nil_success', 'team1_blind_nil_success', 'team1_blind_success',
+                'team2_nil_success', 'team2_blind_nil_success', 'team2_blind_success')
+
+GAME_INSERT_COLUMNS = (('id', 'created_by_user_id') + SEAT_COLUMNS + tuple(name for name, _ in RULE_DEFAULTS) +
+                       ('status', 'team1_final_score', 'team2_final_score', 'team1_bags', 'team2_bags',
+                        'winner', 'share_code', 'created_date', 'completed_date'))
+
+RAW_ROUND_COLUMNS = ('round_number', 'team1_bid', 'team2_bid', 'team1_actual', 'team2_actual') + FLAG_COLUMNS
+
+ROUND_INSERT_COLUMNS = ('game_id',) + RAW_ROUND_COLUMNS + DERIVED_COLUMNS
+
+INSERT_GAME_SQL = 'INSERT INTO games ({}) VALUES ({})'.format(
+    ', '.join(GAME_INSERT_COLUMNS), ', '.join('?' for _ in GAME_INSERT_COLUMNS))
+
+INSERT_ROUND_SQL = 'INSERT INTO rounds ({}) VALUES ({})'.format(
+    ', '.join(ROUND_INSERT_COLUMNS), ', '.join('?' for _ in ROUND_INSERT_COLUMNS))
+
+# A pending round is stored as the app stores one: bids only, the rest left to the column defaults
+INSERT_PENDING_ROUND_SQL = 'INSERT INTO rounds (game_id, round_number, team1_bid, team2_bid) VALUES (?, ?, ?, ?)'
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 'on')
+FALSE_VALUES = ('', '0', 'false', 'no', 'n', 'off', 'none')
+
+class InvalidGame(ValueError):
+    """A game in an import file that can't be stored as it is"""
+
+def flag_value(value):
+    if value is None or isinstance(value, bool):
+        return bool(value)
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise InvalidGame('{!r} is not yes or no'.format(value))
+
+def whole_number(value, what):
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        raise InvalidGame('{} must be a whole number, not {!r}'.format(what, value)) from None
+
+def blank(value):
+    return value is None or not str(value).strip()
+
+def checked_bid(value, what):
+    bid = ('' if value is None else str(value)).strip().lower()
+    try:
+        bid_value, _ = parse_bid(bid)
+    except ValueError:
+        raise InvalidGame('{} {!r} is not a bid like 4, 0n, 0bn, 5b or 3n'.format(what, value)) from None
+    if not 0 <= bid_value <= MAX_TRICKS:
+        raise InvalidGame('{} {!r} is more than {} tricks'.format(what, value, MAX_TRICKS))
+    return bid
+
+def checked_date(value, what):
+    """Stored form ('YYYY-MM-DD HH:MM:SS') of a date or date and time, or None if blank"""
+    text = str(value or '').strip()
+    if not text:
+        return None
+    try:
+        return datetime.fromisoformat(text).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise InvalidGame('{} {!r} is not a date like 2024-05-31 or 2024-05-31 20:15'.format(what, value)) from None
+
+def replay_game(record, rounds):
+    """Validate one game and score its rounds. Returns (game, scored_rounds) as dicts."""
+    if not isinstance(record, dict):
+        raise InvalidGame('not a JSON object')
+    game = {}
+    for column in SEAT_COLUMNS:
+        name = ' '.join(str(record.get(column) or '').split())
+        if not name:
+            raise InvalidGame('{} is missing'.format(column))
+        game[column] = name
+    for column, default in RULE_DEFAULTS:
+        value = record.get(column)
+        game[column] = default if value in (None, '') else whole_number(value, column)
+    if game['bag_penalty_threshold'] < 1:
+        raise InvalidGame('bag_penalty_threshold must be at least 1')
+    game['created_date'] = checked_date(record.get('created_date'), 'created_date')
+    game['completed_date'] = checked_date(record.get('completed_date'), 'completed_date')
+
+    scored = []
+    state = (0, 0, 0, 0)
+    for number, r in enumerate(rounds, 1):
+        what = 'round {}'.format(number)
+        if not isinstance(r, dict):
+            raise InvalidGame('{} is not a JSON object'.format(what))
+        if blank(r.get('team1_actual')) and blank(r.get('team2_actual')):
+            # Bids in, tricks not yet: the game's pending round
+            if number != len(rounds):
+                raise InvalidGame('{} has no tricks taken; only the last round can be waiting for them'.format(what))
+            scored.append(dict(dict.fromkeys(FLAG_COLUMNS), round_number=number, team1_actual=None, team2_actual=None,
+                               team1_bid=checked_bid(r.get('team1_bid'), what + ' team1_bid'),
+                               team2_bid=checked_bid(r.get('team2_bid'), what + ' team2_bid')))
+            continue
+        raw = {
+            'team1_bid': checked_bid(r.get('team1_bid'), what + ' team1_bid'),
+            'team2_bid': checked_bid(r.get('team2_bid'), what + ' team2_bid'),
+            'team1_actual': whole_number(r.get('team1_actual'), what + ' team1_actual'),
+            'team2_actual': whole_number(r.get('team2_actual'), what + ' team2_actual'),
+        }
+        if min(raw['team1_actual'], raw['team2_actual']) < 0 or raw['team1_actual'] + raw['team2_actual'] != MAX_TRICKS:
+            raise InvalidGame('{}: tricks taken must add up to {}'.format(what, MAX_TRICKS))
+        for flag in FLAG_COLUMNS:
+            try:
+                raw[flag] = flag_value(r.get(flag))
+            except InvalidGame as e:
+                raise InvalidGame('{} {}: {}'.format(what, flag, e)) from None
+        derived, state = score_round(game, raw, state)
+        scored.append(dict(raw, round_number=number, **derived))
+
+    team1_total, team2_total, game['team1_bags'], game['team2_bags'] = state
+    game['team1_final_score'], game['team2_final_score'] = team1_total, team2_total
+    if team1_total >= game['max_score'] or team2_total >= game['max_score']:
+        team = 'team1' if team1_total >= game['max_score'] else 'team2'
+        game['status'] = 'completed'
+        game['winner'] = '{} & {}'.format(game[team + '_player1'], game[team + '_player2'])
+    else:
+        status = str(record.get('status') or 'active').strip().lower()
+        game['status'] = status if status in ('active', 'abandoned') else 'active'
+        game['winner'] = game['completed_date'] = None
+    return game, scored
+
+def csv_records(text):
+    """(line, game record, rounds) for each game in an export-style CSV"""
+    reader = csv.DictReader(io.StringIO(text))
+    current = None
+    for row in reader:
+        values = {key.strip(): value for key, value in row.items() if key}
+        key = values.get('game_id')
+        if current is None or not key or key != current[1].get('id'):
+            if current is not None:
+                yield current[0], current[1], current[2]
+            record = {column[len('game_'):]: value for column, value in values.items() if column.startswith('game_')}
+            current = (reader.line_num, record, [])
+        if (values.get('round_team1_bid') or '').strip():
+            current[2].append({column[len('round_'):]: value for column, value in values.items()
+                               if column.startswith('round_')})
+    if current is not None:
+        yield current[0], current[1], current[2]
+
+def json_records(text):
+    """(position, game record, rounds) for a JSON list of games or NDJSON"""
+    stripped = text.strip()
+    if stripped.startswith('['):
+        games = json.loads(stripped)
+    else:
+        games = [json.loads(line) for line in stripped.splitlines() if line.strip()]
+    for position, record in enumerate(games, 1):
+        # replay_game() reports a record that isn't an object, as it does any other bad game
+        yield position, record, (record.get('rounds') if isinstance(record, dict) else None) or []
+
+def read_games(text, fmt):
+    """Validate and score every game in an import file.
+    Returns (games, errors): games as (game, rounds) pairs, errors as messages."""
+    games, errors = [], []
+    where = 'line' if fmt == 'csv' else 'game'
+    try:
+        for position, record, rounds in (csv_records(text) if fmt == 'csv' else json_records(text)):
+            try:
+                games.append(replay_game(record, rounds))
+            except InvalidGame as e:
+                errors.append('{} {}: {}'.format(where, position, e))
+    except (ValueError, csv.Error) as e:
+        errors.append('Could not read the file: {}'.format(e))
+    return games, errors
+
+def file_format(filename):
+    """'csv' or 'json' from an upload's name (NDJSON counts as JSON)"""
+    return 'json' if filename.lower().endswith(('.json', '.ndjson', '.jsonl')) else 'csv'
+
+def new_share_codes(conn, count):
+    """`count` 5-digit share codes unused by any game or each other"""
+    codes = set()
+    while len(codes) < count:
+        codes.add(generate_share_code(conn))
+    return list(codes)
+
+@transactional
+def import_games(conn, user_id, games):
+    """Insert validated games (from read_games) for a user. Returns (games, rounds) inserted."""
+    if not games:
+        return 0, 0
+    # BEGIN IMMEDIATE holds the write lock, so the ids after MAX(id) stay free
+    first_id = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM games').fetchone()[0]
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    game_rows, round_rows, pending_rows, totals = [], [], [], {}
+    for game_id, share_code, (game, rounds) in zip(range(first_id, first_id + len(games)),
+                                                    new_share_codes(conn, len(games)), games):
+        created = game['created_date'] or now
+        completed = (game['completed_date'] or created) if game['status'] == 'completed' else None
+        game = dict(game, id=game_id, created_by_user_id=user_id, share_code=share_code,
+                    created_date=created, completed_date=completed)
+        game_rows.append(tuple(game[column] for column in GAME_INSERT_COLUMNS))
+        scored_rounds = [r for r in rounds if r['team1_actual'] is not None]
+        round_rows.extend((game_id,) + tuple(r[column] for column in RAW_ROUND_COLUMNS) +
+                          stored_values(r['round_number'], tuple(r[column] for column in DERIVED_COLUMNS))
+                          for r in scored_rounds)
+        pending_rows.extend((game_id, r['round_number'], r['team1_bid'], r['team2_bid'])
+                            for r in rounds if r['team1_actual'] is None)
+        for key, values in stats.contribution(game, scored_rounds).items():
+            stats.add_into(totals, key, values)
+
+    conn.executemany(INSERT_GAME_SQL, game_rows)
+    conn.executemany(INSERT_ROUND_SQL, round_rows)
+    conn.executemany(INSERT_PENDING_ROUND_SQL, pending_rows)
+    for game_id in range(first_id, first_id + len(games)):
+        players.sync_game(conn, game_id)
+    stats.apply_delta(conn, user_id, {}, totals)
+    return len(game_rows), len(round_rows) + len(pending_rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import historical games for a scorekeeper')
+    parser.add_argument('email', help='Email of the scorekeeper')
+    parser.add_argument('file', help='CSV, JSON or NDJSON file of games')
+    parser.add_argument('--format', choices=('csv', 'json'), help='Default: from the file name')
+    args = parser.parse_args()
+
+    from models import get_db_connection
+    conn = get_db_connection()
+    user = conn.execute('SELECT id FROM users WHERE email = ?', (args.email,)).fetchone()
+    conn.close()
+    if not user:
+        sys.exit("No user with email {}".format(args.email))
+
+    with open(args.file, encoding='utf-8-sig') as f:
+        games, errors = read_games(f.read(), args.format or file_format(args.file))
+    for error in errors:
+        print("Skipped {}".format(error))
+    imported_games, imported_rounds = import_games(user['id'], games)
+    print("Imported {} games ({} rounds), skipped {}".format(imported_games, imported_rounds, len(errors)))
@@ -0,0 +1,138 @@
+"""
+Live spectator updates.
+
+Write routes publish a compact delta for the game they changed; every
+Server-Sent Events stream watching that game in this process is woken up and
+forwards it. Writes made by other worker processes are picked up by a single
+watcher thread that polls the version of the watched games.
+"""
+import threading
+import time
+from collections import Counter, deque
+
+class GameEventBroker:
+    """Fan-out of per-game updates to the SSE streams of this process"""
+
+    def __init__(self, history=64, poll_interval=2.0):
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._events = deque(maxlen=history)  # (seq, game_id, payload)
+        self._watched = Counter()             # game_id -> open streams
+        self._versions = {}                   # game_id -> last version seen
+        self._watcher = None
+        self._fetch_versions = None
+        self._on_external_change = None
+
+    def is_watched(self, game_id):
+        with self._cond:
+            return self._watched[game_id] > 0
+
+    def publish(self, game_id, payload):
+        """Queue an update for every stream watching game_id"""
+        with self._cond:
+            if not self._watched[game_id]:
+                return
+            if 'version' in payload:
+                self._versions[game_id] = payload['version']
+            self._seq += 1
+            self._events.append((self._seq, game_id, payload))
+            self._cond.notify_all()
+
+    def subscribe(self, game_id, version):
+        """Register a stream for game_id. Returns the sequence number to listen from."""
+        with self._cond:
+            self._watched[game_id] += 1
+            self._versions.setdefault(game_id, version)
+            seq = self._seq
+        self._ensure_watcher()
+        return seq
+
+    def unsubscribe(self, game_id):
+        with self._cond:
+            self._watched[game_id] -= 1
+            if self._watched[game_id] <= 0:
+                del self._watched[game_id]
+                self._versions.pop(game_id, None)
+
+    def wait(self, game_id, since, timeout):
+        """Block until there are updates for game_id newer than `since`.
+
+        Returns (seq, payloads, missed). `missed` is True when updates after
+        `since` already fell out of the history buffer, so the caller should
+        send a full resync instead.
+        """
+        def pending():
+            return any(seq > since and gid == game_id for seq, gid, _ in self._events)
+
+        with self._cond:
+            self._cond.wait_for(pending, timeout)
+            missed = bool(self._events) and self._events[0][0] > since + 1
+            payloads = [p for seq, gid, p in self._events if seq > since and gid == game_id]
+            return self._seq, payloads, missed
+
+    def listen(self, game_id, version, duration=300.0, keepalive=15.0):
+        """Yield updates for game_id for up to `duration` seconds.
+
+        Yields a list of payloads, the string 'resync' when updates were
+        missed, or None when `keepalive` seconds passed without any update.
+        """
+        since = self.subscribe(game_id, version)
+        deadline = time.monotonic() + duration
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                since, payloads, missed = self.wait(game_id, since, min(keepalive, remaining))
+                if missed:
+                    yield 'resync'
+                elif payloads:
+                    yield payloads
+                else:
+                    yield None
+        finally:
+            self.unsubscribe(game_id)
+
+    def start_watcher(self, fetch_versions, on_external_change):
+        """Notice writes made by other worker processes.
+
+        fetch_versions(game_ids) -> {game_id: version} is polled every
+        poll_interval seconds while any stream is open. on_external_change(game_id)
+        is called when a version moved without a local publish(); it is
+        expected to publish a full resync payload.
+        """
+        self._fetch_versions = fetch_versions
+        self._on_external_change = on_external_change
+
+    def _ensure_watcher(self):
+        with self._cond:
+            if self._fetch_versions is None or self._watcher is not None:
+                return
+            self._watcher = threading.Thread(target=self._watch, name='spectator-watcher', daemon=True)
+            self._watcher.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._cond:
+                game_ids = list(self._watched)
+                if not game_ids:
+                    self._watcher = None
+                    return
+            try:
+                current = self._fetch_versions(game_ids)
+            except Exception as e:
+                print("Spectator watcher error: {}".format(e))
+                continue
+            for game_id, version in current.items():
+                with self._cond:
+                    changed = self._versions.get(game_id, version) != version
+                    self._versions[game_id] = version
+                if changed:
+                    try:
+                        self._on_external_change(game_id)
+                    except Exception as e:
+                        print("Spectator watcher error for game {}: {}".format(game_id, e))
+
+spectator_events = GameEventBroker()
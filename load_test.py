@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+In-process load driver.
+
+Each worker thread logs in as a seeded user with its own Flask test client
+and replays a realistic mix of traffic: logins, dashboard loads, game pages,
+bid and score entry, and spectator polling with conditional requests.
+Reports latency percentiles per action and the rate of "database is locked"
+failures.
+
+    python load_test.py --threads 8 --duration 30
+    python load_test.py --database /tmp/load.db --threads 16 --json load.json
+
+Without --database a temporary database is filled with seed_data first.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import models
+import seed_data
+
+# Relative frequency of each action in the replayed traffic
+ACTION_WEIGHTS = {
+    'login': 3,
+    'dashboard': 25,
+    'game': 15,
+    'bid_and_score': 20,
+    'spectate': 30,
+    'spectate_json': 7,
+}
+
+class LockedError(Exception):
+    pass
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+class Worker(threading.Thread):
+    """One simulated user replaying weighted actions until the deadline"""
+
+    def __init__(self, app, email, deadline, results, seed):
+        super().__init__(daemon=True)
+        self.app = app
+        self.email = email
+        self.deadline = deadline
+        self.results = results
+        self.rng = random.Random(seed)
+        self.client = app.test_client()
+        self.spectator = app.test_client()
+        self.etags = {}
+        self.game_ids = []
+        self.share_codes = []
+        self.play_game_id = None
+
+    def check(self, response, expected=(200, 302, 304)):
+        if response.status_code == 503:
+            raise LockedError('database busy after retries')
+        if response.status_code not in expected:
+            raise AssertionError('HTTP {}'.format(response.status_code))
+        if b'temporarily busy' in response.data:
+            raise LockedError('database is locked')
+        return response
+
+    def login(self):
+        self.check(self.client.post('/login', data={'email': self.email}))
+        conn = models.get_db_connection()
+        try:
+            code = conn.execute('''SELECT a.code FROM auth_codes a JOIN users u ON u.id = a.user_id
+                                   WHERE u.email = ? ORDER BY a.id DESC LIMIT 1''', (self.email,)).fetchone()
+        finally:
+            conn.close()
+        if code is None:
+            raise AssertionError('No auth code for {}'.format(self.email))
+        self.check(self.client.post('/verify', data={'code': code[0]}))
+
+    def setup(self):
+        self.login()
+        conn = models.get_db_connection()
+        try:
+            rows = conn.execute('''SELECT g.id, g.share_code FROM games g JOIN users u ON u.id = g.created_by_user_id
+                                   WHERE u.email = ?''', (self.email,)).fetchall()
+        finally:
+            conn.close()
+        self.game_ids = [row['id'] for row in rows]
+        self.share_codes = [row['share_code'] for row in rows if row['share_code']]
+
+        # A long game of our own to enter bids and scores into
+        response = self.check(self.client.post('/new-game', data={
+            'team1_player1': 'Ann', 'team1_player2': 'Ben', 'team2_player1': 'Cal', 'team2_player2': 'Dee',
+            'max_score': '1000000'}))
+        self.play_game_id = int(response.location.rstrip('/').rsplit('/', 1)[1])
+        self.game_ids.append(self.play_game_id)
+
+    def action_login(self):
+        self.login()
+
+    def action_dashboard(self):
+        self.check(self.client.get('/dashboard'), (200,))
+
+    def action_game(self):
+        self.check(self.client.get('/game/{}'.format(self.rng.choice(self.game_ids))), (200,))
+
+    def action_bid_and_score(self):
+        team1_bid = self.rng.choice(('3', '4', '5', '6', '4n', '5b'))
+        team2_bid = self.rng.choice(('3', '4', '5', '0n', '6'))
+        self.check(self.client.post('/game/{}/round'.format(self.play_game_id),
+                                    data={'team1_bid': team1_bid, 'team2_bid': team2_bid}), (302,))
+        team1_actual = self.rng.randint(0, 13)
+        self.check(self.client.post('/game/{}/scores'.format(self.play_game_id), data={
+            'team1_actual': str(team1_actual), 'team2_actual': str(13 - team1_actual),
+            'team1_nil_success': 'on', 'team1_blind_success': 'on', 'team2_nil_success': 'on'}), (302,))
+
+    def spectate(self, suffix):
+        if not self.share_codes:
+            return
+        path = '/view/{}{}'.format(self.rng.choice(self.share_codes), suffix)
+        headers = {'If-None-Match': self.etags[path]} if path in self.etags else {}
+        response = self.check(self.spectator.get(path, headers=headers), (200, 304))
+        if response.headers.get('ETag'):
+            self.etags[path] = response.headers['ETag']
+
+    def action_spectate(self):
+        self.spectate('')
+
+    def action_spectate_json(self):
+        self.spectate('/json')
+
+    def timed(self, name, fn):
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            fn()
+        except LockedError:
+            outcome = 'locked'
+        except Exception as e:
+            outcome = 'locked' if 'database is locked' in str(e) else 'error'
+            if outcome == 'error':
+                self.results['error_samples'].append('{}: {}'.format(name, e))
+        self.results['samples'].append((name, time.perf_counter() - start, outcome))
+
+    def run(self):
+        self.timed('setup', self.setup)
+        if self.play_game_id is None:
+            return
+        names = list(ACTION_WEIGHTS)
+        weights = [ACTION_WEIGHTS[name] for name in names]
+        while time.monotonic() < self.deadline:
+            name = self.rng.choices(names, weights)[0]
+            self.timed(name, getattr(self, 'action_' + name))
+
+def summarize(samples, elapsed):
+    by_action = defaultdict(list)
+    outcomes = defaultdict(lambda: defaultdict(int))
+    for name, seconds, outcome in samples:
+        by_action[name].append(seconds * 1000)
+        outcomes[name][outcome] += 1
+
+    report = {'elapsed_s': round(elapsed, 2), 'actions': {}}
+    for name, latencies in sorted(by_action.items()):
+        latencies.sort()
+        report['actions'][name] = {
+            'count': len(latencies),
+            'ok': outcomes[name]['ok'],
+            'locked': outcomes[name]['locked'],
+            'errors': outcomes[name]['error'],
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p90_ms': round(percentile(latencies, 90), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'max_ms': round(latencies[-1], 2),
+        }
+    total = len(samples)
+    locked = sum(o['locked'] for o in outcomes.values())
+    errors = sum(o['error'] for o in outcomes.values())
+    report.update(requests=total, throughput_per_s=round(total / elapsed, 1) if elapsed else 0.0,
+                  locked=locked, locked_rate=round(locked / total, 4) if total else 0.0,
+                  errors=errors, error_rate=round(errors / total, 4) if total else 0.0)
+    return report
+
+def print_report(report):
+    print("{:<16} {:>7} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+        'action', 'count', 'locked', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for name, stats in report['actions'].items():
+        print("{:<16} {count:>7} {locked:>7} {errors:>7} {p50_ms:>9.1f} {p90_ms:>9.1f} {p99_ms:>9.1f} {max_ms:>9.1f}".format(
+            name, **stats))
+    print("\n{requests} actions in {elapsed_s}s ({throughput_per_s}/s); "
+          "database is locked: {locked} ({locked_rate:.2%}); other errors: {errors}".format(**report))
+
+def run(threads=8, duration=10.0, database=None, users=None, games_per_user=10, seed=1):
+    if database is None:
+        database = os.path.join(tempfile.mkdtemp(prefix='spades-load-'), 'load.db')
+    os.environ['SPADES_DATABASE'] = database
+    models.configure_database(database)
+    models.init_db()
+
+    conn = models.get_db_connection()
+    if conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] < threads:
+        counts = seed_data.generate(conn, users or threads * 2, games_per_user, seed)
+        print("Seeded {users} users, {games} games, {rounds} rounds".format(**counts))
+    emails = [row[0] for row in conn.execute('SELECT email FROM users ORDER BY id LIMIT ?', (threads,))]
+    conn.close()
+
+    from app import app
+    app.config['TESTING'] = True
+
+    results = {'samples': [], 'error_samples': []}
+    start = time.monotonic()
+    workers = [Worker(app, email, start + duration, results, seed + i) for i, email in enumerate(emails)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - start
+
+    report = summarize([s for s in results['samples'] if s[0] != 'setup'], elapsed)
+    report.update(threads=len(workers), database=database, sqlite=sqlite3.sqlite_version,
+                  error_samples=results['error_samples'][:10])
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay realistic traffic against the app in-process')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run')
+    parser.add_argument('--database', help='Existing database to load (default: fresh seeded temp file)')
+    parser.add_argument('--users', type=int, help='Users to seed when the database is empty (default: 2 per thread)')
+    parser.add_argument('--games', type=int, default=10, help='Games per seeded user')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='Also write the report to this file')
+    args = parser.parse_args()
+
+    report = run(args.threads, args.duration, args.database, args.users, args.games, args.seed)
+    print_report(report)
+    for sample in report['error_samples']:
+        print("  error: {}".format(sample))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
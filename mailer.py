@@ -0,0 +1,241 @@
+"""
+Background delivery of outbound email.
+
+Requests only insert a message into the email_outbox table and wake the
+delivery thread of their process, which posts due messages to SMTP2GO over
+one pooled requests.Session with connect/read timeouts. Failed sends are
+retried with exponential backoff; after max_attempts (or on an error that
+retrying can't fix) the message is marked 'dead' and left in the outbox.
+
+A claimed message is leased for LEASE_SECONDS, so mail claimed by a process
+that died mid-send is picked up again by whichever process polls next. The
+lease is renewed just before each message of a batch is sent, and only
+while it is still the one this process took, so a slow batch can't let
+another process send the same message; the outcome is written the same way.
+"""
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from models import get_db_connection, transactional
+
+SMTP2GO_URL = 'https://api.smtp2go.com/v3/email/send'
+SENDER = 'matt@mattortiz.net'
+LEASE_SECONDS = 120
+
+class PermanentError(Exception):
+    """The mail API rejected the message; sending it again won't help"""
+
+def insert_message(conn, recipient, subject, text_body, html_body):
+    return conn.execute('''
+        INSERT INTO email_outbox (recipient, subject, text_body, html_body, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (recipient, subject, text_body, html_body, datetime.now())).lastrowid
+
+store_message = transactional(insert_message)
+
+class Mailer:
+    """Outbox writer plus the per-process delivery thread"""
+
+    def __init__(self, api_url=None, api_key=None, sender=SENDER, timeout=(3.05, 10),
+                 max_attempts=6, base_delay=5.0, max_delay=900.0, poll_interval=30.0, batch_size=20):
+        self.api_url = api_url or os.environ.get('SMTP2GO_API_URL', SMTP2GO_URL)
+        self.api_key = api_key if api_key is not None else os.environ.get('SMTP2GO_API_KEY')
+        self.sender = sender
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._session = None
+        self._counters = {'queued': 0, 'sent': 0, 'retried': 0, 'dead': 0}
+
+    def session(self):
+        """The shared HTTP session, with keep-alive connections to the mail API"""
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session = session
+        return self._session
+
+    def enqueue(self, recipient, subject, text_body, html_body=None, conn=None):
+        """Store a message for delivery. With `conn` the insert joins the caller's
+        transaction and the caller calls wake() after committing."""
+        if conn is not None:
+            message_id = insert_message(conn, recipient, subject, text_body, html_body)
+        else:
+            message_id = store_message(recipient, subject, text_body, html_body)
+        self._count('queued')
+        if conn is None:
+            self.wake()
+        return message_id
+
+    def wake(self):
+        """Have the delivery thread look at the outbox now"""
+        self.start()
+        self._wake.set()
+
+    def start(self):
+        """Start this process's delivery thread if it isn't running"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked child inherits neither the thread nor usable sockets
+                self._thread = None
+                self._session = None
+                self._pid = os.getpid()
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='email-outbox', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        self._stop.set()
+        self._wake.set()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                handled = self.process_due()
+            except Exception as e:
+                print("Email outbox error: {}".format(e))
+                handled = 0
+            if handled < self.batch_size:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def claim_due(self, limit=None):
+        """Lease up to `limit` messages that are due (or whose lease ran out).
+        Each row's next_attempt_at is the lease it now holds."""
+        now = datetime.now()
+        conn = get_db_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute('''
+                SELECT * FROM email_outbox
+                WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+                ORDER BY next_attempt_at LIMIT ?
+            ''', (now, limit or self.batch_size)).fetchall()
+            lease = now + timedelta(seconds=LEASE_SECONDS)
+            conn.executemany("UPDATE email_outbox SET status = 'sending', next_attempt_at = ? WHERE id = ?",
+                             [(lease, row['id']) for row in rows])
+            conn.commit()
+        finally:
+            conn.close()
+        return [dict(row, status='sending', next_attempt_at=lease) for row in rows]
+
+    def renew_lease(self, message):
+        """Extend the lease on a claimed message if this process still holds it.
+        Returns the new lease, or None if it ran out and another process took it."""
+        lease = datetime.now() + timedelta(seconds=LEASE_SECONDS)
+        conn = get_db_connection()
+        try:
+            renewed = conn.execute('''
+                UPDATE email_outbox SET next_attempt_at = ?
+                WHERE id = ? AND status = 'sending' AND next_attempt_at = ?
+            ''', (lease, message['id'], message['next_attempt_at'])).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        return lease if renewed else None
+
+    def deliver(self, message):
+        """POST one message to the mail API. Raises PermanentError for rejections
+        that retrying won't fix and any other exception for ones it might."""
+        payload = {
+            'api_key': self.api_key,
+            'to': [message['recipient']],
+            'sender': self.sender,
+            'subject': message['subject'],
+            'text_body': message['text_body'],
+        }
+        if message['html_body']:
+            payload['html_body'] = message['html_body']
+
+        response = self.session().post(self.api_url, json=payload, timeout=self.timeout)
+        if response.status_code == 200:
+            return
+        error = 'HTTP {}: {}'.format(response.status_code, response.text[:200])
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            raise PermanentError(error)
+        raise Exception(error)
+
+    def retry_delay(self, attempts):
+        """Exponential backoff with jitter, capped at max_delay"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def process_due(self):
+        """Deliver every due message once. Returns how many were attempted."""
+        messages = self.claim_due()
+        if not messages:
+            return 0
+
+        # No database connection is held while talking to the mail API
+        for message in messages:
+            lease = self.renew_lease(message)
+            if lease is None:
+                continue
+            attempts = message['attempts'] + 1
+            try:
+                self.deliver(message)
+                outcome = ("status = 'sent', attempts = ?, sent_date = ?, last_error = NULL",
+                           (attempts, datetime.now()))
+                self._count('sent')
+            except Exception as e:
+                dead = isinstance(e, PermanentError) or attempts >= self.max_attempts
+                if dead:
+                    outcome = ("status = 'dead', attempts = ?, last_error = ?", (attempts, str(e)))
+                    self._count('dead')
+                    print("Giving up on email {} to {} after {} attempt(s): {}".format(
+                        message['id'], message['recipient'], attempts, e))
+                else:
+                    retry_at = datetime.now() + timedelta(seconds=self.retry_delay(attempts))
+                    outcome = ("status = 'pending', attempts = ?, last_error = ?, next_attempt_at = ?",
+                               (attempts, str(e), retry_at))
+                    self._count('retried')
+            self.record_outcome(message, lease, *outcome)
+        return len(messages)
+
+    def record_outcome(self, message, lease, assignments, values):
+        """Write how a send went, unless the lease was lost while sending"""
+        conn = get_db_connection()
+        try:
+            written = conn.execute('''
+                UPDATE email_outbox SET {} WHERE id = ? AND status = 'sending' AND next_attempt_at = ?
+            '''.format(assignments), values + (message['id'], lease)).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        if not written:
+            print("Lease on email {} ran out while it was being sent".format(message['id']))
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        counters['running'] = self._thread is not None and self._thread.is_alive()
+        return counters
+
+mailer = Mailer()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Scheduled database maintenance.
+
+Each pass deletes expired auth codes and old delivered email in small
+batches, reclaims free pages with an incremental vacuum, runs PRAGMA
+optimize and then checkpoints and truncates the WAL once it has grown past
+a threshold.
+
+Every gunicorn worker starts a janitor thread (on its first request, since
+a worker forked from a --preload master doesn't inherit the master's
+thread), but only the one holding the
+'janitor' lease in maintenance_leases does any work; if it dies the lease
+expires and another worker takes over. It can also run on its own:
+
+    python maintenance.py               # run a pass every --interval seconds
+    python maintenance.py --once        # one pass, then exit
+    python maintenance.py --enable-incremental-vacuum   # one-off, rewrites the file
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+import models
+from models import get_db_connection
+
+LEASE_NAME = 'janitor'
+
+class Janitor:
+    """Periodic maintenance passes, run by whichever process holds the lease"""
+
+    def __init__(self, interval=300.0, batch_size=500, wal_threshold=16 * 1024 * 1024,
+                 vacuum_threshold=256, vacuum_pages=1000, sent_email_days=7, name=None):
+        self.name = name
+        self.interval = interval
+        self.batch_size = batch_size
+        self.wal_threshold = wal_threshold
+        self.vacuum_threshold = vacuum_threshold
+        self.vacuum_pages = vacuum_pages
+        self.sent_email_days = sent_email_days
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    @property
+    def holder(self):
+        """Lease holder id; host and pid unless a name was given"""
+        return self.name or '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def acquire_lease(self, conn):
+        """Take or renew the lease for this process. Returns True if we hold it."""
+        now = datetime.now()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('INSERT OR IGNORE INTO maintenance_leases (name, holder, expires_at) VALUES (?, ?, ?)',
+                         (LEASE_NAME, self.holder, now))
+            # Three missed passes before another process takes over
+            taken = conn.execute('''
+                UPDATE maintenance_leases SET holder = ?, expires_at = ?
+                WHERE name = ? AND (holder = ? OR expires_at <= ?)
+            ''', (self.holder, now + timedelta(seconds=self.interval * 3), LEASE_NAME, self.holder, now)).rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return taken == 1
+
+    def delete_in_batches(self, conn, table, where, params):
+        """DELETE matching rows batch_size at a time, committing between batches
+        so each write lock is held only briefly"""
+        deleted = 0
+        while True:
+            count = conn.execute('DELETE FROM {0} WHERE id IN (SELECT id FROM {0} WHERE {1} LIMIT ?)'.format(
+                table, where), params + (self.batch_size,)).rowcount
+            conn.commit()
+            deleted += count
+            if count < self.batch_size:
+                return deleted
+
+    def checkpoint_wal(self, conn):
+        """Fold the WAL back into the database and truncate it once it is over the threshold"""
+        wal_file = models.DATABASE + '-wal'
+        size = os.path.getsize(wal_file) if os.path.exists(wal_file) else 0
+        if size <= self.wal_threshold:
+            return None
+        busy, log_frames, checkpointed = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        return {'wal_bytes': size, 'busy': bool(busy), 'frames': log_frames, 'checkpointed': checkpointed}
+
+    def incremental_vacuum(self, conn):
+        """Release up to vacuum_pages free pages when auto_vacuum is INCREMENTAL"""
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return 0
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if free < self.vacuum_threshold:
+            return 0
+        conn.execute('PRAGMA incremental_vacuum({})'.format(int(self.vacuum_pages))).fetchall()
+        return free - conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+    def run_once(self, force=False):
+        """One maintenance pass. Returns what it did, or None if another process holds the lease."""
+        conn = get_db_connection()
+        try:
+            if not force and not self.acquire_lease(conn):
+                return None
+            start = time.perf_counter()
+            now = datetime.now()
+            # Codes expire after 15 minutes; keep a day of them for support questions
+            report = {
+                'expired_codes': self.delete_in_batches(conn, 'auth_codes', 'expires_at < ?',
+                                                        (now - timedelta(hours=24),)),
+                'sent_emails': self.delete_in_batches(conn, 'email_outbox', "status = 'sent' AND sent_date < ?",
+                                                      (now - timedelta(days=self.sent_email_days),)),
+                'vacuumed_pages': self.incremental_vacuum(conn),
+            }
+            conn.execute('PRAGMA optimize')
+            # Last, so it also folds in what the steps above wrote
+            report['checkpoint'] = self.checkpoint_wal(conn)
+            report['seconds'] = round(time.perf_counter() - start, 3)
+        finally:
+            conn.close()
+        log_report(report)
+        return report
+
+    def start(self):
+        """Start this process's janitor thread if it isn't running. Cheap when it
+        is, so it can be called on every request."""
+        thread = self._thread
+        if self._pid == os.getpid() and thread is not None and thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked child inherits the parent's Thread object but not the thread
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='janitor', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        self._stop.set()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        # Don't pile onto the database while the workers are still starting up
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print("Maintenance error: {}".format(e))
+
+def log_report(report):
+    checkpoint = report['checkpoint']
+    if checkpoint:
+        wal = 'checkpointed {}/{} WAL frames ({} bytes{})'.format(
+            checkpoint['checkpointed'], checkpoint['frames'], checkpoint['wal_bytes'],
+            ', busy' if checkpoint['busy'] else '')
+    else:
+        wal = 'WAL under threshold'
+    print("Maintenance: deleted {} expired codes and {} sent emails, {}, vacuumed {} pages in {}s".format(
+        report['expired_codes'], report['sent_emails'], wal, report['vacuumed_pages'], report['seconds']))
+
+def enable_incremental_vacuum():
+    """Switch an existing database to auto_vacuum=INCREMENTAL. VACUUM rewrites the
+    whole file and needs exclusive access, so run it while the app is stopped."""
+    conn = get_db_connection()
+    try:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    finally:
+        conn.close()
+
+janitor = Janitor()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run database maintenance')
+    parser.add_argument('--once', action='store_true', help='Run a single pass and exit')
+    parser.add_argument('--interval', type=float, default=300.0, help='Seconds between passes (default 300)')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='Convert the database to auto_vacuum=INCREMENTAL (stop the app first)')
+    args = parser.parse_args()
+
+    models.init_db()
+    if args.enable_incremental_vacuum:
+        print("auto_vacuum is INCREMENTAL" if enable_incremental_vacuum() else "Could not enable incremental vacuum")
+    elif args.once:
+        Janitor().run_once(force=True)
+    else:
+        daemon = Janitor(interval=args.interval)
+        while True:
+            if daemon.run_once() is None:
+                print("Maintenance: another process holds the lease")
+            time.sleep(args.interval)
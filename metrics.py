@@ -0,0 +1,303 @@
+"""
+In-process metrics and the Prometheus text format.
+
+Counters and histograms are plain Python numbers behind a lock, so
+recording costs a bisect and a few additions; everything is per worker
+process and reported with a pid label.
+
+Request latency is recorded by the before/after_request hooks in app.py,
+and SQL statements are counted by models.PooledConnection into the
+thread-local request_queries while a request is running.
+"""
+import os
+import struct
+import threading
+from bisect import bisect_left
+
+# Upper bounds in seconds, from a fast query to a full busy timeout
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style (not thread-safe on its own)"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        cumulative, running = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            running += count
+            cumulative.append((bound, running))
+        return {'count': self.count, 'sum': round(self.sum, 6), 'max': round(self.max, 6), 'buckets': cumulative}
+
+class DatabaseMetrics:
+    """Lock waits and write transaction durations, fed by models.PooledConnection"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.busy_waits = Histogram()       # time spent waiting for the write lock
+            self.busy_timeouts = 0              # waits that ended in "database is locked"
+            self.write_transactions = Histogram()
+            self.transactions = 0               # models.run_transaction() units of work
+            self.transactions_retried = 0       # ... that needed more than one attempt
+            self.transaction_retries = 0        # extra attempts in total
+            self.transactions_failed = 0        # ... that ran out of attempts
+
+    def record_busy_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.busy_waits.observe(seconds)
+            if timed_out:
+                self.busy_timeouts += 1
+
+    def record_write_transaction(self, seconds):
+        with self._lock:
+            self.write_transactions.observe(seconds)
+
+    def record_transaction(self, retries, failed=False):
+        with self._lock:
+            self.transactions += 1
+            self.transaction_retries += retries
+            if retries:
+                self.transactions_retried += 1
+            if failed:
+                self.transactions_failed += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'busy_waits': self.busy_waits.snapshot(),
+                'busy_timeouts': self.busy_timeouts,
+                'write_transactions': self.write_transactions.snapshot(),
+                'transactions': {
+                    'total': self.transactions,
+                    'retried': self.transactions_retried,
+                    'retries': self.transaction_retries,
+                    'failed': self.transactions_failed,
+                },
+            }
+
+db_metrics = DatabaseMetrics()
+
+# Statements per request: from a cached page to a long game being recalculated
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+
+class QueryAccounting(threading.local):
+    """SQL statements run by the current thread since start()"""
+    active = False
+    route = None
+    count = 0
+    seconds = 0.0
+
+    def start(self, route=None):
+        self.active = True
+        self.route = route
+        self.count = 0
+        self.seconds = 0.0
+
+    def stop(self):
+        self.active = False
+        return self.count, self.seconds
+
+    def record(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+
+    def record_fetch(self, seconds):
+        """Time spent fetching the rows of a statement already counted"""
+        self.seconds += seconds
+
+request_queries = QueryAccounting()
+
+class RequestMetrics:
+    """Latency per (endpoint, method, status) and SQL usage per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latency = {}      # (endpoint, method, status) -> Histogram
+            self.sql_count = {}    # endpoint -> Histogram of statements per request
+            self.sql_seconds = {}  # endpoint -> Histogram of SQL time per request
+
+    def record(self, endpoint, method, status, seconds, queries, query_seconds):
+        with self._lock:
+            key = (endpoint, method, status)
+            if key not in self.latency:
+                self.latency[key] = Histogram()
+                self.sql_count.setdefault(endpoint, Histogram(QUERY_COUNT_BUCKETS))
+                self.sql_seconds.setdefault(endpoint, Histogram())
+            self.latency[key].observe(seconds)
+            self.sql_count[endpoint].observe(queries)
+            self.sql_seconds[endpoint].observe(query_seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'latency': {key: h.snapshot() for key, h in self.latency.items()},
+                'sql_count': {key: h.snapshot() for key, h in self.sql_count.items()},
+                'sql_seconds': {key: h.snapshot() for key, h in self.sql_seconds.items()},
+            }
+
+request_metrics = RequestMetrics()
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+# The -shm wal-index starts with two copies of its 48-byte header (mxFrame,
+# the last valid WAL frame, at offset 16) followed by the checkpoint info
+# (nBackfill, the frames already copied into the database, at offset 96).
+# Both are native-endian 32-bit integers.
+WAL_INDEX_FRAMES = struct.Struct('=I')
+WAL_INDEX_MAX_FRAME = 16
+WAL_INDEX_BACKFILL = 96
+WAL_HEADER_BYTES = 32
+WAL_FRAME_HEADER_BYTES = 24
+
+def wal_progress(database, page_size):
+    """(frames in the WAL, frames already checkpointed) read from the -shm
+    wal-index without touching the database. Falls back to counting frames
+    from the -wal size, with nothing known to be checkpointed."""
+    try:
+        with open(database + '-shm', 'rb') as f:
+            header = f.read(WAL_INDEX_BACKFILL + WAL_INDEX_FRAMES.size)
+        if len(header) == WAL_INDEX_BACKFILL + WAL_INDEX_FRAMES.size:
+            return (WAL_INDEX_FRAMES.unpack_from(header, WAL_INDEX_MAX_FRAME)[0],
+                    WAL_INDEX_FRAMES.unpack_from(header, WAL_INDEX_BACKFILL)[0])
+    except OSError:
+        pass
+    frames = max(file_size(database + '-wal') - WAL_HEADER_BYTES, 0) // (page_size + WAL_FRAME_HEADER_BYTES)
+    return frames, 0
+
+def collect_db_stats(conn, pool):
+    """Database file, WAL and pool state plus the lock/transaction metrics.
+    Cheap enough to scrape every few seconds: a handful of read-only PRAGMAs
+    and file reads. It never checkpoints; that is left to maintenance.py."""
+    database = conn.execute('PRAGMA database_list').fetchone()['file']
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    wal_frames, checkpointed = wal_progress(database, page_size)
+    return {
+        'pid': os.getpid(),
+        'database': database,
+        'database_bytes': file_size(database),
+        'wal_bytes': file_size(database + '-wal'),
+        'shm_bytes': file_size(database + '-shm'),
+        'page_size': page_size,
+        'page_count': conn.execute('PRAGMA page_count').fetchone()[0],
+        'freelist_count': conn.execute('PRAGMA freelist_count').fetchone()[0],
+        'wal_frames': wal_frames,
+        'checkpoint_lag_frames': max(wal_frames - checkpointed, 0),
+        'wal_autocheckpoint': conn.execute('PRAGMA wal_autocheckpoint').fetchone()[0],
+        'pool': pool.stats(),
+        **db_metrics.snapshot(),
+    }
+
+def format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return '+Inf' if value == float('inf') else repr(value)
+    return str(value)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + '}'
+
+def prometheus_lines(name, kind, help_text, samples):
+    """Lines for one metric family. samples is a list of (labels, value) for
+    counters and gauges, or (labels, Histogram.snapshot()) for histograms."""
+    lines = ['# HELP {} {}'.format(name, help_text), '# TYPE {} {}'.format(name, kind)]
+    for labels, value in samples:
+        if kind == 'histogram':
+            for bound, count in value['buckets']:
+                lines.append('{}_bucket{} {}'.format(name, format_labels(dict(labels, le=format_value(float(bound)))), count))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(float(value['sum']))))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), value['count']))
+        else:
+            lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+    return lines
+
+DB_GAUGES = (
+    ('database_bytes', 'Size of the database file'),
+    ('wal_bytes', 'Size of the -wal file'),
+    ('shm_bytes', 'Size of the -shm file'),
+    ('page_count', 'Pages in the database'),
+    ('freelist_count', 'Unused pages in the database'),
+    ('wal_frames', 'Frames in the WAL'),
+    ('checkpoint_lag_frames', 'WAL frames not yet copied into the database file'),
+    ('wal_autocheckpoint', 'WAL frames at which SQLite checkpoints on commit'),
+)
+
+def db_stats_prometheus(stats):
+    """Prometheus text exposition of collect_db_stats()"""
+    pid = {'pid': stats['pid']}
+    lines = []
+    for key, help_text in DB_GAUGES:
+        lines += prometheus_lines('spades_db_' + key, 'gauge', help_text, [(pid, stats[key])])
+    for key, value in sorted(stats['pool'].items()):
+        if key == 'pid':
+            continue
+        kind, name = ('gauge', key) if key in ('idle', 'in_use', 'max_idle') else ('counter', key + '_total')
+        lines += prometheus_lines('spades_db_pool_' + name, kind, 'Connection pool ' + key.replace('_', ' '),
+                                  [(pid, value)])
+    lines += prometheus_lines('spades_db_busy_wait_seconds', 'histogram',
+                              'Time spent waiting for the write lock (SQLITE_BUSY)', [(pid, stats['busy_waits'])])
+    lines += prometheus_lines('spades_db_busy_timeouts_total', 'counter',
+                              'Write lock waits that gave up with "database is locked"', [(pid, stats['busy_timeouts'])])
+    lines += prometheus_lines('spades_db_write_transaction_seconds', 'histogram',
+                              'Time from taking the write lock to commit or rollback', [(pid, stats['write_transactions'])])
+    for name, key, help_text in (
+            ('spades_db_transactions_total', 'total', 'Units of work run as write transactions'),
+            ('spades_db_transactions_retried_total', 'retried', 'Units of work that needed more than one attempt'),
+            ('spades_db_transaction_retries_total', 'retries', 'Extra attempts after SQLITE_BUSY'),
+            ('spades_db_transactions_failed_total', 'failed', 'Units of work that ran out of attempts')):
+        lines += prometheus_lines(name, 'counter', help_text, [(pid, stats['transactions'][key])])
+    return '\n'.join(lines) + '\n'
+
+RENDER_CACHE_GAUGES = ('entries', 'bytes', 'max_entries', 'max_bytes')
+
+def render_cache_prometheus(stats):
+    """Prometheus text exposition of RenderCache.stats()"""
+    pid = {'pid': os.getpid()}
+    lines = []
+    for key, value in sorted(stats.items()):
+        kind, name = ('gauge', key) if key in RENDER_CACHE_GAUGES else ('counter', key + '_total')
+        lines += prometheus_lines('spades_render_cache_' + name, kind, 'Spectator render cache ' + key.replace('_', ' '),
+                                  [(pid, value)])
+    return '\n'.join(lines) + '\n'
+
+def request_metrics_prometheus(snapshot):
+    """Prometheus text exposition of RequestMetrics.snapshot()"""
+    pid = os.getpid()
+    lines = prometheus_lines(
+        'spades_request_duration_seconds', 'histogram', 'Time to build the response, by route and status',
+        [({'pid': pid, 'endpoint': endpoint, 'method': method, 'status': status}, h)
+         for (endpoint, method, status), h in sorted(snapshot['latency'].items())])
+    lines += prometheus_lines(
+        'spades_request_sql_statements', 'histogram', 'SQL statements executed per request',
+        [({'pid': pid, 'endpoint': endpoint}, h) for endpoint, h in sorted(snapshot['sql_count'].items())])
+    lines += prometheus_lines(
+        'spades_request_sql_seconds', 'histogram', 'Time spent executing SQL per request',
+        [({'pid': pid, 'endpoint': endpoint}, h) for endpoint, h in sorted(snapshot['sql_seconds'].items())])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+"""
+Versioned schema migrations.
+
+Each migration is applied once, in order, inside its own transaction and
+recorded in the schema_migrations table. Migrations are written to be
+idempotent so they are also safe to run against databases that were patched
+by hand with the old one-off scripts.
+
+Usage:
+    python migrations.py            # apply pending migrations
+    python migrations.py --status   # list applied and pending migrations
+    python migrations.py --check    # verify hot queries use their indexes
+"""
+import sys
+import players
+import search
+import stats
+from models import get_db_connection, generate_share_code
+
+MIGRATIONS = []
+
+def migration(version, name):
+    """Register a migration function under a schema version"""
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+def column_names(conn, table):
+    return [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table)).fetchall()]
+
+@migration(1, 'share codes for every game')
+def add_share_codes(conn):
+    """Add games.share_code and give every game a unique 5-digit code.
+    Replaces add_share_code_migration.py and update_share_codes.py."""
+    if 'share_code' not in column_names(conn, 'games'):
+        conn.execute('ALTER TABLE games ADD COLUMN share_code TEXT')
+
+    # Missing, legacy 12-char, or duplicated codes all get a fresh 5-digit code
+    games = conn.execute('''
+        SELECT id FROM games
+        WHERE share_code IS NULL
+           OR length(share_code) != 5
+           OR id NOT IN (SELECT MIN(id) FROM games GROUP BY share_code)
+    ''').fetchall()
+    for game in games:
+        conn.execute('UPDATE games SET share_code = ? WHERE id = ?', (generate_share_code(conn), game['id']))
+
+@migration(2, 'indexes for hot query paths')
+def add_hot_path_indexes(conn):
+    """Indexes for the rounds, spectator, dashboard and login lookups"""
+    # Game page, spectator view and recalculation: WHERE game_id = ? ORDER BY round_number
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_rounds_game_round ON rounds (game_id, round_number)')
+    # /view/<share_code>
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_games_share_code ON games (share_code)')
+    # Dashboard active/abandoned lists (by created_date) and completed list (by completed_date)
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_games_user_status_created
+                    ON games (created_by_user_id, status, created_date)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_games_user_status_completed
+                    ON games (created_by_user_id, status, completed_date)''')
+    # verify_security_code() - covers the whole WHERE clause
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_auth_codes_user_code
+                    ON auth_codes (user_id, code, expires_at)''')
+    # Expired code cleanup
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_auth_codes_expires ON auth_codes (expires_at)')
+
+@migration(3, 'per-game version counter')
+def add_game_version(conn):
+    """games.version goes up in the same transaction as any write to the game or its rounds"""
+    if 'version' not in column_names(conn, 'games'):
+        conn.execute('ALTER TABLE games ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+
+    # Updates that don't touch version themselves bump it (the trigger's own
+    # UPDATE changes version, so it doesn't fire again)
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS games_bump_version AFTER UPDATE ON games
+        WHEN NEW.version = OLD.version
+        BEGIN
+            UPDATE games SET version = OLD.version + 1 WHERE id = NEW.id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS rounds_insert_bump_game_version AFTER INSERT ON rounds
+        BEGIN
+            UPDATE games SET version = version + 1 WHERE id = NEW.game_id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS rounds_update_bump_game_version AFTER UPDATE ON rounds
+        BEGIN
+            UPDATE games SET version = version + 1 WHERE id = NEW.game_id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS rounds_delete_bump_game_version AFTER DELETE ON rounds
+        BEGIN
+            UPDATE games SET version = version + 1 WHERE id = OLD.game_id;
+        END
+    ''')
+
+@migration(4, 'covering index for the dashboard')
+def add_dashboard_covering_index(conn):
+    """Active and abandoned dashboard lists page through (created_date, id) and
+    read only the card columns, so they never touch the games table itself"""
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_games_dashboard
+                    ON games (created_by_user_id, status, created_date, id,
+                              team1_player1, team1_player2, team2_player1, team2_player2,
+                              team1_final_score, team2_final_score, max_score, winner, completed_date)''')
+    # Same leading columns, so the covering index replaces it
+    conn.execute('DROP INDEX IF EXISTS idx_games_user_status_created')
+
+@migration(5, 'outbound email queue')
+def add_email_outbox(conn):
+    """Messages waiting for (or given up on by) the background mailer"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            text_body TEXT NOT NULL,
+            html_body TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL,
+            last_error TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_date TIMESTAMP
+        )
+    ''')
+    # Mailer.claim_due(): WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (status, next_attempt_at)')
+
+@migration(6, 'maintenance lease')
+def add_maintenance_leases(conn):
+    """Which process runs the periodic maintenance pass (see maintenance.Janitor)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        )
+    ''')
+
+@migration(7, 'player statistics')
+def add_player_stats(conn):
+    """Running per-player and per-partnership sums (see stats.py), backfilled here"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS player_stats (
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            games INTEGER NOT NULL DEFAULT 0,
+            wins INTEGER NOT NULL DEFAULT 0,
+            rounds INTEGER NOT NULL DEFAULT 0,
+            bid_total INTEGER NOT NULL DEFAULT 0,
+            contracts INTEGER NOT NULL DEFAULT 0,
+            contracts_made INTEGER NOT NULL DEFAULT 0,
+            nil_attempts INTEGER NOT NULL DEFAULT 0,
+            nil_made INTEGER NOT NULL DEFAULT 0,
+            blind_nil_attempts INTEGER NOT NULL DEFAULT 0,
+            blind_nil_made INTEGER NOT NULL DEFAULT 0,
+            bags INTEGER NOT NULL DEFAULT 0,
+            bag_penalties INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, kind, name)
+        ) WITHOUT ROWID
+    ''')
+    stats.rebuild(conn)
+
+@migration(8, 'players and game seats')
+def add_players(conn):
+    """Normalized players per scorekeeper and who sat where (see players.py), backfilled here"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS players (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            name_key TEXT NOT NULL,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # De-duplication and autocomplete: WHERE user_id = ? AND name_key >= ? AND name_key < ?
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_players_user_name ON players (user_id, name_key)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS game_players (
+            game_id INTEGER NOT NULL,
+            team INTEGER NOT NULL,
+            seat INTEGER NOT NULL,
+            player_id INTEGER NOT NULL,
+            PRIMARY KEY (game_id, team, seat)
+        ) WITHOUT ROWID
+    ''')
+    # Player history and head-to-head: WHERE player_id = ?, joined on game_id
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_game_players_player ON game_players (player_id, game_id, team)')
+    players.backfill(conn)
+
+@migration(9, 'full-text search over games')
+def add_games_search(conn):
+    """External-content FTS5 index on games, kept in step by triggers; replaced by migration 14"""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'games_fts'").fetchone():
+        return
+    columns = ('created_by_user_id, team1_player1, team1_player2, team2_player1, team2_player2, winner, '
+               'share_code, created_date, completed_date')
+    new_values = ', '.join('NEW.' + name for name in columns.split(', '))
+    old_values = ', '.join('OLD.' + name for name in columns.split(', '))
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS games_fts USING fts5(
+            {columns}, content='games', content_rowid='id', tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    '''.format(columns=columns))
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS games_fts_insert AFTER INSERT ON games
+        BEGIN
+            INSERT INTO games_fts (rowid, {columns}) VALUES (NEW.id, {new});
+        END
+    '''.format(columns=columns, new=new_values))
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS games_fts_delete AFTER DELETE ON games
+        BEGIN
+            INSERT INTO games_fts (games_fts, rowid, {columns}) VALUES ('delete', OLD.id, {old});
+        END
+    '''.format(columns=columns, old=old_values))
+    # Only the indexed columns; score and version updates don't touch the index
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS games_fts_update AFTER UPDATE OF {columns} ON games
+        BEGIN
+            INSERT INTO games_fts (games_fts, rowid, {columns}) VALUES ('delete', OLD.id, {old});
+            INSERT INTO games_fts (rowid, {columns}) VALUES (NEW.id, {new});
+        END
+    '''.format(columns=columns, old=old_values, new=new_values))
+    conn.execute("INSERT INTO games_fts (games_fts) VALUES ('rebuild')")
+
+@migration(10, 'index for exports')
+def add_export_index(conn):
+    """All of a user's games in id order, so /export.* streams without a sort"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_games_user ON games (created_by_user_id)')
+
+@migration(11, 'round event log')
+def add_round_log(conn):
+    """Append-only round events and periodic snapshots per game (see round_log.py)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS round_events (
+            game_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            round_number INTEGER NOT NULL,
+            before TEXT,
+            after TEXT,
+            undo_seq INTEGER,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (game_id, seq)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS round_snapshots (
+            game_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            rounds TEXT NOT NULL,
+            PRIMARY KEY (game_id, seq)
+        ) WITHOUT ROWID
+    ''')
+
+@migration(12, 'recount bag penalties')
+def recount_bag_penalties(conn):
+    """player_stats counted a round with a penalty once however many sets of bags it took"""
+    stats.rebuild(conn)
+
+@migration(13, 'drop players without games')
+def drop_unseated_players(conn):
+    """Renamed and deleted games used to leave their old players behind for autocomplete"""
+    conn.execute('DELETE FROM players WHERE NOT EXISTS (SELECT 1 FROM game_players WHERE player_id = players.id)')
+
+@migration(14, 'search index scoped per user')
+def scope_games_search(conn):
+    """Contentless FTS5 index of owner-tagged words (see search.py), kept in step by triggers"""
+    for trigger in ('games_fts_insert', 'games_fts_delete', 'games_fts_update'):
+        conn.execute('DROP TRIGGER IF EXISTS {}'.format(trigger))
+    conn.execute('DROP TABLE IF EXISTS games_fts')
+    columns = ', '.join(name for name, _ in search.FTS_COLUMNS)
+    conn.execute('''
+        CREATE VIRTUAL TABLE games_fts USING fts5(
+            {columns}, content='', tokenize='unicode61 remove_diacritics 2'
+        )
+    '''.format(columns=columns))
+    conn.execute('''
+        CREATE TRIGGER games_fts_insert AFTER INSERT ON games
+        BEGIN
+            INSERT INTO games_fts (rowid, {columns}) VALUES (NEW.id, {new});
+        END
+    '''.format(columns=columns, new=search.indexed_values('NEW')))
+    conn.execute('''
+        CREATE TRIGGER games_fts_delete AFTER DELETE ON games
+        BEGIN
+            INSERT INTO games_fts (games_fts, rowid, {columns}) VALUES ('delete', OLD.id, {old});
+        END
+    '''.format(columns=columns, old=search.indexed_values('OLD')))
+    # Only the indexed columns and their owner; score and version updates don't touch the index
+    conn.execute('''
+        CREATE TRIGGER games_fts_update AFTER UPDATE OF created_by_user_id, {columns} ON games
+        BEGIN
+            INSERT INTO games_fts (games_fts, rowid, {columns}) VALUES ('delete', OLD.id, {old});
+            INSERT INTO games_fts (rowid, {columns}) VALUES (NEW.id, {new});
+        END
+    '''.format(columns=columns, old=search.indexed_values('OLD'), new=search.indexed_values('NEW')))
+    search.rebuild(conn)
+
+def ensure_migrations_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+def current_version(conn):
+    ensure_migrations_table(conn)
+    row = conn.execute('SELECT MAX(version) FROM schema_migrations').fetchone()
+    return row[0] or 0
+
+def pending_migrations(conn):
+    version = current_version(conn)
+    return [m for m in MIGRATIONS if m[0] > version]
+
+def run_migrations(conn=None, verbose=False):
+    """Apply all pending migrations in order. Returns the versions applied."""
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+
+    applied = []
+    try:
+        for version, name, fn in pending_migrations(conn):
+            # BEGIN IMMEDIATE so concurrent workers starting up migrate one at a time
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                already = conn.execute('SELECT 1 FROM schema_migrations WHERE version = ?',
+                                       (version,)).fetchone()
+                if not already:
+                    fn(conn)
+                    conn.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)',
+                                 (version, name))
+                    applied.append(version)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            if verbose and not already:
+                print("Applied migration {}: {}".format(version, name))
+    finally:
+        if own_conn:
+            conn.close()
+
+    return applied
+
+# Hot queries and the index each one must use. Parameters only need the right shape.
+QUERY_PLAN_CHECKS = [
+    ('rounds for a game',
+     'SELECT * FROM rounds WHERE game_id = ? ORDER BY round_number', (1,),
+     'idx_rounds_game_round'),
+    ('game by share code',
+     'SELECT * FROM games WHERE share_code = ?', ('12345',),
+     'idx_games_share_code'),
+    ('dashboard first page',
+     "SELECT id, team1_player1, team1_final_score, max_score FROM games WHERE created_by_user_id = ? AND status = 'active' "
+     "ORDER BY created_date DESC, id DESC LIMIT 13",
+     (1,), 'COVERING INDEX idx_games_dashboard'),
+    ('dashboard load more',
+     "SELECT id, team2_player2, winner, completed_date FROM games WHERE created_by_user_id = ? AND status = 'abandoned' "
+     "AND (created_date, id) < (?, ?) ORDER BY created_date DESC, id DESC LIMIT 13",
+     (1, '2030-01-01 00:00:00', 1), 'COVERING INDEX idx_games_dashboard'),
+    ('dashboard completed games',
+     "SELECT * FROM games WHERE created_by_user_id = ? AND status = 'completed' ORDER BY completed_date DESC LIMIT 5",
+     (1,), 'idx_games_user_status_completed'),
+    ('verify security code',
+     'SELECT * FROM auth_codes WHERE user_id = ? AND code = ? AND expires_at > ? ORDER BY created_date DESC LIMIT 1',
+     (1, '123456', '2000-01-01'), 'idx_auth_codes_user_code'),
+    ('due outbound email',
+     "SELECT * FROM email_outbox WHERE status IN ('pending', 'sending') AND next_attempt_at <= ? "
+     "ORDER BY next_attempt_at LIMIT 20",
+     ('2030-01-01',), 'idx_email_outbox_due'),
+    ('stats page',
+     'SELECT * FROM player_stats WHERE user_id = ? ORDER BY kind, games DESC, rounds DESC, name', (1,),
+     'PRIMARY KEY'),
+    ('player name autocomplete',
+     'SELECT name FROM players WHERE user_id = ? AND name_key >= ? AND name_key < ? ORDER BY name_key LIMIT 10',
+     (1, 'al', 'al\U0010ffff'), 'idx_players_user_name'),
+    ('player history',
+     'SELECT g.*, gp.team FROM game_players gp JOIN games g ON g.id = gp.game_id WHERE gp.player_id = ? '
+     'ORDER BY g.created_date DESC, g.id DESC LIMIT 50',
+     (1,), 'idx_game_players_player'),
+    ('game search',
+     'SELECT g.id, bm25(games_fts) AS score FROM games_fts JOIN games g ON g.id = games_fts.rowid '
+     'WHERE games_fts MATCH ? AND g.created_by_user_id = ? ORDER BY score LIMIT 21',
+     ('"1xal"*', 1), 'VIRTUAL TABLE INDEX 0:M'),
+    ('history export',
+     'SELECT g.*, r.* FROM games g LEFT JOIN rounds r ON r.game_id = g.id WHERE g.created_by_user_id = ? '
+     'ORDER BY g.id, r.round_number',
+     (1,), 'idx_games_user'),
+    ('last round event',
+     'SELECT * FROM round_events WHERE game_id = ? ORDER BY seq DESC LIMIT 1', (1,),
+     'PRIMARY KEY'),
+    ('nearest round snapshot',
+     'SELECT seq, rounds FROM round_snapshots WHERE game_id = ? AND seq <= ? ORDER BY seq DESC LIMIT 1', (1, 100),
+     'PRIMARY KEY'),
+]
+
+def check_query_plans(conn=None):
+    """Run EXPLAIN QUERY PLAN for each hot query.
+    Returns a list of (label, index, ok, plan_details)."""
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+
+    results = []
+    try:
+        for label, sql, params, index in QUERY_PLAN_CHECKS:
+            plan = [row['detail'] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+            uses_index = any(index in detail for detail in plan)
+            results.append((label, index, uses_index, plan))
+    finally:
+        if own_conn:
+            conn.close()
+
+    return results
+
+def print_status(conn):
+    applied = {row['version']: row['applied_date'] for row in
+               conn.execute('SELECT version, applied_date FROM schema_migrations').fetchall()}
+    for version, name, _ in MIGRATIONS:
+        if version in applied:
+            print("  [x] {:>3} {} (applied {})".format(version, name, applied[version]))
+        else:
+            print("  [ ] {:>3} {}".format(version, name))
+
+if __name__ == '__main__':
+    from models import init_db
+
+    if '--status' in sys.argv:
+        conn = get_db_connection()
+        ensure_migrations_table(conn)
+        print("Schema version: {}".format(current_version(conn)))
+        print_status(conn)
+        conn.close()
+    elif '--check' in sys.argv:
+        init_db()
+        failures = 0
+        for label, index, ok, plan in check_query_plans():
+            print("{} {}: {}".format('✓' if ok else '✗', label, '; '.join(plan)))
+            if not ok:
+                failures += 1
+                print("    expected to use {}".format(index))
+        sys.exit(1 if failures else 0)
+    else:
+        init_db()
+        conn = get_db_connection()
+        print("Database is at schema version {}".format(current_version(conn)))
+        conn.close()
@@ -1,20 +1,463 @@
 import sqlite3
 import os
+import random
+import secrets
+import sys
+import threading
+import time
 from datetime import datetime
 from contextlib import contextmanager
+from functools import wraps
 
-DATABASE = 'database.db'
+import slow_queries
+from metrics import db_metrics, request_queries
+
+DATABASE = os.environ.get('SPADES_DATABASE', 'database.db')
+
+# Write transactions: how often to try, how long SQLite waits for the lock on
+# each try, and the first backoff between tries (doubled each time, full jitter)
+TRANSACTION_ATTEMPTS = 5
+TRANSACTION_LOCK_WAIT = 2.0
+TRANSACTION_BACKOFF = 0.05
+
+# With a writer service running (writer_service.py), @transactional units are
+# sent to it over this Unix socket instead of being committed here
+WRITER_SOCKET = os.environ.get('SPADES_WRITER_SOCKET')
+
+# Every @transactional function by unit_name(), for the writer to look up
+UNITS = {}
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to its pool.
+
+    Statements that take the write lock (BEGIN IMMEDIATE, or the first
+    INSERT/UPDATE/DELETE of an implicit transaction) are first tried with
+    busy_timeout=0, so a contended lock shows up as SQLITE_BUSY and the wait
+    that follows can be timed. Commit/rollback records how long the write
+    transaction held the lock. During a request every statement is also
+    counted and timed in metrics.request_queries, and with the slow-query
+    log enabled slow statements are written to it.
+    """
+    pool = None
+    pool_pid = None
+    last_used = 0.0
+    busy_timeout_ms = 0
+    write_started = None
+
+    def _takes_write_lock(self, sql):
+        head = sql.lstrip()[:16].upper()
+        if head.startswith('BEGIN'):
+            return 'IMMEDIATE' in head or 'EXCLUSIVE' in head
+        return not self.in_transaction and head.startswith(WRITE_STATEMENTS)
+
+    def _locking(self, run, sql):
+        if not self._takes_write_lock(sql):
+            return run()
+        restore = 'PRAGMA busy_timeout = {}'.format(self.busy_timeout_ms)
+        super().execute('PRAGMA busy_timeout = 0')
+        try:
+            try:
+                result = run()
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise
+                # Nothing was done yet in the transaction the failed statement opened
+                if self.in_transaction:
+                    super().rollback()
+                super().execute(restore)
+                start = time.perf_counter()
+                try:
+                    result = run()
+                except sqlite3.OperationalError:
+                    db_metrics.record_busy_wait(time.perf_counter() - start, timed_out=True)
+                    raise
+                db_metrics.record_busy_wait(time.perf_counter() - start)
+        finally:
+            super().execute(restore)
+        self.write_started = time.perf_counter()
+        return result
+
+    def _counted(self, run, sql, parameters, many=False):
+        slow_log = slow_queries.active
+        if not request_queries.active and slow_log is None:
+            return self._locking(run, sql)
+        steps = slow_log.start(self) if slow_log is not None else None
+        start = time.perf_counter()
+        try:
+            cursor = self._locking(run, sql)
+        except Exception:
+            if slow_log is not None:
+                slow_log.finish(self, sql, parameters, many, time.perf_counter() - start, steps)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            if request_queries.active:
+                request_queries.record(elapsed)
+        measured = MeasuredCursor(self, cursor, sql, parameters, many, slow_log, steps, elapsed)
+        if cursor.description is None:
+            # Not a query: execute() ran it to completion
+            measured.finish()
+            return cursor
+        if slow_log is not None:
+            slow_log.pause(self)
+        return measured
+
+    def execute(self, sql, parameters=()):
+        return self._counted(lambda: super(PooledConnection, self).execute(sql, parameters), sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._counted(lambda: super(PooledConnection, self).executemany(sql, seq_of_parameters),
+                             sql, seq_of_parameters, many=True)
+
+    def _end_write(self):
+        if self.write_started is not None:
+            db_metrics.record_write_transaction(time.perf_counter() - self.write_started)
+            self.write_started = None
+
+    def commit(self):
+        super().commit()
+        self._end_write()
+
+    def rollback(self):
+        super().rollback()
+        self._end_write()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.checkin(self)
+        else:
+            super().close()
+
+    def discard(self):
+        """Really close the underlying sqlite3 connection"""
+        self.pool = None
+        super().close()
+
+class MeasuredCursor:
+    """A query's cursor while statements are being measured.
+
+    SQLite only steps a SELECT to its first row in execute(); the rest of the
+    work happens as rows are fetched. Fetches through this cursor add to the
+    request's SQL time and the statement's duration and VM steps, and the
+    statement goes to the slow-query log once its rows run out, the cursor is
+    closed or it is dropped. Everything else is the wrapped sqlite3 cursor."""
+
+    def __init__(self, conn, cursor, sql, parameters, many, slow_log, steps, seconds):
+        self._conn = conn
+        self._cursor = cursor
+        self._statement = (sql, parameters, many)
+        self._slow_log = slow_log
+        self._steps = steps
+        self._seconds = seconds
+        self._finished = False
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _measure(self, fetch, *args):
+        if self._finished:
+            return fetch(*args)
+        if self._slow_log is not None:
+            self._slow_log.start(self._conn, self._steps)
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._seconds += elapsed
+            if request_queries.active:
+                request_queries.record_fetch(elapsed)
+            if self._slow_log is not None:
+                self._slow_log.pause(self._conn)
+
+    def fetchone(self):
+        row = self._measure(self._cursor.fetchone)
+        if row is None:
+            self.finish()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self._cursor.arraysize if size is None else size
+        rows = self._measure(self._cursor.fetchmany, size)
+        if len(rows) < size:
+            self.finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._measure(self._cursor.fetchall)
+        self.finish()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self.finish()
+        self._cursor.close()
+
+    def finish(self):
+        """Stop measuring and log the statement if it was slow"""
+        if self._finished:
+            return
+        self._finished = True
+        if self._slow_log is not None:
+            sql, parameters, many = self._statement
+            self._slow_log.finish(self._conn, sql, parameters, many, self._seconds, self._steps)
+
+    def __del__(self):
+        self.finish()
+
+class ConnectionPool:
+    """Per-process pool of long-lived, PRAGMA-initialised SQLite connections.
+
+    Connections are handed out one caller at a time (checkout) and returned
+    by conn.close() (checkin), so each worker keeps its page cache warm instead
+    of reconnecting and re-running the PRAGMAs on every request.
+    """
+
+    def __init__(self, database=None, max_idle=8, health_check_interval=30.0, timeout=30.0):
+        self.database = database
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self._reset_state()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset_state(self):
+        self._lock = threading.Lock()
+        self._idle = []
+        self._checked_out = {}
+        self._pid = os.getpid()
+        self._counters = {
+            'created': 0,
+            'reused': 0,
+            'checkouts': 0,
+            'checkins': 0,
+            'discarded': 0,
+            'health_checks': 0,
+            'health_check_failures': 0,
+            'forks': 0,
+        }
+
+    def _after_fork(self):
+        """Forget connections inherited from the parent process.
+
+        SQLite connections must not be used (or even closed) across fork, so the
+        parent's connections are parked on a list that is never touched again.
+        """
+        orphaned = self._idle + list(self._checked_out)
+        forks = self._counters['forks'] + 1
+        self._reset_state()
+        self._orphaned = orphaned
+        self._counters['forks'] = forks
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database or DATABASE, timeout=self.timeout,
+                               factory=PooledConnection, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # Only takes effect on a brand new file, so it must come before journal_mode;
+        # existing databases are converted with maintenance.py --enable-incremental-vacuum
+        if conn.execute('PRAGMA page_count').fetchone()[0] == 0:
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # Enable WAL mode for better concurrency
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=1000')
+        conn.execute('PRAGMA temp_store=memory')
+        conn.pool = self
+        conn.pool_pid = self._pid
+        conn.busy_timeout_ms = int(self.timeout * 1000)
+        self._count('created')
+        return conn
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _healthy(self, conn):
+        self._count('health_checks')
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            self._count('health_check_failures')
+            return False
+
+    def checkout(self):
+        """Hand out an idle connection, or open a new one if none are idle"""
+        if self._pid != os.getpid():
+            self._after_fork()
+
+        conn = None
+        while conn is None:
+            with self._lock:
+                if not self._idle:
+                    break
+                candidate = self._idle.pop()
+            if time.monotonic() - candidate.last_used > self.health_check_interval \
+                    and not self._healthy(candidate):
+                self._discard(candidate)
+                continue
+            conn = candidate
+            self._count('reused')
+
+        if conn is None:
+            conn = self._connect()
+
+        with self._lock:
+            self._checked_out[conn] = threading.get_ident()
+            self._counters['checkouts'] += 1
+        return conn
+
+    def checkin(self, conn):
+        """Return a connection to the pool, rolling back anything left uncommitted"""
+        if conn.pool_pid != os.getpid():
+            # Inherited from the parent process - never reuse or close it here
+            return
+
+        with self._lock:
+            if self._checked_out.pop(conn, None) is None:
+                return
+            self._counters['checkins'] += 1
+
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+
+        conn.last_used = time.monotonic()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        self._discard(conn)
+
+    def release_thread(self):
+        """Check in every connection the current thread still holds"""
+        ident = threading.get_ident()
+        with self._lock:
+            leaked = [conn for conn, owner in self._checked_out.items() if owner == ident]
+        for conn in leaked:
+            self.checkin(conn)
+        return len(leaked)
+
+    def _discard(self, conn):
+        self._count('discarded')
+        try:
+            conn.discard()
+        except sqlite3.Error:
+            pass
+
+    def close_idle(self):
+        """Close all idle connections (e.g. before replacing the database file)"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        """Snapshot of pool usage counters"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = len(self._checked_out)
+        stats['max_idle'] = self.max_idle
+        stats['pid'] = self._pid
+        return stats
+
+db_pool = ConnectionPool()
+
+def configure_database(path):
+    """Point the app (and its connection pool) at a different database file"""
+    global DATABASE
+    db_pool.close_idle()
+    DATABASE = path
 
 def get_db_connection():
-    """Get database connection with row factory"""
-    conn = sqlite3.connect(DATABASE, timeout=30.0)
-    conn.row_factory = sqlite3.Row
-    # Enable WAL mode for better concurrency
-    conn.execute('PRAGMA journal_mode=WAL')
-    conn.execute('PRAGMA synchronous=NORMAL')
-    conn.execute('PRAGMA cache_size=1000')
-    conn.execute('PRAGMA temp_store=memory')
-    return conn
+    """Check out a pooled database connection with row factory.
+    Call conn.close() to hand it back to the pool."""
+    return db_pool.checkout()
+
+def generate_share_code(conn):
+    """Generate a 5-digit share code that no other game is using"""
+    while True:
+        code = str(secrets.randbelow(90000) + 10000)  # 10000-99999
+        if not conn.execute('SELECT 1 FROM games WHERE share_code = ?', (code,)).fetchone():
+            return code
+
+class DatabaseBusy(Exception):
+    """A write transaction could not get the write lock on any attempt"""
+
+def is_busy_error(error):
+    message = str(error)
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+def run_transaction(fn, *args, **kwargs):
+    """Call fn(conn, *args, **kwargs) inside BEGIN IMMEDIATE and commit.
+
+    Taking the write lock up front means the unit of work never has to upgrade
+    a read transaction halfway through. If the lock can't be had, everything
+    is rolled back and fn runs again from the start after a jittered backoff,
+    so fn must not have side effects outside the database.
+    """
+    backoff = TRANSACTION_BACKOFF
+    for attempt in range(TRANSACTION_ATTEMPTS):
+        conn = get_db_connection()
+        default_timeout_ms = conn.busy_timeout_ms
+        conn.busy_timeout_ms = int(TRANSACTION_LOCK_WAIT * 1000)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            result = fn(conn, *args, **kwargs)
+            conn.commit()
+            db_metrics.record_transaction(retries=attempt)
+            return result
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if not is_busy_error(e):
+                raise
+            if attempt == TRANSACTION_ATTEMPTS - 1:
+                db_metrics.record_transaction(retries=attempt, failed=True)
+                raise DatabaseBusy('{} gave up after {} attempts: {}'.format(fn.__name__, TRANSACTION_ATTEMPTS, e)) from e
+        finally:
+            conn.busy_timeout_ms = default_timeout_ms
+            conn.execute('PRAGMA busy_timeout = {}'.format(default_timeout_ms))
+            conn.close()
+        time.sleep(random.uniform(0, backoff))
+        backoff *= 2
+
+def unit_name(fn):
+    """Importable name of a unit of work, the same in every process"""
+    module = fn.__module__
+    if module in ('__main__', '__mp_main__'):
+        module = os.path.splitext(os.path.basename(sys.modules[module].__file__))[0]
+    return '{}.{}'.format(module, fn.__qualname__)
+
+def transactional(fn):
+    """Decorator: fn(conn, ...) becomes fn(...) run as one retried write transaction,
+    here or, with WRITER_SOCKET set, in the writer service"""
+    name = unit_name(fn)
+    UNITS[name] = fn
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if WRITER_SOCKET:
+            import writer_service
+            return writer_service.client(WRITER_SOCKET).call(name, args, kwargs)
+        return run_transaction(fn, *args, **kwargs)
+    wrapper.unit_of_work = fn
+    return wrapper
 
 @contextmanager
 def get_db():
@@ -136,6 +579,10 @@ def init_db():
     ''')
     
     conn.commit()
+
+    # Bring the schema up to date (indexes, added columns, ...)
+    from migrations import run_migrations
+    run_migrations(conn)
     conn.close()
 
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+"""
+Normalized players.
+
+Each scorekeeper's players are rows in `players`, de-duplicated on a
+case-folded, trimmed name key, and `game_players` records who sat where in
+every game. The free-text team*_player* columns on games stay as they are
+(they are what the score sheet shows); the units of work that create or
+edit or delete a game call sync_game() so the two never disagree, and a
+player left with no games by a rename or a deletion is removed with it.
+
+Name autocomplete is a range scan on (user_id, name_key); a player's
+history and head-to-head records go through game_players by player id
+instead of OR-ing across the four name columns of every game.
+"""
+
+SEATS = (('team1_player1', 1, 1), ('team1_player2', 1, 2), ('team2_player1', 2, 1), ('team2_player2', 2, 2))
+
+def name_key(name):
+    """What makes two spellings the same player: 'alice ', 'Alice' and 'ALICE' are one"""
+    return ' '.join(name.split()).casefold()
+
+def player_id(conn, user_id, name):
+    """Id of the user's player called `name`, creating it on first use"""
+    key = name_key(name)
+    conn.execute('INSERT INTO players (user_id, name, name_key) VALUES (?, ?, ?) ON CONFLICT DO NOTHING',
+                 (user_id, ' '.join(name.split()), key))
+    return conn.execute('SELECT id FROM players WHERE user_id = ? AND name_key = ?', (user_id, key)).fetchone()[0]
+
+DELETE_UNSEATED_SQL = '''
+    DELETE FROM players
+    WHERE id = ? AND NOT EXISTS (SELECT 1 FROM game_players WHERE player_id = players.id)
+'''
+
+def sync_game(conn, game_id):
+    """Point game_players at the game's current four names (none once it is
+    deleted) and drop the players it was the last game of"""
+    game = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+    previous = {row[0] for row in conn.execute('SELECT player_id FROM game_players WHERE game_id = ?', (game_id,))}
+    conn.execute('DELETE FROM game_players WHERE game_id = ?', (game_id,))
+    if game is not None:
+        conn.executemany('INSERT INTO game_players (game_id, team, seat, player_id) VALUES (?, ?, ?, ?)', [
+            (game_id, team, seat, player_id(conn, game['created_by_user_id'], game[column]))
+            for column, team, seat in SEATS
+        ])
+    conn.executemany(DELETE_UNSEATED_SQL, [(player,) for player in previous])
+
+def backfill(conn):
+    """Players and seats for every existing game. The caller commits. Returns the games done."""
+    game_ids = [row[0] for row in conn.execute(
+        'SELECT id FROM games WHERE id NOT IN (SELECT game_id FROM game_players) ORDER BY id')]
+    for game_id in game_ids:
+        sync_game(conn, game_id)
+    return len(game_ids)
+
+def autocomplete(conn, user_id, prefix, limit=10):
+    """The user's player names starting with `prefix`, served from the name index"""
+    key = name_key(prefix)
+    if not key:
+        return []
+    rows = conn.execute('''
+        SELECT name FROM players
+        WHERE user_id = ? AND name_key >= ? AND name_key < ?
+        ORDER BY name_key LIMIT ?
+    ''', (user_id, key, key + '\U0010ffff', limit))
+    return [row['name'] for row in rows]
+
+def find_player(conn, user_id, name):
+    return conn.execute('SELECT * FROM players WHERE user_id = ? AND name_key = ?',
+                        (user_id, name_key(name))).fetchone()
+
+def player_history(conn, player, limit=50):
+    """The player's games, newest first, with the team they were on"""
+    return conn.execute('''
+        SELECT g.*, gp.team AS player_team FROM game_players gp
+        JOIN games g ON g.id = gp.game_id
+        WHERE gp.player_id = ?
+        ORDER BY g.created_date DESC, g.id DESC LIMIT ?
+    ''', (player['id'], limit)).fetchall()
+
+def head_to_head(conn, player, opponent):
+    """Games where the two sat on opposite teams, plus the completed-game record between them"""
+    games = conn.execute('''
+        SELECT g.*, mine.team AS player_team FROM game_players mine
+        JOIN game_players theirs ON theirs.game_id = mine.game_id AND theirs.team != mine.team
+        JOIN games g ON g.id = mine.game_id
+        WHERE mine.player_id = ? AND theirs.player_id = ?
+        ORDER BY g.created_date DESC, g.id DESC
+    ''', (player['id'], opponent['id'])).fetchall()
+
+    record = {'wins': 0, 'losses': 0}
+    for game in games:
+        if game['status'] != 'completed':
+            continue
+        team = 'team{}'.format(game['player_team'])
+        won = game['winner'] == '{} & {}'.format(game[team + '_player1'], game[team + '_player2'])
+        record['wins' if won else 'losses'] += 1
+    return games, record
@@ -0,0 +1,238 @@
+"""
+Round recalculation engine.
+
+After a round is edited or deleted, every later round's running totals and
+bag state may change. recalculate_from_round() streams only the completed
+rounds from the change onwards, computes their derived columns in memory and
+writes them back with a single executemany(). It stops as soon as a round's
+stored values already match what it would write: from then on the running
+state is unchanged, so every later round is already correct.
+
+With SPADES_ROUND_STORAGE=derived, round rows keep only their raw inputs
+plus a checkpoint of the running state (totals and bag counts) on every
+CHECKPOINT_INTERVAL-th round; the other derived columns are NULL. An edit
+then rewrites at most the checkpoints after it instead of every later row.
+Reads go through game_rounds(), which replays the game with score_round()
+and keeps the result per game version. Run `python rescore.py` after
+switching modes to convert the stored rounds.
+"""
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import models
+from scoring import COMPONENTS, RuleSet
+
+DERIVED_ON_READ = os.environ.get('SPADES_ROUND_STORAGE') == 'derived'
+CHECKPOINT_INTERVAL = 8
+ROUNDS_CACHE_GAMES = 256
+
+# Columns derived from the raw round inputs (bids, tricks, success flags)
+# and the running state carried over from the previous round
+DERIVED_COLUMNS = (
+    'team1_points', 'team2_points',
+    'team1_total', 'team2_total',
+    'team1_bags_earned', 'team2_bags_earned',
+    'team1_bags_total', 'team2_bags_total',
+    'team1_bag_penalty', 'team2_bag_penalty',
+    'team1_bags_before_penalty', 'team2_bags_before_penalty',
+    'team1_bid_points', 'team1_nil_bonus', 'team1_blind_nil_bonus',
+    'team1_blind_bonus', 'team1_bag_points',
+    'team2_bid_points', 'team2_nil_bonus', 'team2_blind_nil_bonus',
+    'team2_blind_bonus', 'team2_bag_points',
+)
+
+UPDATE_DERIVED_SQL = 'UPDATE rounds SET {} WHERE id = ?'.format(
+    ', '.join('{} = ?'.format(column) for column in DERIVED_COLUMNS))
+
+# What a checkpoint keeps: the state the next round is scored on
+STATE_COLUMNS = ('team1_total', 'team2_total', 'team1_bags_total', 'team2_bags_total')
+CHECKPOINT_MASK = tuple(column in STATE_COLUMNS for column in DERIVED_COLUMNS)
+NOT_STORED = (None,) * len(DERIVED_COLUMNS)
+
+_rounds_cache = OrderedDict()  # (database, game_id) -> (version, rounds)
+_rounds_cache_lock = threading.Lock()
+
+def stored_values(round_number, values):
+    """The derived values (in DERIVED_COLUMNS order) a round row keeps: all of
+    them, or with derived-on-read storage only a checkpoint's running state"""
+    if not DERIVED_ON_READ:
+        return values
+    if round_number % CHECKPOINT_INTERVAL:
+        return NOT_STORED
+    return tuple(value if keep else None for value, keep in zip(values, CHECKPOINT_MASK))
+
+def score_round(game, r, state):
+    """Derived columns for one completed round.
+
+    `r` needs the raw inputs (team*_bid, team*_actual and the success flags);
+    `state` is (team1_total, team2_total, team1_bags_total, team2_bags_total)
+    after the previous round. Returns (derived, new_state).
+    """
+    rules = RuleSet.for_game(game)
+    team1_total, team2_total, team1_bags_total, team2_bags_total = state
+    derived = {}
+
+    for team, running_total, bags_total in (('team1', team1_total, team1_bags_total),
+                                            ('team2', team2_total, team2_bags_total)):
+        bid, actual = r[team + '_bid'], r[team + '_actual']
+        scored = rules.components(bid, actual, bool(r[team + '_nil_success']),
+                                  bool(r[team + '_blind_nil_success']), bool(r[team + '_blind_success']))
+
+        bags_earned = rules.bags_earned(bid, actual)
+        bags_before_penalty, bag_penalty, bags_total = rules.apply_bag_penalty(bags_total, bags_earned)
+
+        points = scored[-1] - bag_penalty
+        running_total += points
+
+        derived[team + '_points'] = points
+        derived[team + '_total'] = running_total
+        derived[team + '_bags_earned'] = bags_earned
+        derived[team + '_bags_total'] = bags_total
+        derived[team + '_bag_penalty'] = bag_penalty
+        derived[team + '_bags_before_penalty'] = bags_before_penalty
+        for component, value in zip(COMPONENTS[:-1], scored):
+            derived['{}_{}'.format(team, component)] = value
+
+        if team == 'team1':
+            team1_total, team1_bags_total = running_total, bags_total
+        else:
+            team2_total, team2_bags_total = running_total, bags_total
+
+    return derived, (team1_total, team2_total, team1_bags_total, team2_bags_total)
+
+def seed_state(conn, game_id, start_round_number):
+    """Running state after the last completed round before start_round_number"""
+    prev = conn.execute('''
+        SELECT round_number, team1_total, team2_total, team1_bags_total, team2_bags_total
+        FROM rounds WHERE game_id = ? AND round_number < ? AND team1_actual IS NOT NULL AND team1_total IS NOT NULL
+        ORDER BY round_number DESC LIMIT 1
+    ''', (game_id, start_round_number)).fetchone()
+    state = tuple(prev)[1:] if prev else (0, 0, 0, 0)
+    if DERIVED_ON_READ:
+        # Replay the rounds between the last checkpoint and start_round_number
+        game = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+        for r in conn.execute('''
+            SELECT * FROM rounds WHERE game_id = ? AND round_number > ? AND round_number < ?
+                                   AND team1_actual IS NOT NULL
+            ORDER BY round_number
+        ''', (game_id, prev['round_number'] if prev else 0, start_round_number)):
+            _, state = score_round(game, r, state)
+    return state
+
+def with_derived(game, rows):
+    """A game's rounds (all of them, in order) with every derived column: as
+    stored, or replayed from the raw inputs under derived-on-read storage"""
+    if not DERIVED_ON_READ:
+        return rows
+    state = (0, 0, 0, 0)
+    rounds = []
+    for row in rows:
+        r = dict(row)
+        if r['team1_actual'] is not None:
+            derived, state = score_round(game, r, state)
+            r.update(derived)
+        rounds.append(r)
+    return rounds
+
+def game_rounds(conn, game, from_round=1):
+    """A game's rounds from from_round onwards with every derived column,
+    replayed at most once per game version under derived-on-read storage"""
+    if not DERIVED_ON_READ:
+        return conn.execute('SELECT * FROM rounds WHERE game_id = ? AND round_number >= ? ORDER BY round_number',
+                            (game['id'], from_round)).fetchall()
+    key = (models.DATABASE, game['id'])
+    with _rounds_cache_lock:
+        cached = _rounds_cache.get(key)
+        if cached is not None and cached[0] == game['version']:
+            _rounds_cache.move_to_end(key)
+    if cached is None or cached[0] != game['version']:
+        rows = conn.execute('SELECT * FROM rounds WHERE game_id = ? ORDER BY round_number', (game['id'],))
+        cached = (game['version'], with_derived(game, rows))
+        # An open transaction may still roll back and its version be reused
+        if not conn.in_transaction:
+            with _rounds_cache_lock:
+                _rounds_cache[key] = cached
+                _rounds_cache.move_to_end(key)
+                while len(_rounds_cache) > ROUNDS_CACHE_GAMES:
+                    _rounds_cache.popitem(last=False)
+    return [r for r in cached[1] if r['round_number'] >= from_round]
+
+def recalculate_from_round(conn, game_id, start_round_number, converge=True):
+    """Recalculate round totals from a given round number onwards.
+    Call this after editing or deleting a round. Returns the number of rounds rewritten.
+
+    Pass converge=False when the game's scoring rules changed, since stored
+    rounds can then match the new running state and still be stale."""
+    game = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+    state = seed_state(conn, game_id, start_round_number)
+
+    cursor = conn.execute('''
+        SELECT * FROM rounds WHERE game_id = ? AND round_number >= ? AND team1_actual IS NOT NULL
+        ORDER BY round_number
+    ''', (game_id, start_round_number))
+
+    updates = []
+    for r in cursor:
+        derived, state = score_round(game, r, state)
+        values = stored_values(r['round_number'], tuple(derived[column] for column in DERIVED_COLUMNS))
+        if DERIVED_ON_READ:
+            # Only the state columns are ever stored. Rows without a checkpoint match
+            # trivially, so keep going to the end (a delete renumbers the rounds after
+            # it) and write only the rows that differ.
+            if any(r[column] != value for column, value, kept in zip(DERIVED_COLUMNS, values, CHECKPOINT_MASK) if kept):
+                updates.append(values + (r['id'],))
+            continue
+        if converge and all(r[column] == value for column, value in zip(DERIVED_COLUMNS, values)):
+            # Same running totals and bags as already stored - later rounds are unaffected
+            break
+        updates.append(values + (r['id'],))
+    cursor.close()
+
+    if updates:
+        conn.executemany(UPDATE_DERIVED_SQL, updates)
+
+    update_game_totals(conn, game, state if DERIVED_ON_READ else None)
+    return len(updates)
+
+def update_game_totals(conn, game, state=None):
+    """Copy the last completed round's totals onto the game and re-evaluate completion.
+    `state` is the running state after that round when it isn't stored on it."""
+    game_id = game['id']
+    last = conn.execute(
+        'SELECT * FROM rounds WHERE game_id = ? AND team1_actual IS NOT NULL ORDER BY round_number DESC LIMIT 1',
+        (game_id,)
+    ).fetchone()
+
+    if last:
+        team1_total, team2_total, team1_bags_total, team2_bags_total = state or (
+            last['team1_total'], last['team2_total'], last['team1_bags_total'], last['team2_bags_total'])
+        conn.execute('''
+            UPDATE games SET team1_final_score = ?, team2_final_score = ?,
+                             team1_bags = ?, team2_bags = ?
+            WHERE id = ?
+        ''', (team1_total, team2_total, team1_bags_total, team2_bags_total, game_id))
+
+        # Re-evaluate completion
+        if team1_total >= game['max_score'] or team2_total >= game['max_score']:
+            if team1_total >= game['max_score']:
+                winner = '{} & {}'.format(game['team1_player1'], game['team1_player2'])
+            else:
+                winner = '{} & {}'.format(game['team2_player1'], game['team2_player2'])
+            conn.execute(
+                "UPDATE games SET status = 'completed', winner = ?, completed_date = COALESCE(completed_date, ?) "
+                "WHERE id = ?",
+                (winner, datetime.now(), game_id)
+            )
+        else:
+            # Game may have been completed before the edit — reopen it
+            conn.execute(
+                "UPDATE games SET status = 'active', winner = NULL, completed_date = NULL WHERE id = ? AND status = 'completed'",
+                (game_id,)
+            )
+    else:
+        # All rounds deleted — reset game totals
+        conn.execute(
+            'UPDATE games SET team1_final_score = 0, team2_final_score = 0, team1_bags = 0, team2_bags = 0, status = \'active\', winner = NULL, completed_date = NULL WHERE id = ?',
+            (game_id,)
+        )
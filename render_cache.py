@@ -0,0 +1,90 @@
+"""
+In-process cache of rendered spectator pages.
+
+Entries are keyed by (kind, game id, share code, version), so a write to a
+game makes its old entries unreachable on its own; invalidate_game() just
+frees them early. The share code tells a deleted game's renderings apart from
+those of a new game that SQLite gives the same id.
+The cache is bounded both by entry count and by total size, and entries
+expire after a fixed time to live.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+class RenderCache:
+    """Bounded LRU of rendered bodies with size and time based eviction"""
+
+    def __init__(self, max_entries=256, max_bytes=16 * 1024 * 1024, ttl=300.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (body, expires_at)
+        self._bytes = 0
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    @staticmethod
+    def key(kind, game):
+        return (kind, game['id'], game['share_code'], game['version'])
+
+    def get(self, kind, game):
+        key = self.key(kind, game)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            body, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return body
+
+    def put(self, kind, game, body):
+        key = self.key(kind, game)
+        size = len(body)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, time.monotonic() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._counters['evictions'] += 1
+
+    def invalidate_game(self, game_id):
+        """Drop every cached rendering of game_id"""
+        with self._lock:
+            stale = [key for key in self._entries if key[1] == game_id]
+            for key in stale:
+                self._remove(key)
+            self._counters['invalidations'] += len(stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        body, _ = self._entries.pop(key)
+        self._bytes -= len(body)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        stats['max_entries'] = self.max_entries
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+spectator_cache = RenderCache()
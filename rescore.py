@@ -0,0 +1,287 @@
+"""
+Bulk re-scoring of stored rounds.
+
+Scoring rules live on each game (nil_penalty, blind_nil_penalty,
+bag_penalty_threshold, bag_penalty_points), and every round stores the
+points, running totals and bag state derived from them. When a game's rules
+change, or scoring.py is fixed, those stored values have to be rebuilt.
+
+rescore_games() loads the raw inputs of many games at once and recomputes
+every derived column in one vectorized NumPy pass, including the running
+totals and the bag-penalty carry: with cum = cumulative bags earned, a round
+incurs cum // threshold - previous_cum // threshold penalties and leaves
+cum % threshold bags. Only rows whose values actually changed are written
+back. NumPy is in requirements.txt; an install without it still works but
+falls back to scoring each round in a plain loop.
+With derived-on-read storage (see recalculate.py) only the checkpoints are
+written, so running it after switching modes converts the stored rounds.
+
+    python rescore.py                 # re-score every game
+    python rescore.py --game 12       # re-score one game
+    python rescore.py --benchmark     # compare the two engines
+"""
+import argparse
+import random
+import time
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from recalculate import DERIVED_COLUMNS, UPDATE_DERIVED_SQL, score_round, stored_values
+from scoring import BID_TYPES, parse_bid
+
+RULE_COLUMNS = ('nil_penalty', 'blind_nil_penalty', 'bag_penalty_threshold', 'bag_penalty_points')
+
+RAW_COLUMNS = ('team1_bid', 'team2_bid', 'team1_actual', 'team2_actual',
+               'team1_nil_success', 'team1_blind_nil_success', 'team1_blind_success',
+               'team2_nil_success', 'team2_blind_nil_success', 'team2_blind_success')
+
+BID_CODES = {bid_type: code for code, bid_type in enumerate(BID_TYPES)}
+
+def load_rounds(conn, game_ids):
+    """Raw inputs, stored derived columns and game rules for every completed round"""
+    placeholders = ', '.join('?' for _ in game_ids)
+    return conn.execute('''
+        SELECT r.id, r.game_id, r.round_number, {}, {}, {}
+        FROM rounds r JOIN games g ON g.id = r.game_id
+        WHERE r.game_id IN ({}) AND r.team1_actual IS NOT NULL
+        ORDER BY r.game_id, r.round_number
+    '''.format(', '.join('r.' + c for c in RAW_COLUMNS),
+               ', '.join('r.' + c for c in DERIVED_COLUMNS),
+               ', '.join('g.' + c for c in RULE_COLUMNS),
+               placeholders), list(game_ids)).fetchall()
+
+def compute_derived_python(rows):
+    """Derived columns for each row (ordered by game and round), one round at a time"""
+    results = []
+    game_id = None
+    for r in rows:
+        if r['game_id'] != game_id:
+            game_id, state = r['game_id'], (0, 0, 0, 0)
+        derived, state = score_round(r, r, state)
+        results.append(tuple(derived[column] for column in DERIVED_COLUMNS))
+    return results
+
+def _segmented_cumsum(values, starts):
+    """Cumulative sum that restarts at every index in `starts`"""
+    total = np.cumsum(values)
+    before = total - values
+    offsets = np.repeat(before[starts], np.diff(np.append(starts, len(values))))
+    return total - offsets
+
+def _score_team(cols, team, starts, nil_penalty, blind_nil_penalty, threshold, penalty_points):
+    parsed = {bid: parse_bid(bid) for bid in set(cols[team + '_bid'])}
+    bids = [parsed[bid] for bid in cols[team + '_bid']]
+    bid = np.array([value for value, _ in bids], dtype=np.int64)
+    kind = np.array([BID_CODES[bid_type] for _, bid_type in bids], dtype=np.int8)
+    actual = np.array(cols[team + '_actual'], dtype=np.int64)
+    nil_success = np.array([bool(v) for v in cols[team + '_nil_success']])
+    blind_nil_success = np.array([bool(v) for v in cols[team + '_blind_nil_success']])
+    blind_success = np.array([bool(v) for v in cols[team + '_blind_success']])
+
+    made = actual >= bid
+    regular_like = np.isin(kind, (BID_CODES['regular'], BID_CODES['combination_nil'],
+                                  BID_CODES['combination_blind_nil']))
+    blind = kind == BID_CODES['blind']
+    zero = np.zeros_like(bid)
+
+    bid_points = np.where(regular_like, np.where(made, bid * 10, -bid * 10),
+                          np.where(blind & blind_success, bid * 10, zero))
+    bag_points = np.where(regular_like & made, actual - bid,
+                          np.where(blind & blind_success, actual - bid, zero))
+    nil_bonus = np.select(
+        [kind == BID_CODES['nil'], kind == BID_CODES['combination_nil']],
+        [np.where(actual == 0, nil_penalty, -nil_penalty), np.where(nil_success, nil_penalty, -nil_penalty)],
+        zero)
+    blind_nil_bonus = np.select(
+        [kind == BID_CODES['blind_nil'], kind == BID_CODES['combination_blind_nil']],
+        [np.where(actual == 0, blind_nil_penalty, -blind_nil_penalty),
+         np.where(blind_nil_success, blind_nil_penalty, -blind_nil_penalty)],
+        zero)
+    blind_bonus = np.where(blind, np.where(blind_success, bid * 10, -bid * 20), zero)
+    round_points = bid_points + nil_bonus + blind_nil_bonus + blind_bonus
+
+    # Bag carry: penalties are the threshold crossings of the cumulative bag count
+    bags_earned = np.maximum(0, actual - bid)
+    cum_bags = _segmented_cumsum(bags_earned, starts)
+    prev_bags = cum_bags - bags_earned
+    has_penalty = threshold > 0
+    safe_threshold = np.where(has_penalty, threshold, 1)
+    penalties = np.where(has_penalty, cum_bags // safe_threshold - prev_bags // safe_threshold, 0)
+    bags_total = np.where(has_penalty, cum_bags % safe_threshold, cum_bags)
+    bags_before_penalty = np.where(has_penalty, prev_bags % safe_threshold, prev_bags) + bags_earned
+
+    bag_penalty = penalties * penalty_points
+    points = round_points - bag_penalty
+
+    return {
+        team + '_points': points,
+        team + '_total': _segmented_cumsum(points, starts),
+        team + '_bags_earned': bags_earned,
+        team + '_bags_total': bags_total,
+        team + '_bag_penalty': bag_penalty,
+        team + '_bags_before_penalty': bags_before_penalty,
+        team + '_bid_points': bid_points,
+        team + '_nil_bonus': nil_bonus,
+        team + '_blind_nil_bonus': blind_nil_bonus,
+        team + '_blind_bonus': blind_bonus,
+        team + '_bag_points': bag_points,
+    }
+
+def compute_derived_numpy(rows):
+    """Derived columns for each row (ordered by game and round) in one vectorized pass"""
+    if not rows:
+        return []
+    cols = {name: [r[name] for r in rows] for name in ('game_id',) + RAW_COLUMNS + RULE_COLUMNS}
+
+    game_ids = np.array(cols['game_id'], dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], game_ids[1:] != game_ids[:-1])))
+    rules = [np.array(cols[name], dtype=np.int64) for name in RULE_COLUMNS]
+
+    derived = {}
+    derived.update(_score_team(cols, 'team1', starts, *rules))
+    derived.update(_score_team(cols, 'team2', starts, *rules))
+    matrix = np.column_stack([derived[column] for column in DERIVED_COLUMNS])
+    return [tuple(row) for row in matrix.tolist()]
+
+def compute_derived(rows, use_numpy=None):
+    if use_numpy is None:
+        use_numpy = np is not None
+    if use_numpy:
+        return compute_derived_numpy(rows)
+    return compute_derived_python(rows)
+
+def _update_games(conn, game_ids, finals):
+    """Refresh game totals and completion from each game's last computed round"""
+    placeholders = ', '.join('?' for _ in game_ids)
+    games = conn.execute('SELECT * FROM games WHERE id IN ({})'.format(placeholders), list(game_ids)).fetchall()
+
+    totals, completed, reopened = [], [], []
+    for game in games:
+        team1_total, team2_total, team1_bags, team2_bags = finals.get(game['id'], (0, 0, 0, 0))
+        if (game['team1_final_score'], game['team2_final_score'], game['team1_bags'], game['team2_bags']) != \
+                (team1_total, team2_total, team1_bags, team2_bags):
+            totals.append((team1_total, team2_total, team1_bags, team2_bags, game['id']))
+
+        # Same rules as recalculate.update_game_totals(): a re-score can change who won
+        won = team1_total >= game['max_score'] or team2_total >= game['max_score']
+        if won:
+            if team1_total >= game['max_score']:
+                winner = '{} & {}'.format(game['team1_player1'], game['team1_player2'])
+            else:
+                winner = '{} & {}'.format(game['team2_player1'], game['team2_player2'])
+            if (game['status'], game['winner']) != ('completed', winner):
+                completed.append((winner, datetime.now(), game['id']))
+        elif game['status'] == 'completed':
+            reopened.append((game['id'],))
+
+    conn.executemany('UPDATE games SET team1_final_score = ?, team2_final_score = ?, team1_bags = ?, team2_bags = ? WHERE id = ?',
+                     totals)
+    conn.executemany("UPDATE games SET status = 'completed', winner = ?, completed_date = COALESCE(completed_date, ?) WHERE id = ?",
+                     completed)
+    conn.executemany("UPDATE games SET status = 'active', winner = NULL, completed_date = NULL WHERE id = ?", reopened)
+    return len(totals) + len(completed) + len(reopened)
+
+def rescore_games(conn, game_ids=None, batch_size=500, use_numpy=None):
+    """Recompute every derived round column for game_ids (default: all games).
+    Writes only changed rows; the caller commits. Returns a summary dict."""
+    if game_ids is None:
+        game_ids = [row[0] for row in conn.execute('SELECT id FROM games ORDER BY id')]
+    game_ids = list(game_ids)
+
+    summary = {'games': len(game_ids), 'rounds': 0, 'rounds_rewritten': 0, 'games_updated': 0}
+    for i in range(0, len(game_ids), batch_size):
+        batch = game_ids[i:i + batch_size]
+        rows = load_rounds(conn, batch)
+        derived = compute_derived(rows, use_numpy)
+
+        updates = []
+        finals = {}
+        for r, values in zip(rows, derived):
+            stored = stored_values(r['round_number'], values)
+            if tuple(r[column] for column in DERIVED_COLUMNS) != stored:
+                updates.append(stored + (r['id'],))
+            finals[r['game_id']] = (values[2], values[3], values[6], values[7])
+
+        conn.executemany(UPDATE_DERIVED_SQL, updates)
+        summary['rounds'] += len(rows)
+        summary['rounds_rewritten'] += len(updates)
+        summary['games_updated'] += _update_games(conn, batch, finals)
+    return summary
+
+def synthetic_rounds(games=200, rounds_per_game=25, seed=1):
+    """Random but valid round inputs for benchmarking, ordered by game and round"""
+    rng = random.Random(seed)
+    rows = []
+    for game_id in range(1, games + 1):
+        rules = {'nil_penalty': rng.choice((50, 100)), 'blind_nil_penalty': rng.choice((100, 200)),
+                 'bag_penalty_threshold': rng.choice((5, 10)), 'bag_penalty_points': 100}
+        for _ in range(rounds_per_game):
+            row = {'game_id': game_id}
+            row.update(rules)
+            team1_actual = rng.randint(0, 13)
+            for team, actual in (('team1', team1_actual), ('team2', 13 - team1_actual)):
+                bid = rng.randint(1, 7)
+                row[team + '_bid'] = rng.choice((str(bid), str(bid), str(bid), '{}b'.format(bid), '0n',
+                                                 '{}n'.format(bid), '0bn', '{}bn'.format(bid)))
+                row[team + '_actual'] = actual
+                for flag in ('_nil_success', '_blind_nil_success', '_blind_success'):
+                    row[team + flag] = rng.random() < 0.5
+            rows.append(row)
+    return rows
+
+def benchmark(games=200, rounds_per_game=25, repeat=3):
+    """Time the vectorized engine against the per-round loop on synthetic data"""
+    rows = synthetic_rounds(games, rounds_per_game)
+    print("Re-scoring {} rounds across {} games".format(len(rows), games))
+
+    timings = {}
+    engines = [('loop', compute_derived_python)]
+    if np is not None:
+        engines.append(('numpy', compute_derived_numpy))
+    else:
+        print("NumPy is not installed; only the loop engine is available")
+
+    results = {}
+    for name, engine in engines:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results[name] = engine(rows)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+        print("  {:<6} {:8.1f} ms  ({:.2f} us/round)".format(name, best * 1000, best * 1e6 / len(rows)))
+
+    if 'numpy' in results:
+        assert results['numpy'] == results['loop'], "Engines disagree"
+        print("  speedup {:.1f}x".format(timings['loop'] / timings['numpy']))
+    return timings
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Re-score stored rounds from their raw inputs')
+    parser.add_argument('--game', type=int, action='append', help='Game id to re-score (repeatable; default all)')
+    parser.add_argument('--python', action='store_true', help='Use the per-round loop instead of NumPy')
+    parser.add_argument('--benchmark', action='store_true', help='Compare the engines on synthetic data')
+    parser.add_argument('--games', type=int, default=200, help='Synthetic games for --benchmark')
+    parser.add_argument('--rounds', type=int, default=25, help='Rounds per synthetic game for --benchmark')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.games, args.rounds)
+    else:
+        from models import get_db_connection
+        import stats
+        conn = get_db_connection()
+        start = time.perf_counter()
+        summary = rescore_games(conn, args.game, use_numpy=False if args.python else None)
+        # Bag penalties and winners may have changed under the player statistics
+        stats.rebuild(conn)
+        conn.commit()
+        conn.close()
+        print("Re-scored {rounds} rounds in {games} games: {rounds_rewritten} rounds and "
+              "{games_updated} game rows changed".format(**summary))
+        print("Took {:.2f}s".format(time.perf_counter() - start))
@@ -0,0 +1,214 @@
+"""
+Append-only log of round changes, with snapshots and undo.
+
+The rounds table stays the current state that every page reads; next to it
+each game gets a numbered list of events in `round_events`, one per change
+a scorekeeper makes: bids entered or changed, scores entered, a round
+edited or deleted, or an undo. An event holds the round number and the
+round's raw inputs before and after the change (NULL for a round that
+didn't exist yet or no longer does), so applying one is a single list
+insert, replace or delete - the derived scores are always worked out by
+recalculate.score_round().
+
+Every SNAPSHOT_INTERVAL-th event also stores the game's rounds as they
+stand in `round_snapshots`. replay() rebuilds the rounds at any point in
+the log from the nearest snapshot at or before it, so going back to event
+N of a 500-event game costs at most SNAPSHOT_INTERVAL - 1 events, not N.
+Games whose rounds existed before their first logged change (older games,
+imports, seed data) get a snapshot of those rounds as event 0.
+
+Undo reverts the last change that hasn't been undone. Each event records
+which change an undo at that point would revert (undo_seq), so finding it
+takes two primary key lookups whatever the length of the log. The undo is
+itself appended as an event that swaps the reverted change's before and
+after, so the log is never rewritten and undoing repeatedly walks further
+back.
+"""
+import argparse
+import json
+
+from recalculate import NOT_STORED, UPDATE_DERIVED_SQL, recalculate_from_round, score_round
+
+SNAPSHOT_INTERVAL = 32
+
+# What an event keeps of a round: its identity and raw inputs, not the scores
+IMAGE_COLUMNS = (
+    'id', 'team1_bid', 'team2_bid', 'team1_actual', 'team2_actual',
+    'team1_nil_success', 'team1_blind_nil_success', 'team1_blind_success',
+    'team2_nil_success', 'team2_blind_nil_success', 'team2_blind_success',
+    'created_date',
+)
+
+# Rounds are found by their place in the game, not by the logged id: a deleted
+# round's id is free for SQLite to give to any game's next round
+RESTORE_ROUND_SQL = 'UPDATE rounds SET {} WHERE game_id = ? AND round_number = ?'.format(
+    ', '.join('{} = ?'.format(column) for column in IMAGE_COLUMNS[1:]))
+
+INSERT_ROUND_SQL = 'INSERT INTO rounds (game_id, round_number, {}) VALUES (?, ?, {})'.format(
+    ', '.join(IMAGE_COLUMNS), ', '.join('?' for _ in IMAGE_COLUMNS))
+
+def image(row):
+    """The logged form of a round row (None stays None)"""
+    return None if row is None else {column: row[column] for column in IMAGE_COLUMNS}
+
+def round_image(conn, round_id):
+    return image(conn.execute('SELECT * FROM rounds WHERE id = ?', (round_id,)).fetchone())
+
+def current_rounds(conn, game_id):
+    """The game's rounds as the log sees them, in round order"""
+    return [image(row) for row in conn.execute('SELECT * FROM rounds WHERE game_id = ? ORDER BY round_number',
+                                               (game_id,))]
+
+def encode(value):
+    return None if value is None else json.dumps(value, separators=(',', ':'))
+
+def decode(text):
+    return None if text is None else json.loads(text)
+
+def apply(rounds, round_number, before, after):
+    """Apply one event to a list of round images, in place"""
+    if before is None:
+        rounds.insert(round_number - 1, after)
+    elif after is None:
+        del rounds[round_number - 1]
+    else:
+        rounds[round_number - 1] = after
+
+def last_event(conn, game_id):
+    return conn.execute('SELECT * FROM round_events WHERE game_id = ? ORDER BY seq DESC LIMIT 1',
+                        (game_id,)).fetchone()
+
+def event(conn, game_id, seq):
+    return conn.execute('SELECT * FROM round_events WHERE game_id = ? AND seq = ?', (game_id, seq)).fetchone()
+
+def snapshot(conn, game_id, seq, rounds):
+    conn.execute('INSERT OR REPLACE INTO round_snapshots (game_id, seq, rounds) VALUES (?, ?, ?)',
+                 (game_id, seq, encode(rounds)))
+
+def append(conn, game_id, seq, action, round_number, before, after, undo_seq):
+    conn.execute('''
+        INSERT INTO round_events (game_id, seq, action, round_number, before, after, undo_seq)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (game_id, seq, action, round_number, encode(before), encode(after), undo_seq))
+    if seq % SNAPSHOT_INTERVAL == 0:
+        snapshot(conn, game_id, seq, current_rounds(conn, game_id))
+
+def record(conn, game_id, action, round_number, before, after):
+    """Log a change the caller has just made to the rounds table: `before` and
+    `after` are the round's images (see image()) either side of it"""
+    last = last_event(conn, game_id)
+    if last is None:
+        # First logged change: keep the rounds from before it as event 0
+        rounds = current_rounds(conn, game_id)
+        apply(rounds, round_number, after, before)
+        if rounds:
+            snapshot(conn, game_id, 0, rounds)
+    seq = last['seq'] + 1 if last else 1
+    append(conn, game_id, seq, action, round_number, before, after, seq)
+    return seq
+
+def replay(conn, game_id, seq=None):
+    """The game's rounds (as images, with round_number) after event `seq`, or
+    after the latest one, rebuilt from the nearest snapshot"""
+    last = last_event(conn, game_id)
+    if last is None:
+        # Nothing logged yet: the rounds table is the whole story
+        rounds = current_rounds(conn, game_id)
+    else:
+        seq = last['seq'] if seq is None else seq
+        start = conn.execute('''
+            SELECT seq, rounds FROM round_snapshots WHERE game_id = ? AND seq <= ?
+            ORDER BY seq DESC LIMIT 1
+        ''', (game_id, seq)).fetchone()
+        rounds = decode(start['rounds']) if start else []
+        for e in conn.execute('''
+            SELECT round_number, before, after FROM round_events WHERE game_id = ? AND seq > ? AND seq <= ?
+            ORDER BY seq
+        ''', (game_id, start['seq'] if start else 0, seq)):
+            apply(rounds, e['round_number'], decode(e['before']), decode(e['after']))
+    return [dict(r, round_number=n) for n, r in enumerate(rounds, 1)]
+
+def game_state(conn, game_id, seq=None, through_round=None):
+    """The game as of event `seq` (default: now), optionally only up to round
+    `through_round`: (rounds with their scores, running state after them).
+    Scored under the game's current rules."""
+    game = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+    rounds = replay(conn, game_id, seq)[:through_round]
+    state = (0, 0, 0, 0)
+    for r in rounds:
+        if r['team1_actual'] is not None:
+            derived, state = score_round(game, r, state)
+            r.update(derived)
+    return rounds, state
+
+def restore(conn, game_id, round_number, before, after):
+    """Make the rounds table match an event (from `before` to `after`) and rescore from that round.
+    Returns `after` with the id the round has now (a re-inserted round keeps its
+    old id unless another round has been given it since)."""
+    if after is None:
+        conn.execute('DELETE FROM rounds WHERE game_id = ? AND round_number = ?', (game_id, round_number))
+        conn.execute('UPDATE rounds SET round_number = round_number - 1 WHERE game_id = ? AND round_number > ?',
+                     (game_id, round_number))
+        recalculate_from_round(conn, game_id, round_number)
+        return None
+    if before is None:
+        if conn.execute('SELECT 1 FROM rounds WHERE id = ?', (after['id'],)).fetchone():
+            after = dict(after, id=None)
+        conn.execute('UPDATE rounds SET round_number = round_number + 1 WHERE game_id = ? AND round_number >= ?',
+                     (game_id, round_number))
+        round_id = conn.execute(INSERT_ROUND_SQL, (game_id, round_number) +
+                                tuple(after[column] for column in IMAGE_COLUMNS)).lastrowid
+        after = dict(after, id=round_id)
+    else:
+        conn.execute(RESTORE_ROUND_SQL, tuple(after[column] for column in IMAGE_COLUMNS[1:]) + (game_id, round_number))
+        after = dict(after, id=conn.execute('SELECT id FROM rounds WHERE game_id = ? AND round_number = ?',
+                                            (game_id, round_number)).fetchone()[0])
+    if before is None or after['team1_actual'] is None:
+        # A restored round, or one back to waiting for scores: no scores stored until recalculated
+        conn.execute(UPDATE_DERIVED_SQL, NOT_STORED + (after['id'],))
+    recalculate_from_round(conn, game_id, round_number)
+    return after
+
+def undo(conn, game_id):
+    """Revert the game's last change that hasn't been undone.
+    Returns (action, round_number, before, after) with the round's images
+    either side of the undo, or None if there is nothing to undo."""
+    last = last_event(conn, game_id)
+    if last is None or last['undo_seq'] is None:
+        return None
+    target = event(conn, game_id, last['undo_seq'])
+    # After this undo, the next one reverts whatever the change before the target left to undo
+    previous = event(conn, game_id, target['seq'] - 1)
+    before, after = decode(target['after']), decode(target['before'])
+    after = restore(conn, game_id, target['round_number'], before, after)
+    append(conn, game_id, last['seq'] + 1, 'undo', target['round_number'], before, after,
+           previous['undo_seq'] if previous else None)
+    return target['action'], target['round_number'], before, after
+
+def can_undo(conn, game_id):
+    last = last_event(conn, game_id)
+    return last is not None and last['undo_seq'] is not None
+
+def forget(conn, game_id):
+    """Drop a deleted game's log"""
+    conn.execute('DELETE FROM round_events WHERE game_id = ?', (game_id,))
+    conn.execute('DELETE FROM round_snapshots WHERE game_id = ?', (game_id,))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show a game's round log, or the game as of a point in it")
+    parser.add_argument('game_id', type=int)
+    parser.add_argument('--at', type=int, metavar='SEQ', help='As of this event (default: now)')
+    parser.add_argument('--round', type=int, metavar='N', help='Only up to round N')
+    args = parser.parse_args()
+
+    from models import get_db_connection
+    conn = get_db_connection()
+    if args.at is None and args.round is None:
+        for e in conn.execute('SELECT * FROM round_events WHERE game_id = ? ORDER BY seq', (args.game_id,)):
+            print("{:>5} {:<7} round {:<3} {}".format(e['seq'], e['action'], e['round_number'], e['created_date']))
+    rounds, (team1_total, team2_total, team1_bags, team2_bags) = game_state(conn, args.game_id, args.at, args.round)
+    conn.close()
+    for r in rounds:
+        print("Round {:>3}: {} / {} bid, {} / {} taken".format(
+            r['round_number'], r['team1_bid'], r['team2_bid'], r['team1_actual'], r['team2_actual']))
+    print("Score {} - {}, bags {} - {}".format(team1_total, team2_total, team1_bags, team2_bags))
@@ -1,3 +1,14 @@
+from functools import lru_cache
+
+# Bid types in the order RuleSet lookup tables are laid out
+BID_TYPES = ('regular', 'blind', 'nil', 'blind_nil', 'combination_nil', 'combination_blind_nil')
+
+# Scoring components of one team's round, in the order RuleSet returns them
+COMPONENTS = ('bid_points', 'nil_bonus', 'blind_nil_bonus', 'blind_bonus', 'bag_points', 'total_points')
+
+MAX_TRICKS = 13
+
+@lru_cache(maxsize=1024)
 def parse_bid(bid_string):
     """Parse bid string format: '7', '4b', '0n', '0bn', '4n' (combination)"""
     if bid_string.endswith('bn'):
@@ -17,164 +28,151 @@ def parse_bid(bid_string):
     else:
         return int(bid_string), 'regular'
 
-def calculate_round_points_with_flags(bid_string, actual_tricks, game, nil_success=False, blind_nil_success=False, blind_success=False):
-    """Calculate points for a round with explicit success/failure flags for special bids"""
-    bid_value, bid_type = parse_bid(bid_string)
-    
+# Which success flag (nil, blind nil, blind) decides each bid type; None if tricks alone do
+FLAG_SLOT = {'regular': None, 'blind': 2, 'nil': None, 'blind_nil': None,
+             'combination_nil': 0, 'combination_blind_nil': 1}
+
+def _score_components(bid_value, bid_type, actual_tricks, success, nil_penalty, blind_nil_penalty):
+    """Score one team's round. `success` is the flag FLAG_SLOT picks for bid_type.
+    Returns a tuple in COMPONENTS order."""
+    bid_points = nil_bonus = blind_nil_bonus = blind_bonus = bag_points = 0
+
     if bid_type == 'nil':
         # Pure nil bid
-        return game['nil_penalty'] if actual_tricks == 0 else -game['nil_penalty']
-    
-    elif bid_type == 'combination_nil':
-        # Combination nil bid (e.g., "4n" = one player nil, other bids 4)
-        base_points = 0
-        if actual_tricks >= bid_value:
-            base_points = (bid_value * 10) + (actual_tricks - bid_value)
-        else:
-            base_points = -(bid_value * 10)
-        
-        # Add nil bonus/penalty based on success flag
-        nil_bonus = game['nil_penalty'] if nil_success else -game['nil_penalty']
-        return base_points + nil_bonus
-    
-    elif bid_type == 'combination_blind_nil':
-        # Combination blind nil bid (e.g., "4bn" = one player blind nil, other bids 4)
-        base_points = 0
-        if actual_tricks >= bid_value:
-            base_points = (bid_value * 10) + (actual_tricks - bid_value)
-        else:
-            base_points = -(bid_value * 10)
-        
-        # Add blind nil bonus/penalty based on success flag
-        blind_nil_bonus = game['blind_nil_penalty'] if blind_nil_success else -game['blind_nil_penalty']
-        return base_points + blind_nil_bonus
-    
+        nil_bonus = nil_penalty if actual_tricks == 0 else -nil_penalty
+
     elif bid_type == 'blind_nil':
         # Pure blind nil bid
-        return game['blind_nil_penalty'] if actual_tricks == 0 else -game['blind_nil_penalty']
-    
+        blind_nil_bonus = blind_nil_penalty if actual_tricks == 0 else -blind_nil_penalty
+
     elif bid_type == 'blind':
         # Blind bid (doubled points/penalties)
-        if blind_success:
-            # Successful blind bid: doubled points + overtricks
-            return (bid_value * 10 * 2) + (actual_tricks - bid_value)
-        else:
-            # Failed blind bid: doubled penalty
-            return -(bid_value * 10 * 2)
-    
-    else:  # 'regular'
-        # Standard bid
-        if actual_tricks >= bid_value:
-            return (bid_value * 10) + (actual_tricks - bid_value)
+        if success:
+            # Split into base bid and blind bonus for clearer display
+            bid_points = bid_value * 10
+            blind_bonus = bid_value * 10  # Additional doubling bonus
+            bag_points = actual_tricks - bid_value
         else:
-            return -(bid_value * 10)
+            # Failed blind bid: show as blind penalty only
+            blind_bonus = -(bid_value * 10 * 2)
 
-def calculate_round_points(bid_string, actual_tricks, game):
-    """Calculate points for a round based on bid and actual tricks"""
-    bid_value, bid_type = parse_bid(bid_string)
-    
-    if bid_type == 'nil':
-        # Nil bid
-        if actual_tricks == 0:
-            return game['nil_penalty']  # Successful nil
-        else:
-            # Failed nil - handle based on game configuration
-            base_penalty = -game['nil_penalty']
-            
-            if game['failed_nil_handling'] == 'takes_bags':
-                # Failed nil tricks count as bags (handled in main logic)
-                return base_penalty
-            elif game['failed_nil_handling'] == 'helps_team':
-                # Failed nil tricks help partner (handled in main logic)
-                return base_penalty
-            else:  # 'no_effect'
-                # Failed nil tricks ignored
-                return base_penalty
-    
-    elif bid_type == 'combination_nil':
-        # Combination bid (e.g., "4n" = one player bids nil, other bids 4)
-        # Score as regular bid + nil bonus if successful
-        base_points = 0
-        if actual_tricks >= bid_value:
-            base_points = (bid_value * 10) + (actual_tricks - bid_value)
-        else:
-            base_points = -(bid_value * 10)
-        
-        # Add nil bonus (assuming nil player took 0 tricks)
-        # This is simplified - in reality you'd need to track individual player performance
-        nil_bonus = game['nil_penalty']
-        return base_points + nil_bonus
-    
-    elif bid_type == 'combination_blind_nil':
-        # Combination blind nil bid (e.g., "4bn" = one player bids blind nil, other bids 4)
-        # Score as regular bid + blind nil bonus if successful
-        base_points = 0
-        if actual_tricks >= bid_value:
-            base_points = (bid_value * 10) + (actual_tricks - bid_value)
-        else:
-            base_points = -(bid_value * 10)
-        
-        # Add blind nil bonus (assuming blind nil player took 0 tricks)
-        # This is simplified - in reality you'd need to track individual player performance
-        blind_nil_bonus = game['blind_nil_penalty']
-        return base_points + blind_nil_bonus
-    
-    elif bid_type == 'blind_nil':
-        # Blind nil bid
-        if actual_tricks == 0:
-            return game['blind_nil_penalty']  # Successful blind nil
-        else:
-            # Failed blind nil - same handling as regular nil
-            base_penalty = -game['blind_nil_penalty']
-            
-            if game['failed_nil_handling'] == 'takes_bags':
-                return base_penalty
-            elif game['failed_nil_handling'] == 'helps_team':
-                return base_penalty
-            else:  # 'no_effect'
-                return base_penalty
-    
-    elif bid_type == 'blind':
-        # Blind bid (not nil) - doubled points/penalties
-        if actual_tricks >= bid_value:
-            return (bid_value * 10 * 2) + (actual_tricks - bid_value)
-        else:
-            return -(bid_value * 10 * 2)
-    
-    else:  # 'regular'
-        # Standard bid
+    else:
+        # Regular bid, or the partner's bid in a combination nil (e.g., "4n") / blind nil (e.g., "4bn")
         if actual_tricks >= bid_value:
-            return (bid_value * 10) + (actual_tricks - bid_value)
+            bid_points = bid_value * 10
+            bag_points = actual_tricks - bid_value
         else:
-            return -(bid_value * 10)
+            bid_points = -(bid_value * 10)
 
-def calculate_bags_earned(bid_string, actual_tricks, game):
-    """Calculate bags earned this round"""
-    bid_value, bid_type = parse_bid(bid_string)
-    
-    if bid_type in ['nil', 'blind_nil']:
-        if actual_tricks == 0:
-            return 0  # Successful nil/blind nil
+        if bid_type == 'combination_nil':
+            nil_bonus = nil_penalty if success else -nil_penalty
+        elif bid_type == 'combination_blind_nil':
+            blind_nil_bonus = blind_nil_penalty if success else -blind_nil_penalty
+
+    # IMPORTANT: total_points should NOT include bag_points
+    # Bags are tracked separately and displayed in the ones digit
+    total_points = bid_points + nil_bonus + blind_nil_bonus + blind_bonus
+    return bid_points, nil_bonus, blind_nil_bonus, blind_bonus, bag_points, total_points
+
+class RuleSet:
+    """A game's scoring rules compiled into lookup tables.
+
+    Every (bid type, bid value, tricks 0-13, success flag) outcome is scored
+    once up front, and bag penalties are applied with divmod() instead of one
+    threshold at a time. Use RuleSet.for_game(game), which shares one compiled
+    instance between all games with the same rules.
+    """
+
+    def __init__(self, nil_penalty, blind_nil_penalty, bag_penalty_threshold, bag_penalty_points):
+        self.nil_penalty = nil_penalty
+        self.blind_nil_penalty = blind_nil_penalty
+        self.bag_penalty_threshold = bag_penalty_threshold
+        self.bag_penalty_points = bag_penalty_points
+
+        # Outcomes of each (bid type, bid value), indexed by tricks * 2 + success
+        size = MAX_TRICKS + 1
+        self._table = {
+            (bid_type, bid_value): tuple(
+                _score_components(bid_value, bid_type, tricks, success, nil_penalty, blind_nil_penalty)
+                for tricks in range(size) for success in (False, True))
+            for bid_type in BID_TYPES
+            for bid_value in range(size)
+        }
+
+        # Canonical bid strings ('7', '4b', '0n', '0bn', '4n', '4bn') resolved up front
+        self._bids = {}
+        for bid_value in range(size):
+            for suffix in ('', 'b', 'n', 'bn'):
+                bid_string = '{}{}'.format(bid_value, suffix)
+                self._bids[bid_string] = self._resolve(bid_string)
+
+    @classmethod
+    def for_game(cls, game):
+        return _compiled_rules((game['nil_penalty'], game['blind_nil_penalty'],
+                                game['bag_penalty_threshold'], game['bag_penalty_points']))
+
+    def _resolve(self, bid_string):
+        """(outcomes or None if the bid is off the table, flag slot, bid value, bid type)"""
+        bid_value, bid_type = parse_bid(bid_string)
+        return self._table.get((bid_type, bid_value)), FLAG_SLOT[bid_type], bid_value, bid_type
+
+    def components(self, bid_string, actual_tricks, nil_success=False, blind_nil_success=False, blind_success=False):
+        """Scoring components as a tuple in COMPONENTS order"""
+        outcomes, slot, bid_value, bid_type = self._bids.get(bid_string) or self._resolve(bid_string)
+        if slot is None:
+            success = False
+        elif slot == 0:
+            success = bool(nil_success)
+        elif slot == 1:
+            success = bool(blind_nil_success)
         else:
-            # Failed nil/blind nil
-            if game['failed_nil_handling'] == 'takes_bags':
-                return actual_tricks
-            elif game['failed_nil_handling'] == 'helps_team':
-                return 0  # Tricks help partner, don't count as bags
-            else:  # 'no_effect'
-                return 0  # Tricks ignored
-    
-    elif bid_type == 'combination_nil':
-        # Combination bid - bags are calculated like regular bids
-        return max(0, actual_tricks - bid_value)
-    
-    elif bid_type == 'combination_blind_nil':
-        # Combination blind nil bid - bags are calculated like regular bids
-        return max(0, actual_tricks - bid_value)
-    
-    else:
-        # Regular or blind bid
-        return max(0, actual_tricks - bid_value)
+            success = bool(blind_success)
+
+        if outcomes is not None and 0 <= actual_tricks <= MAX_TRICKS:
+            return outcomes[actual_tricks * 2 + success]
+        return _score_components(bid_value, bid_type, actual_tricks, success,
+                                 self.nil_penalty, self.blind_nil_penalty)
+
+    def points_with_flags(self, bid_string, actual_tricks, nil_success=False, blind_nil_success=False, blind_success=False):
+        """Round points including overtricks, using explicit success flags"""
+        scored = self.components(bid_string, actual_tricks, nil_success, blind_nil_success, blind_success)
+        return scored[5] + scored[4]
+
+    def points(self, bid_string, actual_tricks):
+        """Round points including overtricks, assuming nil partners took no tricks
+        and a blind bid succeeded whenever enough tricks were taken"""
+        bid_value = self.bid_value(bid_string)
+        return self.points_with_flags(bid_string, actual_tricks, True, True, actual_tricks >= bid_value)
+
+    def bid_value(self, bid_string):
+        return (self._bids.get(bid_string) or self._resolve(bid_string))[2]
+
+    def bags_earned(self, bid_string, actual_tricks):
+        return max(0, actual_tricks - self.bid_value(bid_string))
+
+    def apply_bag_penalty(self, bags_total, bags_earned):
+        """Add this round's bags to the running count.
+        Returns (bags_before_penalty, bag_penalty, bags_total)."""
+        bags_before_penalty = bags_total + bags_earned
+        threshold = self.bag_penalty_threshold
+        if threshold <= 0 or bags_before_penalty < threshold:
+            return bags_before_penalty, 0, bags_before_penalty
+
+        # One penalty for each complete set of bags (e.g., 23 bags = 2 penalties, 3 remaining)
+        penalties, remaining = divmod(bags_before_penalty, threshold)
+        return bags_before_penalty, penalties * self.bag_penalty_points, remaining
+
+@lru_cache(maxsize=64)
+def _compiled_rules(rules):
+    return RuleSet(*rules)
+
+def calculate_round_points_with_flags(bid_string, actual_tricks, game, nil_success=False, blind_nil_success=False, blind_success=False):
+    """Calculate points for a round with explicit success/failure flags for special bids"""
+    return RuleSet.for_game(game).points_with_flags(bid_string, actual_tricks, nil_success, blind_nil_success, blind_success)
+
+def calculate_round_points(bid_string, actual_tricks, game):
+    """Calculate points for a round based on bid and actual tricks"""
+    return RuleSet.for_game(game).points(bid_string, actual_tricks)
 
 def format_bid_display(bid_string):
     """Format bid string for display"""
@@ -291,79 +289,13 @@ def get_score_breakdown_detailed(round_data):
 
 def calculate_detailed_round_scoring(bid_string, actual_tricks, game, nil_success=False, blind_nil_success=False, blind_success=False):
     """Calculate detailed scoring components for database storage"""
-    bid_value, bid_type = parse_bid(bid_string)
-    
-    # Initialize all components
-    components = {
-        'bid_points': 0,
-        'nil_bonus': 0,
-        'blind_nil_bonus': 0,
-        'blind_bonus': 0,
-        'bag_points': 0,
-        'total_points': 0
+    bid_points, nil_bonus, blind_nil_bonus, blind_bonus, bag_points, total_points = RuleSet.for_game(game).components(
+        bid_string, actual_tricks, nil_success, blind_nil_success, blind_success)
+    return {
+        'bid_points': bid_points,
+        'nil_bonus': nil_bonus,
+        'blind_nil_bonus': blind_nil_bonus,
+        'blind_bonus': blind_bonus,
+        'bag_points': bag_points,
+        'total_points': total_points
     }
-    
-    if bid_type == 'nil':
-        # Pure nil bid
-        components['nil_bonus'] = game['nil_penalty'] if actual_tricks == 0 else -game['nil_penalty']
-        components['total_points'] = components['nil_bonus']
-        
-    elif bid_type == 'combination_nil':
-        # Combination nil bid (e.g., "4n")
-        # Base bid scoring
-        if actual_tricks >= bid_value:
-            components['bid_points'] = bid_value * 10
-            components['bag_points'] = actual_tricks - bid_value
-        else:
-            components['bid_points'] = -(bid_value * 10)
-
-        # Nil bonus/penalty
-        components['nil_bonus'] = game['nil_penalty'] if nil_success else -game['nil_penalty']
-        # IMPORTANT: total_points should NOT include bag_points (tracked separately)
-        components['total_points'] = components['bid_points'] + components['nil_bonus']
-        
-    elif bid_type == 'combination_blind_nil':
-        # Combination blind nil bid (e.g., "4bn")
-        # Base bid scoring
-        if actual_tricks >= bid_value:
-            components['bid_points'] = bid_value * 10
-            components['bag_points'] = actual_tricks - bid_value
-        else:
-            components['bid_points'] = -(bid_value * 10)
-
-        # Blind nil bonus/penalty
-        components['blind_nil_bonus'] = game['blind_nil_penalty'] if blind_nil_success else -game['blind_nil_penalty']
-        # IMPORTANT: total_points should NOT include bag_points (tracked separately)
-        components['total_points'] = components['bid_points'] + components['blind_nil_bonus']
-        
-    elif bid_type == 'blind_nil':
-        # Pure blind nil bid
-        components['blind_nil_bonus'] = game['blind_nil_penalty'] if actual_tricks == 0 else -game['blind_nil_penalty']
-        components['total_points'] = components['blind_nil_bonus']
-        
-    elif bid_type == 'blind':
-        # Blind bid (doubled points/penalties)
-        if blind_success:
-            # Split into base bid and blind bonus for clearer display
-            components['bid_points'] = bid_value * 10
-            components['blind_bonus'] = bid_value * 10  # Additional doubling bonus
-            components['bag_points'] = actual_tricks - bid_value
-        else:
-            # Failed blind bid: show as blind penalty only
-            components['bid_points'] = 0
-            components['blind_bonus'] = -(bid_value * 10 * 2)
-        # IMPORTANT: total_points should NOT include bag_points (tracked separately)
-        components['total_points'] = components['bid_points'] + components['blind_bonus']
-        
-    else:  # 'regular'
-        # Standard bid
-        if actual_tricks >= bid_value:
-            components['bid_points'] = bid_value * 10
-            components['bag_points'] = actual_tricks - bid_value
-        else:
-            components['bid_points'] = -(bid_value * 10)
-        # IMPORTANT: total_points should NOT include bag_points
-        # Bags are tracked separately and displayed in the ones digit
-        components['total_points'] = components['bid_points']
-    
-    return components
\ No newline at end of file
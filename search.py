@@ -0,0 +1,87 @@
+"""
+Full-text search over a scorekeeper's games.
+
+games_fts is a contentless FTS5 index of player names, winner, share code
+and the created/completed dates. Triggers added by migration 14 keep it in
+step with every insert, delete and update of those columns, so no write
+path has to remember it.
+
+Every word is indexed with its owner's id in front ("Alice" is stored as
+"7xalice" for user 7), so a search only reads the posting lists of that
+user's own words. An index shared by every user, with the owner as just
+another column to AND against, read every user's "ali" games on each
+search and was slower than a LIKE scan of the user's rows.
+
+Every word of the query is matched as a prefix ("ali 2024" finds Alice's
+games from 2024); a word with punctuation in it, like 2024-05, must match
+as a phrase. Results are ranked by bm25 with player names and share codes
+weighted above the winner and dates.
+"""
+import re
+
+# Indexed columns of games_fts, in order, with their bm25 weights
+FTS_COLUMNS = (
+    ('team1_player1', 10.0),
+    ('team1_player2', 10.0),
+    ('team2_player1', 10.0),
+    ('team2_player2', 10.0),
+    ('winner', 5.0),
+    ('share_code', 10.0),
+    ('created_date', 1.0),
+    ('completed_date', 1.0),
+)
+
+PAGE_SIZE = 20
+
+# Split into separately tagged words, on both the indexed and the query side
+SEPARATORS = ('-', '&', '.', ',', ':', '/', '#', '(', ')', "'", '"')
+
+_TOKEN = re.compile(r'[^\W_]')
+
+SEARCH_SQL = '''
+    SELECT g.id, g.status, g.team1_player1, g.team1_player2, g.team2_player1, g.team2_player2,
+           g.team1_final_score, g.team2_final_score, g.winner, g.share_code, g.created_date, g.completed_date,
+           bm25(games_fts, {weights}) AS score
+    FROM games_fts JOIN games g ON g.id = games_fts.rowid
+    WHERE games_fts MATCH ? AND g.created_by_user_id = ?
+    ORDER BY score, g.id DESC
+    LIMIT ? OFFSET ?
+'''.format(weights=', '.join(str(weight) for _, weight in FTS_COLUMNS))
+
+def owned_words(owner, value):
+    """SQL expression tagging each word of the SQL expression `value` with the owner's id.
+    Splits words exactly like owned_phrase() does."""
+    for separator in SEPARATORS:
+        value = "replace({}, '{}', ' ')".format(value, separator.replace("'", "''"))
+    return "{owner} || 'x' || replace({value}, ' ', ' ' || {owner} || 'x')".format(owner=owner, value=value)
+
+def owned_phrase(user_id, word):
+    """The user's tagged form of one search box word, or None if it has nothing to match"""
+    for separator in SEPARATORS:
+        word = word.replace(separator, ' ')
+    parts = ['{}x{}'.format(int(user_id), part) for part in word.split() if _TOKEN.search(part)]
+    return ' '.join(parts) or None
+
+def indexed_values(row):
+    """Values to index for the games row named `row` (NEW, OLD or games), in FTS_COLUMNS order"""
+    return ', '.join(owned_words(row + '.created_by_user_id', row + '.' + name) for name, _ in FTS_COLUMNS)
+
+def match_expression(query, user_id):
+    """FTS5 MATCH text for a user's search box input, or None if it has no words"""
+    phrases = [owned_phrase(user_id, word) for word in query.split()]
+    terms = ['"{}"*'.format(phrase) for phrase in phrases if phrase]
+    return ' AND '.join(terms) or None
+
+def search_games(conn, user_id, query, page=1, page_size=PAGE_SIZE):
+    """One page of the user's games matching `query`, best first. Returns (games, has_more)."""
+    match = match_expression(query, user_id)
+    if match is None:
+        return [], False
+    rows = conn.execute(SEARCH_SQL, (match, user_id, page_size + 1, (page - 1) * page_size)).fetchall()
+    return rows[:page_size], len(rows) > page_size
+
+def rebuild(conn):
+    """Re-index every game from the games table"""
+    conn.execute("INSERT INTO games_fts (games_fts) VALUES ('delete-all')")
+    conn.execute('INSERT INTO games_fts (rowid, {}) SELECT games.id, {} FROM games'.format(
+        ', '.join(name for name, _ in FTS_COLUMNS), indexed_values('games')))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Fill a database with realistic synthetic data.
+
+Creates users, games per user and rounds with a plausible mix of regular,
+nil, blind nil, blind and combination bids. Every round is scored through
+the real scoring code (recalculate.score_round), so derived columns, totals
+and completion are exactly what the app would have stored. Rows are inserted
+with executemany() in one transaction per batch of users.
+
+    python seed_data.py --users 50 --games 20
+    python seed_data.py --users 200 --games 40 --database /tmp/load.db
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+import models
+from recalculate import DERIVED_COLUMNS, score_round, stored_values
+from scoring import parse_bid
+
+FIRST_NAMES = ('Alice', 'Bob', 'Carmen', 'Dev', 'Erin', 'Femi', 'Grace', 'Hiro', 'Ines', 'Jamal',
+               'Kai', 'Lena', 'Marco', 'Nia', 'Omar', 'Priya', 'Quinn', 'Rosa', 'Sam', 'Tess')
+
+RAW_COLUMNS = ('team1_bid', 'team2_bid', 'team1_actual', 'team2_actual',
+               'team1_nil_success', 'team1_blind_nil_success', 'team1_blind_success',
+               'team2_nil_success', 'team2_blind_nil_success', 'team2_blind_success')
+
+ROUND_COLUMNS = ('game_id', 'round_number') + RAW_COLUMNS + DERIVED_COLUMNS + ('created_date',)
+
+GAME_COLUMNS = ('id', 'created_by_user_id', 'team1_player1', 'team1_player2', 'team2_player1', 'team2_player2',
+                'max_score', 'nil_penalty', 'blind_nil_penalty', 'bag_penalty_threshold', 'bag_penalty_points',
+                'status', 'team1_final_score', 'team2_final_score', 'team1_bags', 'team2_bags', 'winner',
+                'share_code', 'created_date', 'completed_date')
+
+def team_bid(rng):
+    """(bid string, kind) for one team: regular, blind, nil, blind nil or a combination"""
+    partner = rng.randint(2, 6)
+    roll = rng.random()
+    if roll < 0.06:
+        # One player goes nil, the partner bids normally (or the whole team goes nil)
+        return ('{}n'.format(partner) if rng.random() < 0.9 else '0n'), 'nil'
+    if roll < 0.08:
+        return ('{}bn'.format(partner) if rng.random() < 0.8 else '0bn'), 'blind_nil'
+    if roll < 0.12:
+        return '{}b'.format(rng.randint(5, 8)), 'blind'
+    return str(rng.randint(max(1, partner - 1), partner + 3)), 'regular'
+
+def play_round(rng, round_number, game_id, created):
+    """Raw inputs for one round with a realistic trick split"""
+    (bid1, kind1), (bid2, kind2) = team_bid(rng), team_bid(rng)
+    value1, value2 = parse_bid(bid1)[0], parse_bid(bid2)[0]
+
+    # Tricks land near the bids, with the leftover split roughly evenly
+    leftover = 13 - value1 - value2
+    team1_actual = min(13, max(0, round(rng.gauss(value1 + leftover / 2, 1.5))))
+    team2_actual = 13 - team1_actual
+
+    row = {'game_id': game_id, 'round_number': round_number, 'created_date': created,
+           'team1_bid': bid1, 'team2_bid': bid2, 'team1_actual': team1_actual, 'team2_actual': team2_actual}
+    for team, kind, value, actual in (('team1', kind1, value1, team1_actual), ('team2', kind2, value2, team2_actual)):
+        row[team + '_nil_success'] = kind == 'nil' and rng.random() < 0.7
+        row[team + '_blind_nil_success'] = kind == 'blind_nil' and rng.random() < 0.55
+        row[team + '_blind_success'] = kind == 'blind' and actual >= value
+    return row
+
+def generate_game(rng, game_id, user_id, share_code, created):
+    """One game row and its round rows, played until someone wins or the game stops"""
+    players = rng.sample(FIRST_NAMES, 4)
+    game = {
+        'id': game_id, 'created_by_user_id': user_id,
+        'team1_player1': players[0], 'team1_player2': players[1],
+        'team2_player1': players[2], 'team2_player2': players[3],
+        'max_score': rng.choice((500, 500, 500, 300, 250)),
+        'nil_penalty': 100, 'blind_nil_penalty': 200,
+        'bag_penalty_threshold': rng.choice((10, 10, 10, 5)), 'bag_penalty_points': 100,
+        'status': 'active', 'winner': None, 'share_code': share_code,
+        'created_date': created, 'completed_date': None,
+    }
+
+    # Most games are finished; some were left in progress or abandoned part way
+    roll = rng.random()
+    stop_after = None if roll < 0.75 else rng.randint(1, 12)
+    state = (0, 0, 0, 0)
+    rounds = []
+    when = created
+    while len(rounds) < 60:
+        when = when + timedelta(minutes=rng.randint(3, 8))
+        row = play_round(rng, len(rounds) + 1, game_id, when)
+        derived, state = score_round(game, row, state)
+        row.update(zip(DERIVED_COLUMNS, stored_values(row['round_number'],
+                                                      tuple(derived[column] for column in DERIVED_COLUMNS))))
+        rounds.append(row)
+        if max(state[0], state[1]) >= game['max_score'] or len(rounds) == stop_after:
+            break
+
+    team1_total, team2_total, team1_bags, team2_bags = state
+    game.update(team1_final_score=team1_total, team2_final_score=team2_total, team1_bags=team1_bags, team2_bags=team2_bags)
+    if max(team1_total, team2_total) >= game['max_score']:
+        winners = ('team1', players[:2]) if team1_total >= game['max_score'] else ('team2', players[2:])
+        game.update(status='completed', winner='{} & {}'.format(*winners[1]), completed_date=when)
+    elif roll > 0.9:
+        game['status'] = 'abandoned'
+
+    # An in-progress game often has bids entered for the next round but no scores yet
+    if game['status'] == 'active' and rng.random() < 0.3:
+        pending = play_round(rng, len(rounds) + 1, game_id, when + timedelta(minutes=2))
+        for column in RAW_COLUMNS[2:]:
+            pending[column] = None
+        for column in DERIVED_COLUMNS:
+            pending[column] = None if column in ('team1_points', 'team2_points', 'team1_total', 'team2_total') else 0
+        rounds.append(pending)
+    return game, rounds
+
+def generate(conn, users=50, games_per_user=20, seed=None, batch_users=25):
+    """Insert `users` users with `games_per_user` games each. Returns counts."""
+    rng = random.Random(seed)
+    first_user = conn.execute('SELECT COALESCE(MAX(id), 0) FROM users').fetchone()[0] + 1
+    next_game = conn.execute('SELECT COALESCE(MAX(id), 0) FROM games').fetchone()[0] + 1
+
+    used_codes = {row[0] for row in conn.execute('SELECT share_code FROM games WHERE share_code IS NOT NULL')}
+    needed = users * games_per_user
+    free_codes = 90000 - len(used_codes)
+    if needed > free_codes:
+        raise ValueError('Only {} unused 5-digit share codes left for {} games'.format(free_codes, needed))
+    codes = iter(rng.sample([c for c in (str(n) for n in range(10000, 100000)) if c not in used_codes], needed))
+
+    now = datetime.now()
+    counts = {'users': 0, 'games': 0, 'rounds': 0}
+    for batch_start in range(0, users, batch_users):
+        user_rows, game_rows, round_rows = [], [], []
+        for offset in range(batch_start, min(users, batch_start + batch_users)):
+            user_id = first_user + offset
+            joined = now - timedelta(days=rng.randint(30, 730))
+            user_rows.append((user_id, 'player{}'.format(user_id), 'player{}@example.com'.format(user_id), joined))
+            for _ in range(games_per_user):
+                created = joined + timedelta(minutes=rng.randint(0, int((now - joined).total_seconds() // 60)))
+                game, rounds = generate_game(rng, next_game, user_id, next(codes), created)
+                next_game += 1
+                game_rows.append(tuple(game[column] for column in GAME_COLUMNS))
+                round_rows.extend(tuple(r[column] for column in ROUND_COLUMNS) for r in rounds)
+
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('INSERT INTO users (id, name, email, created_date) VALUES (?, ?, ?, ?)', user_rows)
+        conn.executemany('INSERT INTO games ({}) VALUES ({})'.format(
+            ', '.join(GAME_COLUMNS), ', '.join('?' for _ in GAME_COLUMNS)), game_rows)
+        conn.executemany('INSERT INTO rounds ({}) VALUES ({})'.format(
+            ', '.join(ROUND_COLUMNS), ', '.join('?' for _ in ROUND_COLUMNS)), round_rows)
+        conn.commit()
+
+        counts['users'] += len(user_rows)
+        counts['games'] += len(game_rows)
+        counts['rounds'] += len(round_rows)
+    return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill the database with synthetic users, games and rounds')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--games', type=int, default=20, help='Games per user')
+    parser.add_argument('--seed', type=int, help='Random seed for a reproducible dataset')
+    parser.add_argument('--database', help='Database file (default: SPADES_DATABASE or database.db)')
+    args = parser.parse_args()
+
+    if args.database:
+        models.configure_database(args.database)
+    models.init_db()
+
+    conn = models.get_db_connection()
+    start = time.perf_counter()
+    counts = generate(conn, args.users, args.games, args.seed)
+    conn.close()
+    print("Inserted {users} users, {games} games and {rounds} rounds into {db} in {secs:.1f}s".format(
+        db=models.DATABASE, secs=time.perf_counter() - start, **counts))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Opt-in slow-query log.
+
+With SPADES_SLOW_QUERY_MS set, every statement run through a pooled
+connection that takes at least that long is written as one JSON line to a
+rotating log (SPADES_SLOW_QUERY_LOG, default slow_queries.log): normalized
+SQL, the shape of its parameters, duration, SQLite VM work (counted with a
+progress handler) and the route or thread that ran it. For a query both
+run from execute() until its rows are used up or its cursor is closed, since
+execute() only computes the first row. The first time a statement shows up
+in a process its EXPLAIN QUERY PLAN is captured too.
+
+    python slow_queries.py                  # summarize slow_queries.log
+    python slow_queries.py --log other.log --top 10
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from collections import defaultdict
+from logging.handlers import RotatingFileHandler
+
+from metrics import request_queries
+
+DEFAULT_LOG = 'slow_queries.log'
+PROGRESS_STEPS = 1000  # VM instructions per progress callback
+PLANNED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACE = re.compile(r'\s+')
+_NAMED = re.compile(r':(\w+)')
+
+def normalize_sql(sql):
+    """One line, literals replaced by ?, IN lists collapsed, so variants group together"""
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _SPACE.sub(' ', sql).strip()
+    return _IN_LIST.sub('(?, ...)', sql)
+
+def parameter_shape(parameters, many=False):
+    """Types of the bound values, never the values themselves"""
+    if many:
+        return 'many'
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in sorted(parameters.items())}
+    return [type(value).__name__ for value in parameters]
+
+class SlowQueryLog:
+    """Writes statements slower than threshold_ms to a rotating JSON-lines file"""
+
+    def __init__(self, threshold_ms, path=DEFAULT_LOG, max_bytes=5 * 1024 * 1024, backups=5):
+        self.threshold = threshold_ms / 1000.0
+        self.path = path
+        self._planned = set()
+        self._lock = threading.Lock()
+        self._handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, delay=True)
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+        self._logger = logging.Logger('spades.slow_queries', logging.INFO)
+        self._logger.addHandler(self._handler)
+
+    def start(self, conn, steps=None):
+        """Count VM work for the statement about to run (or fetch) on conn,
+        adding to `steps` if given. Returns the counter."""
+        steps = [0] if steps is None else steps
+
+        def progress():
+            steps[0] += PROGRESS_STEPS
+            return 0
+
+        conn.set_progress_handler(progress, PROGRESS_STEPS)
+        return steps
+
+    def pause(self, conn):
+        conn.set_progress_handler(None, 0)
+
+    def finish(self, conn, sql, parameters, many, seconds, steps):
+        self.pause(conn)
+        if seconds < self.threshold:
+            return
+        normalized = normalize_sql(sql)
+        entry = {
+            'sql': normalized,
+            'params': parameter_shape(parameters, many),
+            'ms': round(seconds * 1000, 3),
+            'vm_steps': steps[0],
+            'route': request_queries.route if request_queries.active else threading.current_thread().name,
+        }
+        with self._lock:
+            first_time = normalized not in self._planned
+            self._planned.add(normalized)
+        if first_time:
+            entry['plan'] = self.explain(conn, sql, parameters, many)
+        self._logger.info(json.dumps(entry))
+
+    def explain(self, conn, sql, parameters, many):
+        if not sql.lstrip()[:7].upper().startswith(PLANNED):
+            return None
+        if many:
+            # The real rows may be a consumed iterator; the plan doesn't depend on values
+            names = _NAMED.findall(_STRING.sub('', sql))
+            parameters = dict.fromkeys(names) if names else (None,) * sql.count('?')
+        try:
+            rows = sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+        except sqlite3.Error as e:
+            return ['EXPLAIN failed: {}'.format(e)]
+        return [row[3] for row in rows]
+
+    def close(self):
+        self._handler.close()
+
+# The active log, or None when slow-query logging is off
+active = None
+
+def enable(threshold_ms, path=DEFAULT_LOG, **kwargs):
+    global active
+    disable()
+    active = SlowQueryLog(threshold_ms, path, **kwargs)
+    return active
+
+def disable():
+    global active
+    if active is not None:
+        active.close()
+    active = None
+
+if os.environ.get('SPADES_SLOW_QUERY_MS'):
+    enable(float(os.environ['SPADES_SLOW_QUERY_MS']), os.environ.get('SPADES_SLOW_QUERY_LOG', DEFAULT_LOG))
+
+def log_files(path):
+    """Rotated backups oldest first (path.N ... path.1), then the live log"""
+    backups = [name for name in glob.glob(path + '.*') if name[len(path) + 1:].isdigit()]
+    backups.sort(key=lambda name: int(name[len(path) + 1:]), reverse=True)
+    return backups + [path]
+
+def read_entries(path):
+    """Entries from the log and its rotated backups, oldest first"""
+    for name in log_files(path):
+        if not os.path.exists(name):
+            continue
+        with open(name) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+def summarize(entries):
+    """Group by normalized SQL, slowest total time first"""
+    groups = defaultdict(lambda: {'count': 0, 'total_ms': 0.0, 'durations': [], 'routes': defaultdict(int), 'plan': None})
+    for entry in entries:
+        group = groups[entry['sql']]
+        group['count'] += 1
+        group['total_ms'] += entry['ms']
+        group['durations'].append(entry['ms'])
+        group['routes'][entry['route']] += 1
+        if entry.get('plan'):
+            group['plan'] = entry['plan']
+
+    summary = []
+    for sql, group in groups.items():
+        durations = sorted(group['durations'])
+        summary.append({
+            'sql': sql,
+            'count': group['count'],
+            'total_ms': round(group['total_ms'], 3),
+            'p50_ms': durations[len(durations) // 2],
+            'max_ms': durations[-1],
+            'routes': dict(group['routes']),
+            'plan': group['plan'],
+        })
+    summary.sort(key=lambda s: s['total_ms'], reverse=True)
+    return summary
+
+def print_summary(summary, top=20):
+    if not summary:
+        print("No slow queries logged")
+        return
+    for item in summary[:top]:
+        print("{count:>6}x  total {total_ms:>10.1f} ms  p50 {p50_ms:>8.1f} ms  max {max_ms:>8.1f} ms".format(**item))
+        print("        {}".format(item['sql'][:300]))
+        print("        routes: {}".format(', '.join('{} ({})'.format(r, n) for r, n in sorted(item['routes'].items()))))
+        for detail in item['plan'] or []:
+            print("        plan: {}".format(detail))
+        print()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the slow-query log')
+    parser.add_argument('--log', default=os.environ.get('SPADES_SLOW_QUERY_LOG', DEFAULT_LOG))
+    parser.add_argument('--top', type=int, default=20, help='How many statements to show')
+    args = parser.parse_args()
+    print_summary(summarize(read_entries(args.log)), args.top)
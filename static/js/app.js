@@ -56,6 +56,32 @@ document.addEventListener('keypress', function(e) {
     }
 });
 
+// Player name suggestions for inputs marked data-player-autocomplete
+document.addEventListener('DOMContentLoaded', function() {
+    const list = document.getElementById('player-names');
+    if (!list) return;
+    let timer = null;
+    document.querySelectorAll('[data-player-autocomplete]').forEach(input => {
+        input.addEventListener('input', function() {
+            clearTimeout(timer);
+            const prefix = input.value.trim();
+            if (!prefix) return;
+            timer = setTimeout(() => {
+                fetch('/players/autocomplete?q=' + encodeURIComponent(prefix))
+                    .then(response => response.ok ? response.json() : [])
+                    .then(names => {
+                        list.replaceChildren(...names.map(name => {
+                            const option = document.createElement('option');
+                            option.value = name;
+                            return option;
+                        }));
+                    })
+                    .catch(() => {});
+            }, 150);
+        });
+    });
+});
+
 // Mobile touch improvements
 document.addEventListener('touchstart', function() {}, {passive: true});
 
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Per-player and per-partnership statistics.
+
+player_stats keeps running sums for every player name and every partnership
+a scorekeeper has recorded, so the stats page reads a handful of rows
+instead of scanning every round. The sums are kept current by the units of
+work that change scores: they wrap their writes in tracking(conn, game_id)
+and hand it the rounds they change, and it applies the difference those
+rounds and the game row make in the same transaction - without reading the
+game's other rounds. Renames and rule changes recompute the one game.
+
+Only scored rounds count; games and wins count completed games only.
+
+    python stats.py --rebuild      # recompute everything from games and rounds
+"""
+import argparse
+from contextlib import contextmanager
+
+from recalculate import game_rounds, with_derived
+from scoring import RuleSet, parse_bid
+
+# Running sums per (user, kind, name), in the order contributions are kept
+STAT_COLUMNS = (
+    'games', 'wins', 'rounds', 'bid_total', 'contracts', 'contracts_made',
+    'nil_attempts', 'nil_made', 'blind_nil_attempts', 'blind_nil_made',
+    'bags', 'bag_penalties',
+)
+
+UPSERT_SQL = '''
+    INSERT INTO player_stats (user_id, kind, name, {columns}) VALUES (?, ?, ?, {placeholders})
+    ON CONFLICT (user_id, kind, name) DO UPDATE SET {updates}
+'''.format(columns=', '.join(STAT_COLUMNS),
+           placeholders=', '.join('?' for _ in STAT_COLUMNS),
+           updates=', '.join('{0} = {0} + excluded.{0}'.format(column) for column in STAT_COLUMNS))
+
+def partnership(player1, player2):
+    """Same name whichever seat each partner was entered in"""
+    return ' & '.join(sorted((player1.strip(), player2.strip())))
+
+def penalties(r, team, threshold):
+    """How many bag penalties a scored round gave the team: one per full set of
+    `threshold` bags taken off its count, so crossing it twice counts twice"""
+    if threshold <= 0:
+        return 0
+    return ((r[team + '_bags_before_penalty'] or 0) - (r[team + '_bags_total'] or 0)) // threshold
+
+def team_round(r, team, threshold):
+    """One team's contribution from one scored round, in STAT_COLUMNS order (games/wins zero)"""
+    return round_inputs(r, team) + [r[team + '_bags_earned'] or 0, penalties(r, team, threshold)]
+
+def round_inputs(r, team):
+    """The part of team_round() that only needs the round's raw inputs (no bags)"""
+    bid = r[team + '_bid']
+    actual = r[team + '_actual']
+    bid_value, bid_type = parse_bid(bid)
+    contract = bid_type not in ('nil', 'blind_nil')
+    if bid_type == 'blind':
+        made = bool(r[team + '_blind_success'])
+    else:
+        made = actual >= bid_value
+    nil = bid_type in ('nil', 'combination_nil')
+    blind_nil = bid_type in ('blind_nil', 'combination_blind_nil')
+    # A pure nil is scored on the team's tricks; a combination on its success flag
+    if bid_type == 'nil':
+        nil_made = actual == 0
+    else:
+        nil_made = nil and bool(r[team + '_nil_success'])
+    if bid_type == 'blind_nil':
+        blind_nil_made = actual == 0
+    else:
+        blind_nil_made = blind_nil and bool(r[team + '_blind_nil_success'])
+    return [0, 0, 1, bid_value, int(contract), int(contract and made),
+            int(nil), int(nil_made), int(blind_nil), int(blind_nil_made)]
+
+def add_into(totals, key, values):
+    current = totals.get(key)
+    if current is None:
+        totals[key] = list(values)
+    else:
+        for i, value in enumerate(values):
+            current[i] += value
+
+def game_contribution(conn, game_id):
+    """(user_id, {(kind, name): sums}) for one game as it is stored right now"""
+    game = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+    if game is None:
+        return None, {}
+    rounds = [r for r in game_rounds(conn, game) if r['team1_actual'] is not None]
+    return game['created_by_user_id'], contribution(game, rounds)
+
+def game_result(game, players):
+    """games and wins for one team of a game"""
+    if game is None or game['status'] != 'completed':
+        return 0, 0
+    return 1, int(game['winner'] == '{} & {}'.format(*players))
+
+def contribution(game, rounds):
+    totals = {}
+    teams = {}
+    for team in ('team1', 'team2'):
+        players = (game[team + '_player1'], game[team + '_player2'])
+        team_totals = [0] * len(STAT_COLUMNS)
+        team_totals[0], team_totals[1] = game_result(game, players)
+        teams[team] = (players, team_totals)
+
+    for r in rounds:
+        for team, (players, team_totals) in teams.items():
+            for i, value in enumerate(team_round(r, team, game['bag_penalty_threshold'])):
+                team_totals[i] += value
+
+    return team_keys(teams.values())
+
+def team_keys(teams):
+    """{(kind, name): sums} from (players, team_totals) per team"""
+    totals = {}
+    for players, team_totals in teams:
+        if not any(team_totals):
+            continue
+        for player in players:
+            add_into(totals, ('player', player.strip()), team_totals)
+        add_into(totals, ('partnership', partnership(*players)), team_totals)
+    return totals
+
+def change_delta(before, after, changed_rounds):
+    """{(kind, name): difference} from the game row before and after a change
+    and the (old, new) rounds it changed directly. The other rounds' inputs
+    are untouched; the bag penalties they gain or lose follow from the game's
+    bag count, as every penalty takes a full threshold of bags off it."""
+    rules = RuleSet.for_game(before)
+    threshold = before['bag_penalty_threshold']
+    teams = []
+    for team in ('team1', 'team2'):
+        players = (before[team + '_player1'], before[team + '_player2'])
+        delta = [0] * len(STAT_COLUMNS)
+        (games_before, wins_before), (games_after, wins_after) = game_result(before, players), game_result(after, players)
+        delta[0], delta[1] = games_after - games_before, wins_after - wins_before
+        for old, new in changed_rounds:
+            for r, sign in ((old, -1), (new, 1)):
+                if r is None or r['team1_actual'] is None:
+                    continue
+                values = round_inputs(r, team) + [rules.bags_earned(r[team + '_bid'], r[team + '_actual']), 0]
+                for i, value in enumerate(values):
+                    delta[i] += sign * value
+        if threshold > 0:
+            bags_change = ((after[team + '_bags'] or 0) if after is not None else 0) - (before[team + '_bags'] or 0)
+            delta[-1] = (delta[-2] - bags_change) // threshold
+        teams.append((players, delta))
+    return team_keys(teams)
+
+def apply_delta(conn, user_id, before, after):
+    """Add after - before to the stored sums and drop rows that reach zero"""
+    changes = []
+    for key in set(before) | set(after):
+        old = before.get(key, [0] * len(STAT_COLUMNS))
+        new = after.get(key, [0] * len(STAT_COLUMNS))
+        delta = [n - o for n, o in zip(new, old)]
+        if any(delta):
+            changes.append((user_id,) + key + tuple(delta))
+    if not changes:
+        return 0
+    conn.executemany(UPSERT_SQL, changes)
+    conn.execute('DELETE FROM player_stats WHERE user_id = ? AND games = 0 AND rounds = 0', (user_id,))
+    return len(changes)
+
+@contextmanager
+def tracking(conn, game_id, whole_game=False):
+    """Keep player_stats in step with what the block does to one game.
+
+    The block appends (old, new) to the list it is given for every round it
+    changes itself - rows or round images, None for no round. Pass
+    whole_game=True when players or rules change, to recompute the game."""
+    if whole_game:
+        user_id, before = game_contribution(conn, game_id)
+        yield []
+        after_user_id, after = game_contribution(conn, game_id)
+        apply_delta(conn, user_id if user_id is not None else after_user_id, before, after)
+        return
+    before = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+    changed_rounds = []
+    yield changed_rounds
+    if before is not None:
+        after = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+        apply_delta(conn, before['created_by_user_id'], {}, change_delta(before, after, changed_rounds))
+
+def rebuild(conn, batch_size=500):
+    """Recompute every row from games and rounds (backfill, or after a bulk re-score).
+    The caller commits. Returns the number of rows written."""
+    conn.execute('DELETE FROM player_stats')
+    totals = {}
+    game_ids = [row[0] for row in conn.execute('SELECT id FROM games ORDER BY id')]
+    for i in range(0, len(game_ids), batch_size):
+        batch = game_ids[i:i + batch_size]
+        marks = ', '.join('?' for _ in batch)
+        games = conn.execute('SELECT * FROM games WHERE id IN ({})'.format(marks), batch).fetchall()
+        rounds = {}
+        for r in conn.execute('SELECT * FROM rounds WHERE game_id IN ({}) ORDER BY game_id, round_number'.format(marks),
+                              batch):
+            rounds.setdefault(r['game_id'], []).append(r)
+        for game in games:
+            user_totals = totals.setdefault(game['created_by_user_id'], {})
+            scored = [r for r in with_derived(game, rounds.get(game['id'], [])) if r['team1_actual'] is not None]
+            for key, values in contribution(game, scored).items():
+                add_into(user_totals, key, values)
+
+    rows = [(user_id,) + key + tuple(values)
+            for user_id, user_totals in totals.items() for key, values in user_totals.items()]
+    conn.executemany(UPSERT_SQL, rows)
+    return len(rows)
+
+def ratio(numerator, denominator):
+    return numerator / denominator if denominator else None
+
+def user_stats(conn, user_id):
+    """Players and partnerships for the stats page, most games first"""
+    stats = {'player': [], 'partnership': []}
+    for row in conn.execute('''
+        SELECT * FROM player_stats WHERE user_id = ? ORDER BY kind, games DESC, rounds DESC, name
+    ''', (user_id,)):
+        stats[row['kind']].append({
+            'name': row['name'],
+            'games': row['games'],
+            'wins': row['wins'],
+            'win_rate': ratio(row['wins'], row['games']),
+            'rounds': row['rounds'],
+            'average_bid': ratio(row['bid_total'], row['rounds']),
+            'bid_made_rate': ratio(row['contracts_made'], row['contracts']),
+            'nil_attempts': row['nil_attempts'] + row['blind_nil_attempts'],
+            'nil_success_rate': ratio(row['nil_made'] + row['blind_nil_made'],
+                                      row['nil_attempts'] + row['blind_nil_attempts']),
+            'bags_per_round': ratio(row['bags'], row['rounds']),
+            'bag_penalties': row['bag_penalties'],
+        })
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Player and partnership statistics')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute all statistics from the stored games')
+    args = parser.parse_args()
+
+    from models import run_transaction
+    if args.rebuild:
+        print("Rebuilt {} statistics rows".format(run_transaction(rebuild)))
+    else:
+        parser.print_help()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Test script for the pooled SQLite connections in models.py"""
+
+import os
+import tempfile
+import threading
+
+import models
+from models import ConnectionPool
+
+def make_pool(**kwargs):
+    """Pool pointed at a throwaway database file"""
+    path = os.path.join(tempfile.mkdtemp(), 'pool.db')
+    return ConnectionPool(path, **kwargs)
+
+def test_checkout_reuses_connection():
+    """close() hands the connection back and the next checkout reuses it"""
+    pool = make_pool()
+
+    conn = pool.checkout()
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    conn.close()
+
+    again = pool.checkout()
+    assert again is conn, "Expected the idle connection to be reused"
+    again.close()
+
+    stats = pool.stats()
+    print(f"  Pool stats: {stats}")
+    assert stats['created'] == 1
+    assert stats['reused'] == 1
+    assert stats['idle'] == 1 and stats['in_use'] == 0
+
+def test_checkin_rolls_back_uncommitted_work():
+    """Uncommitted writes never leak into the next borrower's transaction"""
+    pool = make_pool()
+
+    conn = pool.checkout()
+    conn.execute('CREATE TABLE t (x INTEGER)')
+    conn.commit()
+    conn.execute('INSERT INTO t VALUES (1)')
+    conn.close()
+
+    conn = pool.checkout()
+    assert not conn.in_transaction
+    assert conn.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 0
+    conn.close()
+
+def test_health_check_discards_broken_connection():
+    """An idle connection that fails its health check is replaced"""
+    pool = make_pool(health_check_interval=0)
+
+    conn = pool.checkout()
+    conn.close()
+    # Simulate a connection that died while idle
+    sqlite_close = super(models.PooledConnection, conn).close
+    sqlite_close()
+
+    fresh = pool.checkout()
+    assert fresh is not conn
+    fresh.execute('SELECT 1')
+    fresh.close()
+
+    stats = pool.stats()
+    assert stats['health_check_failures'] == 1
+    assert stats['discarded'] == 1
+
+def test_release_thread_returns_leaked_connections():
+    """Connections a thread forgot to close are checked in by release_thread()"""
+    pool = make_pool()
+    pool.checkout()
+    pool.checkout()
+
+    other = []
+    worker = threading.Thread(target=lambda: other.append(pool.checkout()))
+    worker.start()
+    worker.join()
+
+    assert pool.release_thread() == 2
+    stats = pool.stats()
+    assert stats['in_use'] == 1, "Another thread's connection must stay checked out"
+    other[0].close()
+
+def test_idle_connections_are_bounded():
+    """Connections beyond max_idle are closed instead of kept"""
+    pool = make_pool(max_idle=2)
+    conns = [pool.checkout() for _ in range(4)]
+    for conn in conns:
+        conn.close()
+
+    stats = pool.stats()
+    assert stats['idle'] == 2
+    assert stats['discarded'] == 2
+
+def test_after_fork_forgets_parent_connections():
+    """A forked child starts with an empty pool and ignores inherited checkins"""
+    pool = make_pool()
+    inherited = pool.checkout()
+    pool.checkout().close()
+
+    pool._after_fork()
+    stats = pool.stats()
+    assert stats['idle'] == 0 and stats['in_use'] == 0
+    assert stats['forks'] == 1
+
+    inherited.pool_pid = -1  # as seen from the child process
+    inherited.close()
+    assert pool.stats()['checkins'] == 0
+
+if __name__ == '__main__':
+    print("🃏 Testing connection pool\n")
+
+    test_checkout_reuses_connection()
+    test_checkin_rolls_back_uncommitted_work()
+    test_health_check_discards_broken_connection()
+    test_release_thread_returns_leaked_connections()
+    test_idle_connections_are_bounded()
+    test_after_fork_forgets_parent_connections()
+
+    print("🎉 All connection pool tests passed!")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Test script for the streaming CSV/NDJSON history export"""
+
+import csv
+import gzip
+import io
+import json
+
+import pytest
+
+import export
+import models
+from migrations import check_query_plans
+
+def new_game(client, names, max_score=500):
+    seats = ('team1_player1', 'team1_player2', 'team2_player1', 'team2_player2')
+    response = client.post('/new-game', data=dict(zip(seats, names), max_score=max_score))
+    return int(response.location.rsplit('/', 1)[1])
+
+def test_export_formats(logged_in_client):
+    """CSV has a line per round, NDJSON a line per game; both gzip on request"""
+    client = logged_in_client()
+    first = new_game(client, ('Alice', 'Bob', 'Carol', 'Dave'))
+    client.post('/game/{}/round'.format(first), data={'team1_bid': '4', 'team2_bid': '0n'})
+    client.post('/game/{}/scores'.format(first), data={'team1_actual': '13', 'team2_actual': '0'})
+    client.post('/game/{}/round'.format(first), data={'team1_bid': '5', 'team2_bid': '6'})
+    client.post('/game/{}/scores'.format(first), data={'team1_actual': '5', 'team2_actual': '8'})
+    second = new_game(client, ('Erin', 'Femi', 'Grace', 'Hiro'))
+    new_game(logged_in_client('other@example.com'), ('Ines', 'Jamal', 'Kai', 'Lena'))
+    client = logged_in_client()
+
+    response = client.get('/export.csv')
+    assert response.status_code == 200 and response.mimetype == 'text/csv'
+    assert 'attachment' in response.headers['Content-Disposition']
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [(row['game_id'], row['round_number']) for row in rows] == \
+        [(str(first), '1'), (str(first), '2'), (str(second), '')]
+    assert rows[0]['round_team1_points'] and rows[0]['round_team2_nil_bonus'] == '100'
+
+    games = [json.loads(line) for line in client.get('/export.ndjson').get_data(as_text=True).splitlines()]
+    assert [game['id'] for game in games] == [first, second]
+    assert [r['team1_total'] for r in games[0]['rounds']] == [int(rows[0]['round_team1_total']),
+                                                               int(rows[1]['round_team1_total'])]
+    assert games[1]['rounds'] == []
+
+    response = client.get('/export.ndjson', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert [json.loads(line) for line in gzip.decompress(response.data).decode().splitlines()] == games
+    assert client.get('/export.xml').status_code == 404
+
+def test_export_streams_in_batches(database):
+    """Rows are fetched EXPORT_BATCH at a time and the query never sorts"""
+    conn = models.get_db_connection()
+    conn.executemany('''INSERT INTO games (created_by_user_id, team1_player1, team1_player2, team2_player1, team2_player2)
+                        VALUES (1, 'A', 'B', 'C', 'D')''', [()] * 1200)
+    conn.commit()
+    conn.close()
+
+    chunks = list(export.stream_export(1, 'csv'))
+    assert len(chunks) == 1200 // export.EXPORT_BATCH + 1
+    assert sum(chunk.count('\n') for chunk in chunks) == 1201
+    compressed = b''.join(export.stream_export(1, 'csv', compress=True))
+    assert gzip.decompress(compressed).decode() == ''.join(chunks)
+
+    plans = {label: (ok, details) for label, _, ok, details in check_query_plans()}
+    ok, details = plans['history export']
+    print(f"  {details}")
+    assert ok and 'TEMP B-TREE' not in ' '.join(details)
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
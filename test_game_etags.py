@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Test script for ETags and Cache-Control on game pages"""
+
+import pytest
+
+import models
+
+def flash_pending(client, message='Round saved'):
+    with client.session_transaction() as session:
+        session['_flashes'] = [('message', message)]
+
+def test_game_page_with_flash_is_not_cached(logged_in_client):
+    """A page showing a flash message gets no ETag, and an old ETag doesn't hide the message"""
+    client = logged_in_client()
+    seats = ('team1_player1', 'team1_player2', 'team2_player1', 'team2_player2')
+    game_id = client.post('/new-game', data=dict(zip(seats, 'ABCD'))).location.rsplit('/', 1)[1]
+    assert 'ETag' not in client.get('/game/{}'.format(game_id)).headers, "Shows the new-game flash"
+    page = client.get('/game/{}'.format(game_id))
+    etag = page.headers['ETag']
+    assert page.headers['Cache-Control'] == 'private, no-cache'
+    assert client.get('/game/{}'.format(game_id), headers={'If-None-Match': etag}).status_code == 304
+
+    flash_pending(client)
+    page = client.get('/game/{}'.format(game_id), headers={'If-None-Match': etag})
+    assert page.status_code == 200 and b'Round saved' in page.data
+    assert 'ETag' not in page.headers and page.headers['Cache-Control'] == 'private, no-cache'
+    assert client.get('/game/{}'.format(game_id), headers={'If-None-Match': etag}).status_code == 304
+
+def test_spectator_page_with_flash_is_private(logged_in_client):
+    """Anonymous spectator pages are public, except one carrying a visitor's flash message"""
+    client = logged_in_client()
+    seats = ('team1_player1', 'team1_player2', 'team2_player1', 'team2_player2')
+    client.post('/new-game', data=dict(zip(seats, 'ABCD')))
+    conn = models.get_db_connection()
+    share_code = conn.execute('SELECT share_code FROM games').fetchone()[0]
+    conn.close()
+
+    from app import app
+    spectator = app.test_client()
+    page = spectator.get('/view/{}'.format(share_code))
+    assert page.headers['Cache-Control'].startswith('public') and 'ETag' in page.headers
+
+    flash_pending(spectator, 'Welcome back')
+    page = spectator.get('/view/{}'.format(share_code))
+    print(f"  {page.headers['Cache-Control']}")
+    assert page.headers['Cache-Control'] == 'private, no-cache' and 'ETag' not in page.headers
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
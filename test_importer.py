@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Test script for the bulk importer of historical games"""
+
+import io
+import json
+
+import pytest
+
+import importer
+import models
+import players
+from search import search_games
+
+def play(client, names, rounds, max_score=500, pending_bids=None):
+    seats = ('team1_player1', 'team1_player2', 'team2_player1', 'team2_player2')
+    game_id = int(client.post('/new-game', data=dict(zip(seats, names), max_score=max_score)).location.rsplit('/', 1)[1])
+    for bids, tricks, flags in rounds:
+        client.post('/game/{}/round'.format(game_id), data={'team1_bid': bids[0], 'team2_bid': bids[1]})
+        client.post('/game/{}/scores'.format(game_id),
+                    data=dict({'team1_actual': tricks[0], 'team2_actual': tricks[1]}, **{flag: 'on' for flag in flags}))
+    if pending_bids:
+        client.post('/game/{}/round'.format(game_id), data={'team1_bid': pending_bids[0], 'team2_bid': pending_bids[1]})
+    return game_id
+
+def stored(conn, user_id):
+    """Everything the app keeps for a user's games, without ids and share codes"""
+    games = []
+    for game in conn.execute('SELECT * FROM games WHERE created_by_user_id = ? ORDER BY id', (user_id,)):
+        rounds = conn.execute('SELECT * FROM rounds WHERE game_id = ? ORDER BY round_number', (game['id'],))
+        games.append(({column: game[column] for column in importer.GAME_INSERT_COLUMNS[2:-3]},
+                      [{column: r[column] for column in importer.ROUND_INSERT_COLUMNS[1:]} for r in rounds]))
+    return games
+
+def test_export_round_trip(logged_in_client):
+    """Importing an export reproduces the scoring, players, stats and search index"""
+    client = logged_in_client()
+    play(client, ('Alice', 'Bob', 'Carol', 'Dave'), [
+        (('4', '0n'), ('13', '0'), ()),
+        (('5b', '6'), ('6', '7'), ('team1_blind_success',)),
+        (('3n', '9'), ('4', '9'), ('team1_nil_success',)),
+    ], max_score=100)
+    play(client, ('Erin', 'Femi', 'Grace', 'Hiro'), [(('6', '6'), ('7', '6'), ())], pending_bids=('3', '0bn'))
+    csv_export = client.get('/export.csv').get_data(as_text=True)
+    ndjson_export = client.get('/export.ndjson').get_data(as_text=True)
+
+    for name, text in (('history.csv', csv_export), ('history.ndjson', ndjson_export)):
+        importing = logged_in_client('{}@example.com'.format(name))
+        page = importing.post('/import', data={'file': (io.BytesIO(text.encode()), name)},
+                              content_type='multipart/form-data')
+        assert page.status_code == 200 and b'Imported 2 games (5 rounds)' in page.data
+
+    conn = models.get_db_connection()
+    original = stored(conn, 1)
+    assert original[0][0]['status'] == 'completed' and original[0][0]['winner'] == 'Alice & Bob'
+    assert stored(conn, 2) == original
+    assert stored(conn, 3) == original
+    stats = [tuple(row)[1:] for row in conn.execute('SELECT * FROM player_stats ORDER BY user_id, kind, name')]
+    assert stats[:len(stats) // 3] == stats[len(stats) // 3:2 * len(stats) // 3] == stats[2 * len(stats) // 3:]
+    assert len(players.player_history(conn, players.find_player(conn, 2, 'alice'))) == 1
+    assert len(search_games(conn, 3, 'grace')[0]) == 1
+    pending = conn.execute('SELECT * FROM rounds WHERE team1_actual IS NULL ORDER BY game_id').fetchall()
+    assert [(r['round_number'], r['team1_bid'], r['team2_bid']) for r in pending] == [(2, '3', '0bn')] * 3
+    conn.close()
+
+    # The imported game carries on where it left off
+    client = logged_in_client('history.csv@example.com')
+    game_id = pending[1]['game_id']
+    client.post('/game/{}/scores'.format(game_id), data={'team1_actual': 13, 'team2_actual': 0,
+                                                         'team2_blind_nil_success': 'on'})
+    conn = models.get_db_connection()
+    assert conn.execute('SELECT team1_actual FROM rounds WHERE game_id = ? AND round_number = 2',
+                        (game_id,)).fetchone()[0] == 13
+    conn.close()
+
+def test_bad_games_are_reported(logged_in_client):
+    """A bad game is skipped with a reason; the others in the file are still imported"""
+    logged_in_client()
+    good = {'team1_player1': 'A', 'team1_player2': 'B', 'team2_player1': 'C', 'team2_player2': 'D',
+            'created_date': '2023-12-31', 'rounds': [{'team1_bid': 5, 'team2_bid': 7, 'team1_actual': 6, 'team2_actual': 7}]}
+    text = json.dumps([
+        good,
+        dict(good, rounds=[{'team1_bid': '15', 'team2_bid': '7', 'team1_actual': 6, 'team2_actual': 7}]),
+        dict(good, rounds=[{'team1_bid': '5x', 'team2_bid': '7', 'team1_actual': 6, 'team2_actual': 7}]),
+        dict(good, rounds=[{'team1_bid': '5', 'team2_bid': '7', 'team1_actual': 6, 'team2_actual': 8}]),
+        dict(good, team2_player2=' '),
+        dict(good, created_date='last tuesday'),
+        dict(good, rounds=[{'team1_bid': '5n', 'team2_bid': '7', 'team1_actual': 6, 'team2_actual': 7,
+                            'team1_nil_success': 'maybe'}]),
+        dict(good, rounds=[{'team1_bid': '5', 'team2_bid': '7'}] + good['rounds']),
+        ['not', 'a', 'game'],
+        good,
+    ])
+    games, errors = importer.read_games(text, 'json')
+    print("\n  " + "\n  ".join(errors))
+    assert len(games) == 2 and [error.split(':')[0] for error in errors] == \
+        ['game 2', 'game 3', 'game 4', 'game 5', 'game 6', 'game 7', 'game 8', 'game 9']
+    assert errors[-1] == 'game 9: not a JSON object'
+    assert importer.import_games(1, games[:1]) == (1, 1)
+
+    conn = models.get_db_connection()
+    game = conn.execute('SELECT * FROM games').fetchone()
+    assert (game['status'], game['team1_final_score'], game['team2_final_score']) == ('active', 50, 70)
+    assert game['created_date'] == '2023-12-31 00:00:00' and len(game['share_code']) == 5
+    conn.close()
+
+    assert importer.read_games('{"team1', 'json')[1][0].startswith('Could not read the file')
+    games, errors = importer.read_games('game_id,game_team1_player1\n1,A\n', 'csv')
+    assert games == [] and errors == ['line 2: team1_player2 is missing']
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Test script for live spectator updates"""
+
+import threading
+import time
+
+import pytest
+
+import models
+from live import GameEventBroker
+
+def test_publish_wakes_listener_for_same_game_only():
+    """A stream only receives updates for the game it watches"""
+    broker = GameEventBroker()
+    received = []
+
+    def listen():
+        for updates in broker.listen(1, 0, duration=2, keepalive=2):
+            received.append(updates)
+            return
+
+    listener = threading.Thread(target=listen)
+    listener.start()
+    while not broker.is_watched(1):
+        time.sleep(0.01)
+
+    broker.publish(2, {'version': 'other'})
+    broker.publish(1, {'version': 1})
+    listener.join()
+
+    print(f"  Received: {received}")
+    assert received == [[{'version': 1}]]
+    assert not broker.is_watched(1), "Stream should unsubscribe when it stops"
+
+def test_publish_without_watchers_is_dropped():
+    """Nobody watching means nothing is buffered"""
+    broker = GameEventBroker()
+    broker.publish(1, {'version': 1})
+    assert broker.wait(1, 0, timeout=0) == (0, [], False)
+
+def test_overflowing_history_asks_for_resync():
+    """A listener that fell behind the history buffer is told to resync"""
+    broker = GameEventBroker(history=2)
+    since = broker.subscribe(1, 0)
+    for i in range(5):
+        broker.publish(1, {'version': i})
+
+    seq, payloads, missed = broker.wait(1, since, timeout=0)
+    assert seq == 5
+    assert missed
+
+def test_watcher_reports_external_changes():
+    """Version changes made by other workers trigger on_external_change"""
+    broker = GameEventBroker(poll_interval=0.01)
+    versions = {1: 0}
+    changed = []
+    broker.start_watcher(lambda ids: {i: versions[i] for i in ids}, changed.append)
+
+    broker.subscribe(1, 0)
+    versions[1] = 1
+    deadline = time.time() + 2
+    while not changed and time.time() < deadline:
+        time.sleep(0.01)
+    broker.unsubscribe(1)
+
+    assert changed == [1]
+
+def test_stream_ends_and_resumes_from_last_event_id(logged_in_client, monkeypatch):
+    """A stream gives its worker back after a while; the reconnect only sends what the client missed"""
+    import app
+    monkeypatch.setattr(app, 'SPECTATOR_STREAM_SECONDS', 0.2)
+    client = logged_in_client()
+    seats = ('team1_player1', 'team1_player2', 'team2_player1', 'team2_player2')
+    game_id = client.post('/new-game', data=dict(zip(seats, 'ABCD'))).location.rsplit('/', 1)[1]
+    conn = models.get_db_connection()
+    game = conn.execute('SELECT share_code, version FROM games WHERE id = ?', (game_id,)).fetchone()
+    conn.close()
+
+    spectator = app.app.test_client()
+    url = '/view/{}/stream'.format(game['share_code'])
+    start = time.monotonic()
+    body = spectator.get(url, headers={'Last-Event-ID': str(game['version'])}).get_data(as_text=True)
+    assert time.monotonic() - start < 2
+    assert body.startswith('retry: 3000') and 'event: update' not in body, "Up to date: nothing to send"
+
+    client.post('/game/{}/round'.format(game_id), data={'team1_bid': '4', 'team2_bid': '5'})
+    body = spectator.get(url, headers={'Last-Event-ID': str(game['version'])}).get_data(as_text=True)
+    assert 'event: update' in body and 'id: {}\n'.format(game['version']) not in body
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
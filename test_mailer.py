@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Test script for the background email outbox, against a local stand-in for SMTP2GO"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import mailer as mailer_module
+import models
+from mailer import Mailer
+
+class StubSMTP2GO:
+    """Local HTTP server that answers with the queued (status, delay) replies, then 200s"""
+
+    def __init__(self, replies=()):
+        self.replies = list(replies)
+        self.received = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                stub.received.append(body)
+                status, delay = stub.replies.pop(0) if stub.replies else (200, 0)
+                time.sleep(delay)
+                reply = json.dumps({'data': {'succeeded': int(status == 200)}}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/v3/email/send'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def outbox():
+    conn = models.get_db_connection()
+    rows = [dict(row) for row in conn.execute('SELECT * FROM email_outbox ORDER BY id')]
+    conn.close()
+    return rows
+
+def queue(mailer, recipient):
+    """Enqueue without waking the delivery thread, so the test drives delivery"""
+    conn = models.get_db_connection()
+    mailer.enqueue(recipient, 'Subject', 'Body', conn=conn)
+    conn.commit()
+    conn.close()
+
+def make_due_now():
+    conn = models.get_db_connection()
+    conn.execute("UPDATE email_outbox SET next_attempt_at = '2000-01-01' WHERE status = 'pending'")
+    conn.commit()
+    conn.close()
+
+def test_worker_delivers_queued_message(database):
+    """enqueue() returns at once and the delivery thread posts the message"""
+    stub = StubSMTP2GO([(200, 0.3)])
+    mailer = Mailer(api_url=stub.url, api_key='test-key', poll_interval=0.05)
+    try:
+        start = time.perf_counter()
+        mailer.enqueue('player@example.com', 'Your code', 'Code: 123456', '<p>123456</p>')
+        queued_in = time.perf_counter() - start
+
+        deadline = time.monotonic() + 5
+        while outbox()[0]['status'] != 'sent' and time.monotonic() < deadline:
+            time.sleep(0.02)
+    finally:
+        mailer.stop()
+        stub.close()
+
+    print(f"  Queued in {queued_in * 1000:.1f} ms, outbox: {outbox()}")
+    assert queued_in < 0.3, "Queueing must not wait for the mail API"
+    assert outbox()[0]['status'] == 'sent' and outbox()[0]['attempts'] == 1
+    assert stub.received[0]['api_key'] == 'test-key'
+    assert stub.received[0]['to'] == ['player@example.com']
+    assert stub.received[0]['html_body'] == '<p>123456</p>'
+
+def test_failures_are_retried_with_backoff(database):
+    """Server errors and timeouts are retried later; the next success sends it"""
+    stub = StubSMTP2GO([(503, 0), (200, 1.0), (200, 0)])
+    mailer = Mailer(api_url=stub.url, api_key='test-key', timeout=(1, 0.3), base_delay=60)
+    try:
+        queue(mailer, 'player@example.com')
+        assert mailer.process_due() == 1
+        first = outbox()[0]
+        assert mailer.process_due() == 0, "A failed message waits for its backoff"
+
+        make_due_now()
+        mailer.process_due()
+        second = outbox()[0]
+
+        make_due_now()
+        mailer.process_due()
+        final = outbox()[0]
+    finally:
+        mailer.stop()
+        stub.close()
+
+    print(f"  After 503: {first['last_error']!r}; after timeout: {second['last_error']!r}")
+    assert first['status'] == 'pending' and first['attempts'] == 1 and 'HTTP 503' in first['last_error']
+    assert second['status'] == 'pending' and second['attempts'] == 2 and 'timed out' in second['last_error']
+    assert final['status'] == 'sent' and final['attempts'] == 3
+
+def test_undeliverable_messages_are_dead_lettered(database):
+    """Rejections and exhausted retries leave the message marked dead"""
+    stub = StubSMTP2GO([(400, 0), (500, 0), (500, 0)])
+    mailer = Mailer(api_url=stub.url, api_key='test-key', max_attempts=2, base_delay=0)
+    try:
+        queue(mailer, 'bad@example.com')
+        queue(mailer, 'flaky@example.com')
+        for _ in range(3):
+            mailer.process_due()
+            make_due_now()
+    finally:
+        mailer.stop()
+        stub.close()
+
+    rejected, exhausted = outbox()
+    print(f"  Rejected: {rejected['last_error']!r}; exhausted: {exhausted['last_error']!r}")
+    assert rejected['status'] == 'dead' and rejected['attempts'] == 1
+    assert exhausted['status'] == 'dead' and exhausted['attempts'] == 2
+    assert mailer.stats()['dead'] == 2
+
+def test_slow_batch_keeps_its_leases(database):
+    """A message waiting behind a slow send isn't taken and sent again by another process"""
+    stub = StubSMTP2GO([(200, 0.8), (200, 0.8)])
+    first = Mailer(api_url=stub.url, api_key='test-key')
+    second = Mailer(api_url=stub.url, api_key='test-key')
+    lease_seconds = mailer_module.LEASE_SECONDS
+    mailer_module.LEASE_SECONDS = 1.0
+    try:
+        queue(first, 'one@example.com')
+        queue(first, 'two@example.com')
+        make_due_now()
+        batch = threading.Thread(target=first.process_due)
+        batch.start()
+        time.sleep(1.2)  # the batch's original lease has run out; the second send is under way
+        taken = second.process_due()
+        batch.join()
+    finally:
+        mailer_module.LEASE_SECONDS = lease_seconds
+        stub.close()
+
+    print(f"  Second process took {taken}, mail API got {len(stub.received)} posts")
+    assert taken == 0 and len(stub.received) == 2
+    assert [row['status'] for row in outbox()] == ['sent', 'sent']
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
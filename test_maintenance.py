@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Test script for the maintenance janitor"""
+
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import models
+from maintenance import Janitor
+
+def test_pass_deletes_expired_codes_in_batches(database):
+    """Only codes well past expiry go, however many batches it takes"""
+    now = datetime.now()
+    conn = models.get_db_connection()
+    conn.executemany('INSERT INTO auth_codes (user_id, code, expires_at) VALUES (1, ?, ?)',
+                     [(str(i), now - timedelta(days=2)) for i in range(25)] +
+                     [('fresh', now + timedelta(minutes=15)), ('recent', now - timedelta(hours=1))])
+    conn.commit()
+    conn.close()
+
+    report = Janitor(batch_size=10).run_once()
+
+    conn = models.get_db_connection()
+    left = sorted(row['code'] for row in conn.execute('SELECT code FROM auth_codes'))
+    conn.close()
+    print(f"  Report: {report}")
+    assert report['expired_codes'] == 25
+    assert left == ['fresh', 'recent']
+
+def test_only_the_lease_holder_runs(database):
+    """A second process is turned away until the holder's lease runs out"""
+    first, second = Janitor(interval=60), Janitor(interval=60, name='other-host:1')
+
+    assert first.run_once() is not None
+    assert second.run_once() is None, "Lease is still held by the first janitor"
+    assert first.run_once() is not None, "The holder renews its own lease"
+
+    conn = models.get_db_connection()
+    conn.execute("UPDATE maintenance_leases SET expires_at = '2000-01-01'")
+    conn.commit()
+    conn.close()
+    assert second.run_once() is not None, "An expired lease can be taken over"
+
+def test_wal_checkpoint_and_incremental_vacuum(database):
+    """A big WAL is truncated and free pages are handed back"""
+    conn = models.get_db_connection()
+    assert conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2, "New databases use incremental vacuum"
+    conn.execute('CREATE TABLE filler (data BLOB)')
+    conn.executemany('INSERT INTO filler VALUES (?)', [(b'x' * 4000,) for _ in range(500)])
+    conn.commit()
+    conn.execute('DROP TABLE filler')
+    conn.commit()
+    conn.close()
+
+    report = Janitor(wal_threshold=1024, vacuum_threshold=10).run_once(force=True)
+    print(f"  Report: {report}")
+    assert report['checkpoint'] and not report['checkpoint']['busy']
+    assert os.path.getsize(models.DATABASE + '-wal') == 0
+    assert report['vacuumed_pages'] > 0
+
+def test_forked_worker_starts_its_own_janitor(logged_in_client, monkeypatch):
+    """A request in a process that didn't start the janitor thread starts one"""
+    import app
+    janitor = Janitor(interval=3600)
+    inherited = threading.Thread(target=lambda: None)
+    janitor._thread, janitor._pid = inherited, os.getpid() + 1
+    monkeypatch.setattr(app, 'janitor', janitor)
+    try:
+        logged_in_client().get('/dashboard')
+        assert janitor._pid == os.getpid()
+        assert janitor._thread is not inherited and janitor._thread.is_alive()
+    finally:
+        janitor.stop()
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
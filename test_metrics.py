@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Test script for database health and request metrics (/internal/db-stats, /metrics)"""
+
+import os
+import threading
+import time
+
+import pytest
+
+import models
+from metrics import db_metrics, request_metrics, collect_db_stats, db_stats_prometheus
+
+def test_lock_waits_and_write_transactions_are_timed(database):
+    """A writer blocked behind another write transaction records its wait"""
+    db_metrics.reset()
+    holder = models.get_db_connection()
+    holder.execute('BEGIN IMMEDIATE')
+
+    def write():
+        conn = models.get_db_connection()
+        conn.execute("INSERT INTO users (email) VALUES ('waiter@example.com')")
+        conn.commit()
+        conn.close()
+
+    waiter = threading.Thread(target=write)
+    waiter.start()
+    time.sleep(0.2)
+    holder.commit()
+    holder.close()
+    waiter.join()
+
+    snapshot = db_metrics.snapshot()
+    print(f"  Busy waits: {snapshot['busy_waits']['count']} totalling {snapshot['busy_waits']['sum']}s")
+    assert snapshot['busy_waits']['count'] == 1
+    assert 0.1 < snapshot['busy_waits']['sum'] < 5
+    assert snapshot['busy_timeouts'] == 0
+    assert snapshot['write_transactions']['count'] == 2
+    assert snapshot['write_transactions']['max'] >= 0.2
+
+def test_stats_report_files_pages_and_pool(database):
+    """collect_db_stats() sees the WAL, page counts and pool usage"""
+    conn = models.get_db_connection()
+    stats = collect_db_stats(conn, models.db_pool)
+    conn.close()
+
+    print(f"  WAL {stats['wal_bytes']} bytes, {stats['page_count']} pages, pool {stats['pool']}")
+    assert stats['database'] == os.path.realpath(database) or stats['database'] == database
+    assert stats['wal_bytes'] > 0 and stats['page_count'] > 0
+    assert stats['pool']['in_use'] >= 1
+
+    # Reading the stats doesn't checkpoint: the lag stays until maintenance does
+    conn = models.get_db_connection()
+    conn.execute("INSERT INTO users (name, email) VALUES ('Wal', 'wal@example.com')")
+    conn.commit()
+    lag = collect_db_stats(conn, models.db_pool)['checkpoint_lag_frames']
+    assert lag > 0 and collect_db_stats(conn, models.db_pool)['checkpoint_lag_frames'] == lag
+    conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+    assert collect_db_stats(conn, models.db_pool)['checkpoint_lag_frames'] == 0
+    conn.close()
+
+    text = db_stats_prometheus(stats)
+    assert '# TYPE spades_db_busy_wait_seconds histogram' in text
+    assert 'spades_db_wal_bytes{pid="%d"} %d' % (os.getpid(), stats['wal_bytes']) in text
+
+def test_endpoint_requires_token(database):
+    """/internal/db-stats is closed without the configured token"""
+    os.environ['INTERNAL_STATS_TOKEN'] = 'secret'
+    try:
+        from app import app
+        client = app.test_client()
+        assert client.get('/internal/db-stats').status_code == 403
+        assert client.get('/internal/db-stats', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+
+        response = client.get('/internal/db-stats', headers={'Authorization': 'Bearer secret'})
+        assert response.status_code == 200 and 'checkpoint_lag_frames' in response.get_json()
+        response = client.get('/internal/db-stats?format=prometheus&token=secret')
+        assert response.status_code == 200 and b'spades_db_pool_checkouts_total' in response.data
+    finally:
+        del os.environ['INTERNAL_STATS_TOKEN']
+
+    # No token configured: closed, even to localhost (which is what a proxy looks like)
+    assert client.get('/internal/db-stats', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 403
+    assert client.get('/metrics').status_code == 403
+
+def test_requests_record_latency_and_sql(database):
+    """Each request is timed by route and status, with its SQL statements counted"""
+    from app import app
+    app.config['SERVER_TIMING'] = True
+    request_metrics.reset()
+    try:
+        client = app.test_client()
+        client.get('/login')
+        client.post('/login', data={'email': 'metrics@example.com'})
+        response = client.get('/view/00000')
+    finally:
+        app.config['SERVER_TIMING'] = False
+
+    snapshot = request_metrics.snapshot()
+    print(f"  Routes: {sorted(snapshot['latency'])}; Server-Timing: {response.headers['Server-Timing']}")
+    assert snapshot['latency'][('/login', 'GET', 200)]['count'] == 1
+    assert snapshot['latency'][('/login', 'POST', 302)]['count'] == 1
+    assert ('/view/<share_code>', 'GET', 200) in snapshot['latency'], "Routes are keyed by their rule"
+    assert snapshot['sql_count']['/login']['sum'] >= 3, "Login looks up the user and stores a code"
+    assert 'db;dur=' in response.headers['Server-Timing']
+
+    os.environ['INTERNAL_STATS_TOKEN'] = 'secret'
+    try:
+        text = client.get('/metrics?token=secret').data.decode()
+    finally:
+        del os.environ['INTERNAL_STATS_TOKEN']
+    assert 'spades_request_duration_seconds_count{endpoint="/login",method="POST"' in text
+    assert 'spades_request_sql_statements_bucket{endpoint="/login"' in text
+    assert 'spades_db_wal_bytes' in text
+    assert '# TYPE spades_render_cache_hits_total counter' in text
+    assert '# TYPE spades_render_cache_entries gauge' in text
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Test script for the schema migration runner"""
+
+import sqlite3
+
+import pytest
+
+import models
+from migrations import MIGRATIONS, run_migrations, current_version, check_query_plans
+
+def test_fresh_database_is_fully_migrated(database_path):
+    """init_db() applies every migration and a second run is a no-op"""
+    models.init_db()
+
+    conn = models.get_db_connection()
+    assert current_version(conn) == MIGRATIONS[-1][0]
+    assert run_migrations(conn) == [], "Nothing should be pending after init_db()"
+    conn.close()
+
+def test_legacy_database_gets_share_codes(database_path):
+    """A pre-share-code database gets unique 5-digit codes for every game"""
+
+    legacy = sqlite3.connect(database_path)
+    legacy.execute('''CREATE TABLE games (
+        id INTEGER PRIMARY KEY, created_by_user_id INTEGER NOT NULL,
+        team1_player1 TEXT NOT NULL, team1_player2 TEXT NOT NULL,
+        team2_player1 TEXT NOT NULL, team2_player2 TEXT NOT NULL,
+        max_score INTEGER DEFAULT 500, status TEXT DEFAULT 'active',
+        team1_final_score INTEGER DEFAULT 0, team2_final_score INTEGER DEFAULT 0, winner TEXT,
+        created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, completed_date TIMESTAMP)''')
+    for _ in range(3):
+        legacy.execute("INSERT INTO games (created_by_user_id, team1_player1, team1_player2, "
+                       "team2_player1, team2_player2) VALUES (1, 'a', 'b', 'c', 'd')")
+    legacy.commit()
+    legacy.close()
+
+    models.init_db()
+
+    conn = models.get_db_connection()
+    codes = [row['share_code'] for row in conn.execute('SELECT share_code FROM games').fetchall()]
+    conn.close()
+    print(f"  Share codes: {codes}")
+    assert all(code and len(code) == 5 for code in codes)
+    assert len(set(codes)) == len(codes)
+
+def test_hot_queries_use_indexes(database_path):
+    """EXPLAIN QUERY PLAN shows every hot query using its index"""
+    models.init_db()
+
+    for label, index, ok, plan in check_query_plans():
+        print(f"  {label}: {'; '.join(plan)}")
+        assert ok, f"{label} should use {index}"
+
+def test_game_version_bumps_on_every_write(database_path):
+    """Writes to a game or its rounds raise games.version in the same transaction"""
+    models.init_db()
+
+    conn = models.get_db_connection()
+    game_id = conn.execute("""INSERT INTO games (created_by_user_id, team1_player1, team1_player2,
+                              team2_player1, team2_player2) VALUES (1, 'a', 'b', 'c', 'd')""").lastrowid
+
+    def version():
+        return conn.execute('SELECT version FROM games WHERE id = ?', (game_id,)).fetchone()[0]
+
+    seen = [version()]
+    round_id = conn.execute("INSERT INTO rounds (game_id, round_number, team1_bid, team2_bid) VALUES (?, 1, '4', '5')",
+                            (game_id,)).lastrowid
+    seen.append(version())
+    conn.execute('UPDATE rounds SET team1_actual = 6 WHERE id = ?', (round_id,))
+    seen.append(version())
+    conn.execute("UPDATE games SET status = 'abandoned' WHERE id = ?", (game_id,))
+    seen.append(version())
+    conn.execute('DELETE FROM rounds WHERE id = ?', (round_id,))
+    seen.append(version())
+    conn.rollback()
+    conn.close()
+
+    print(f"  Versions: {seen}")
+    assert seen == sorted(set(seen)), "Every write should raise the version"
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
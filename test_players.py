@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Test script for normalized players, autocomplete and head-to-head lookups"""
+
+import sqlite3
+
+import pytest
+
+import models
+import players
+from migrations import run_migrations
+
+def new_game(client, names, max_score=500):
+    seats = ('team1_player1', 'team1_player2', 'team2_player1', 'team2_player2')
+    response = client.post('/new-game', data=dict(zip(seats, names), max_score=max_score))
+    return int(response.location.rsplit('/', 1)[1])
+
+def test_backfill_merges_spellings(database):
+    """Existing games get one player per name however it was typed"""
+    conn = sqlite3.connect(database)
+    conn.executemany('''
+        INSERT INTO games (created_by_user_id, team1_player1, team1_player2, team2_player1, team2_player2)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(1, 'Alice', 'Bob', 'Carol', 'Dave'), (1, 'alice ', 'Carol', 'BOB', 'Eve'), (2, 'Alice', 'X', 'Y', 'Z')])
+    conn.execute('DELETE FROM game_players')
+    conn.execute('DELETE FROM players')
+    conn.execute('DELETE FROM schema_migrations WHERE version >= 8')
+    conn.commit()
+    conn.close()
+
+    assert 8 in run_migrations()
+    conn = models.get_db_connection()
+    names = [row['name'] for row in conn.execute('SELECT name FROM players WHERE user_id = 1 ORDER BY name_key')]
+    alice = players.find_player(conn, 1, 'ALICE')
+    history = players.player_history(conn, alice)
+    conn.close()
+    print(f"  {names}")
+    assert names == ['Alice', 'Bob', 'Carol', 'Dave', 'Eve']
+    assert [game['id'] for game in history] == [2, 1], "The other scorekeeper's Alice is someone else"
+
+def test_games_keep_seats_in_step(logged_in_client):
+    """New games, rematches, renames and deletions all update game_players"""
+    client = logged_in_client()
+    game_id = new_game(client, ('Alice', 'Bob', 'Carol', 'Dave'), max_score=100)
+    rematch_id = int(client.post('/game/{}/rematch'.format(game_id)).location.rsplit('/', 1)[1])
+    client.post('/game/{}/edit'.format(rematch_id), data={
+        'team1_player1': 'Alice', 'team1_player2': 'Bob', 'team2_player1': 'Carol', 'team2_player2': 'Erin',
+        'max_score': 100})
+    third_id = new_game(client, ('Carol', 'Alan', 'alice', 'Dave'))
+
+    assert client.get('/players/autocomplete?q=al').get_json() == ['Alan', 'Alice']
+    assert client.get('/players/autocomplete?q=').get_json() == []
+
+    # Alice beats Carol in the first game; the others are unfinished
+    client.post('/game/{}/round'.format(game_id), data={'team1_bid': '6', 'team2_bid': '6'})
+    client.post('/game/{}/scores'.format(game_id), data={'team1_actual': '7', 'team2_actual': '6'})
+    client.post('/game/{}/round'.format(game_id), data={'team1_bid': '6', 'team2_bid': '6'})
+    client.post('/game/{}/scores'.format(game_id), data={'team1_actual': '7', 'team2_actual': '6'})
+
+    conn = models.get_db_connection()
+    alice = players.find_player(conn, 1, 'Alice')
+    carol = players.find_player(conn, 1, 'Carol')
+    erin = players.find_player(conn, 1, 'Erin')
+    games, record = players.head_to_head(conn, alice, carol)
+    assert [game['id'] for game in games] == [third_id, rematch_id, game_id]
+    assert record == {'wins': 1, 'losses': 0}
+    assert [game['id'] for game in players.player_history(conn, erin)] == [rematch_id]
+    assert [game['id'] for game in players.player_history(conn, players.find_player(conn, 1, 'Dave'))] == \
+        [third_id, game_id], "Dave was replaced by Erin in the rematch"
+    conn.close()
+
+    page = client.get('/players/Alice?vs=carol')
+    assert page.status_code == 200 and b'1 \xe2\x80\x93 0' in page.data
+
+    # Players left without games by a delete or a rename are gone
+    client.post('/game/{}/delete'.format(rematch_id))
+    client.post('/game/{}/edit'.format(third_id), data={
+        'team1_player1': 'Carol', 'team1_player2': 'Zoe', 'team2_player1': 'alice', 'team2_player2': 'Dave',
+        'max_score': 500})
+    conn = models.get_db_connection()
+    assert players.player_history(conn, erin) == []
+    assert players.find_player(conn, 1, 'Erin') is None and players.find_player(conn, 1, 'Alan') is None
+    assert players.find_player(conn, 1, 'Carol')['id'] == carol['id']
+    conn.close()
+    assert client.get('/players/autocomplete?q=al').get_json() == ['Alice']
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
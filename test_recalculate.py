@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Test script for the incremental round recalculation"""
+
+import pytest
+
+import models
+from recalculate import recalculate_from_round, DERIVED_COLUMNS
+
+# (team1_bid, team2_bid, team1_actual, team2_actual)
+ROUNDS = [('4', '5', 5, 8), ('6', '6', 6, 7), ('3', '7', 4, 9), ('5', '5', 7, 6),
+          ('4', '4', 9, 4), ('6', '5', 6, 7), ('5', '6', 3, 10), ('4', '7', 5, 8)]
+
+def make_game(rounds=ROUNDS):
+    """One game in the test's database whose rounds have raw inputs only"""
+    conn = models.get_db_connection()
+    game_id = conn.execute("""INSERT INTO games (created_by_user_id, team1_player1, team1_player2,
+                              team2_player1, team2_player2) VALUES (1, 'a', 'b', 'c', 'd')""").lastrowid
+    for number, (t1_bid, t2_bid, t1_actual, t2_actual) in enumerate(rounds, 1):
+        conn.execute('''INSERT INTO rounds (game_id, round_number, team1_bid, team2_bid, team1_actual, team2_actual)
+                        VALUES (?, ?, ?, ?, ?, ?)''', (game_id, number, t1_bid, t2_bid, t1_actual, t2_actual))
+    recalculate_from_round(conn, game_id, 1, converge=False)
+    conn.commit()
+    return conn, game_id
+
+def derived_rows(conn, game_id):
+    return [tuple(r) for r in conn.execute(
+        'SELECT round_number, {} FROM rounds WHERE game_id = ? ORDER BY round_number'.format(', '.join(DERIVED_COLUMNS)),
+        (game_id,)).fetchall()]
+
+def test_unchanged_round_rewrites_nothing(database):
+    """Re-running after a no-op edit converges on the first round"""
+    conn, game_id = make_game()
+    before = derived_rows(conn, game_id)
+
+    rewritten = recalculate_from_round(conn, game_id, 3)
+    after = derived_rows(conn, game_id)
+    conn.close()
+
+    assert rewritten == 0
+    assert after == before
+
+def test_edit_matches_full_recalculation(database):
+    """An edited round rewrites itself and every later round, matching a full pass"""
+    conn, game_id = make_game()
+    conn.execute('UPDATE rounds SET team1_actual = 2, team2_actual = 11 WHERE game_id = ? AND round_number = 3',
+                 (game_id,))
+
+    rewritten = recalculate_from_round(conn, game_id, 3)
+    incremental = derived_rows(conn, game_id)
+    recalculate_from_round(conn, game_id, 1, converge=False)
+    full = derived_rows(conn, game_id)
+    game = conn.execute('SELECT team1_final_score, team2_final_score FROM games WHERE id = ?', (game_id,)).fetchone()
+    conn.close()
+
+    print(f"  Rewrote {rewritten} of {len(ROUNDS)} rounds")
+    assert rewritten == len(ROUNDS) - 2
+    assert incremental == full
+    assert (game['team1_final_score'], game['team2_final_score']) == full[-1][3:5]
+
+def test_delete_converges_after_renumbering(database):
+    """Deleting a round that scored nothing leaves the renumbered rounds untouched"""
+    # Round 3 (0 points, 0 bags for both teams) is deleted below
+    conn, game_id = make_game(ROUNDS[:2] + [('0', '0', 0, 0)] + ROUNDS[2:])
+    before = [row[1:] for row in derived_rows(conn, game_id) if row[0] != 3]
+
+    conn.execute('DELETE FROM rounds WHERE game_id = ? AND round_number = 3', (game_id,))
+    conn.execute('UPDATE rounds SET round_number = round_number - 1 WHERE game_id = ? AND round_number > 3', (game_id,))
+    rewritten = recalculate_from_round(conn, game_id, 3)
+    after = [row[1:] for row in derived_rows(conn, game_id)]
+    conn.close()
+
+    assert rewritten == 0
+    assert after == before
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Test script for the rendered spectator page cache"""
+
+import time
+
+from render_cache import RenderCache
+
+def game(game_id, version, share_code='ABCDE'):
+    return {'id': game_id, 'version': version, 'share_code': share_code}
+
+def test_hits_and_misses_are_counted():
+    cache = RenderCache()
+    assert cache.get('view', game(1, 1)) is None
+    cache.put('view', game(1, 1), '<html>v1</html>')
+    assert cache.get('view', game(1, 1)) == '<html>v1</html>'
+    assert cache.get('view', game(1, 2)) is None, "A new version must not hit the old rendering"
+
+    stats = cache.stats()
+    print(f"  Cache stats: {stats}")
+    assert stats['hits'] == 1 and stats['misses'] == 2
+
+def test_least_recently_used_entry_is_evicted():
+    cache = RenderCache(max_entries=2)
+    cache.put('view', game(1, 1), 'a')
+    cache.put('view', game(2, 1), 'b')
+    cache.get('view', game(1, 1))
+    cache.put('view', game(3, 1), 'c')
+
+    assert cache.get('view', game(2, 1)) is None
+    assert cache.get('view', game(1, 1)) == 'a'
+    assert cache.stats()['evictions'] == 1
+
+def test_total_size_is_bounded():
+    cache = RenderCache(max_bytes=10)
+    cache.put('view', game(1, 1), 'x' * 6)
+    cache.put('view', game(2, 1), 'y' * 6)
+    cache.put('view', game(3, 1), 'z' * 11)  # larger than the whole cache: never stored
+
+    stats = cache.stats()
+    assert stats['entries'] == 1 and stats['bytes'] == 6
+    assert cache.get('view', game(2, 1)) == 'y' * 6
+
+def test_entries_expire():
+    cache = RenderCache(ttl=0.01)
+    cache.put('json', game(1, 1), '{}')
+    time.sleep(0.02)
+    assert cache.get('json', game(1, 1)) is None
+    assert cache.stats()['expirations'] == 1
+
+def test_invalidate_game_drops_all_its_renderings():
+    cache = RenderCache()
+    cache.put('view', game(1, 1), 'a')
+    cache.put('json', game(1, 1), 'b')
+    cache.put('view', game(2, 1), 'c')
+
+    assert cache.invalidate_game(1) == 2
+    assert cache.get('view', game(2, 1)) == 'c'
+    assert cache.stats()['bytes'] == 1
+
+def test_reused_game_id_misses():
+    """A new game that gets a deleted game's id doesn't see its renderings"""
+    cache = RenderCache()
+    cache.put('view', game(1, 3), 'old game')
+    assert cache.get('view', game(1, 3, share_code='FGHIJ')) is None
+
+if __name__ == '__main__':
+    print("🃏 Testing spectator render cache\n")
+
+    test_hits_and_misses_are_counted()
+    test_least_recently_used_entry_is_evicted()
+    test_total_size_is_bounded()
+    test_entries_expire()
+    test_invalidate_game_drops_all_its_renderings()
+    test_reused_game_id_misses()
+
+    print("🎉 All render cache tests passed!")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Test script for bulk re-scoring"""
+
+import pytest
+
+import models
+import rescore
+from recalculate import recalculate_from_round, DERIVED_COLUMNS
+
+def test_engines_agree_on_synthetic_rounds():
+    """The vectorized engine matches the per-round loop, bag carry included"""
+    rows = rescore.synthetic_rounds(games=30, rounds_per_game=30)
+    loop = rescore.compute_derived_python(rows)
+    if rescore.np is None:
+        print("  NumPy not installed, only the loop engine was checked")
+        return
+    assert rescore.compute_derived_numpy(rows) == loop
+
+def test_rule_change_rescores_game(database):
+    """Changing a game's bag rules rebuilds its rounds and reopens it if needed"""
+    conn = models.get_db_connection()
+    game_id = conn.execute("""INSERT INTO games (created_by_user_id, team1_player1, team1_player2,
+                              team2_player1, team2_player2, max_score)
+                              VALUES (1, 'a', 'b', 'c', 'd', 100)""").lastrowid
+    for number in range(1, 6):
+        conn.execute('''INSERT INTO rounds (game_id, round_number, team1_bid, team2_bid, team1_actual, team2_actual)
+                        VALUES (?, ?, '3', '4', 7, 6)''', (game_id, number))
+    recalculate_from_round(conn, game_id, 1, converge=False)
+    assert conn.execute('SELECT status FROM games WHERE id = ?', (game_id,)).fetchone()[0] == 'completed'
+
+    conn.execute('UPDATE games SET bag_penalty_threshold = 2, bag_penalty_points = 100 WHERE id = ?', (game_id,))
+    summary = rescore.rescore_games(conn, [game_id])
+    rescored = conn.execute('SELECT {} FROM rounds WHERE game_id = ? ORDER BY round_number'.format(
+        ', '.join(DERIVED_COLUMNS)), (game_id,)).fetchall()
+    game = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+
+    recalculate_from_round(conn, game_id, 1, converge=False)
+    expected = conn.execute('SELECT {} FROM rounds WHERE game_id = ? ORDER BY round_number'.format(
+        ', '.join(DERIVED_COLUMNS)), (game_id,)).fetchall()
+    conn.rollback()
+    conn.close()
+
+    print(f"  {summary}")
+    assert [tuple(r) for r in rescored] == [tuple(r) for r in expected]
+    assert summary['rounds_rewritten'] == 5
+    assert game['team1_final_score'] == rescored[-1]['team1_total'] == 5 * (30 - 200)
+    assert game['status'] == 'active' and game['winner'] is None
+
+def test_rescore_corrects_winner_and_keeps_completed_date(database):
+    """A completed game with a stale winner gets the right one, on its original completion date"""
+    conn = models.get_db_connection()
+    game_id = conn.execute("""INSERT INTO games (created_by_user_id, team1_player1, team1_player2,
+                              team2_player1, team2_player2, max_score)
+                              VALUES (1, 'a', 'b', 'c', 'd', 150)""").lastrowid
+    for number in range(1, 5):
+        conn.execute('''INSERT INTO rounds (game_id, round_number, team1_bid, team2_bid, team1_actual, team2_actual)
+                        VALUES (?, ?, '3', '4', 7, 6)''', (game_id, number))
+    recalculate_from_round(conn, game_id, 1, converge=False)
+    conn.execute("UPDATE games SET winner = 'a & b', completed_date = '2024-03-01 20:00:00' WHERE id = ?", (game_id,))
+
+    summary = rescore.rescore_games(conn, [game_id])
+    game = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+    conn.rollback()
+    conn.close()
+
+    assert summary['games_updated'] == 1
+    assert (game['status'], game['winner']) == ('completed', 'c & d')
+    assert game['completed_date'] == '2024-03-01 20:00:00'
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""Test script for the round event log, replay and undo"""
+
+import pytest
+
+import models
+import round_log
+from recalculate import game_rounds
+from round_log import current_rounds, game_state, replay
+
+def new_game(client, max_score=500):
+    seats = ('team1_player1', 'team1_player2', 'team2_player1', 'team2_player2')
+    response = client.post('/new-game', data=dict(zip(seats, ('Alice', 'Bob', 'Carol', 'Dave')), max_score=max_score))
+    return int(response.location.rsplit('/', 1)[1])
+
+def snapshot_of_tables(game_id):
+    """The rounds, their running totals and the game's totals as they stand"""
+    conn = models.get_db_connection()
+    rounds = current_rounds(conn, game_id)
+    totals = [tuple(row) for row in conn.execute('SELECT team1_total, team2_total FROM rounds WHERE game_id = ? '
+                                                 'ORDER BY round_number', (game_id,))]
+    game = conn.execute('SELECT team1_final_score, team2_final_score, team1_bags, team2_bags, status FROM games '
+                        'WHERE id = ?', (game_id,)).fetchone()
+    conn.close()
+    return rounds, tuple(game), totals
+
+def round_ids(game_id):
+    conn = models.get_db_connection()
+    ids = [row['id'] for row in conn.execute('SELECT id FROM rounds WHERE game_id = ? ORDER BY round_number',
+                                             (game_id,))]
+    conn.close()
+    return ids
+
+def play_with_edits(client, game_id):
+    """Bids, scores, bid changes, an edit and a delete. Returns the tables after every change."""
+    states = [snapshot_of_tables(game_id)]
+    for n in range(6):
+        client.post('/game/{}/round'.format(game_id), data={'team1_bid': '4', 'team2_bid': '5'})
+        states.append(snapshot_of_tables(game_id))
+        if n == 2:
+            client.post('/game/{}/round'.format(game_id), data={'team1_bid': '0n', 'team2_bid': '6'})
+            states.append(snapshot_of_tables(game_id))
+        client.post('/game/{}/scores'.format(game_id), data={
+            'team1_actual': 3 + n, 'team2_actual': 10 - n, 'team1_nil_success': 'on'})
+        states.append(snapshot_of_tables(game_id))
+    ids = round_ids(game_id)
+    client.post('/game/{}/round/{}/edit'.format(game_id, ids[1]), data={'team1_actual': 13, 'team2_actual': 0})
+    states.append(snapshot_of_tables(game_id))
+    client.post('/game/{}/round/{}/delete'.format(game_id, ids[3]))
+    states.append(snapshot_of_tables(game_id))
+    client.post('/game/{}/round'.format(game_id), data={'team1_bid': '3', 'team2_bid': '3'})
+    states.append(snapshot_of_tables(game_id))
+    return states
+
+def test_replay_matches_every_change(logged_in_client):
+    """Replaying to any event gives the rounds the table had at that point"""
+    client = logged_in_client()
+    game_id = new_game(client)
+    interval = round_log.SNAPSHOT_INTERVAL
+    round_log.SNAPSHOT_INTERVAL = 4
+    try:
+        states = play_with_edits(client, game_id)
+    finally:
+        round_log.SNAPSHOT_INTERVAL = interval
+
+    conn = models.get_db_connection()
+    snapshots = [row[0] for row in conn.execute('SELECT seq FROM round_snapshots WHERE game_id = ?', (game_id,))]
+    for seq, (rounds, _, _) in enumerate(states):
+        assert [dict(r, round_number=n) for n, r in enumerate(rounds, 1)] == replay(conn, game_id, seq), seq
+    print(f"  {len(states) - 1} events, snapshots at {snapshots}")
+    assert snapshots == [4, 8, 12, 16]
+
+    rounds, state = game_state(conn, game_id)
+    game = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+    assert state == (game['team1_final_score'], game['team2_final_score'], game['team1_bags'], game['team2_bags'])
+    assert game_state(conn, game_id, through_round=3)[1][0] == game_rounds(conn, game)[2]['team1_total']
+    assert len(game_state(conn, game_id, seq=5)[0]) == 3, "Bids for round 3 were event 5"
+    conn.close()
+
+def test_undo_walks_back_through_the_log(logged_in_client):
+    """Each undo restores the tables to the state before the change it reverts"""
+    client = logged_in_client()
+    game_id = new_game(client, max_score=200)
+    states = play_with_edits(client, game_id)
+    assert states[-4][1][4] == 'completed', "Game was won before the edit"
+
+    for expected in reversed(states[:-1]):
+        client.post('/game/{}/undo'.format(game_id))
+        assert snapshot_of_tables(game_id) == expected
+    print(f"  undid {len(states) - 1} changes")
+    assert b'Nothing to undo' in client.post('/game/{}/undo'.format(game_id), follow_redirects=True).data
+    assert b'Undo last change' not in client.get('/game/{}'.format(game_id)).data
+
+    # New changes after undoing can be undone in turn
+    client.post('/game/{}/round'.format(game_id), data={'team1_bid': '2', 'team2_bid': '2'})
+    assert b'Undo last change' in client.get('/game/{}'.format(game_id)).data
+    client.post('/game/{}/undo'.format(game_id))
+    assert snapshot_of_tables(game_id) == states[0]
+
+def test_rounds_from_before_the_log_are_kept(logged_in_client):
+    """A game with rounds that were never logged gets them as event 0"""
+    client = logged_in_client()
+    game_id = new_game(client)
+    conn = models.get_db_connection()
+    conn.executemany('''INSERT INTO rounds (game_id, round_number, team1_bid, team2_bid, team1_actual, team2_actual)
+                        VALUES (?, ?, '4', '4', 6, 7)''', [(game_id, n) for n in (1, 2)])
+    conn.commit()
+    conn.close()
+    before = snapshot_of_tables(game_id)[0]
+
+    client.post('/game/{}/round/{}/delete'.format(game_id, round_ids(game_id)[0]))
+    conn = models.get_db_connection()
+    assert [{k: v for k, v in r.items() if k != 'round_number'} for r in replay(conn, game_id, 0)] == before
+    conn.close()
+    client.post('/game/{}/undo'.format(game_id))
+    assert snapshot_of_tables(game_id)[0] == before
+
+def test_undo_delete_after_its_id_was_reused(logged_in_client):
+    """Undoing a delete works, and leaves other games alone, after another game got the round's id"""
+    client = logged_in_client()
+    game_a, game_b = new_game(client), new_game(client)
+    client.post('/game/{}/round'.format(game_a), data={'team1_bid': '4', 'team2_bid': '5'})
+    client.post('/game/{}/scores'.format(game_a), data={'team1_actual': 6, 'team2_actual': 7})
+    before = snapshot_of_tables(game_a)
+    deleted_id = round_ids(game_a)[0]
+    client.post('/game/{}/round/{}/delete'.format(game_a, deleted_id))
+    client.post('/game/{}/round'.format(game_b), data={'team1_bid': '3', 'team2_bid': '3'})
+    assert round_ids(game_b) == [deleted_id], "SQLite hands out the freed id again"
+    game_b_rounds = snapshot_of_tables(game_b)
+
+    assert client.post('/game/{}/undo'.format(game_a)).status_code == 302
+    rounds, game, totals = snapshot_of_tables(game_a)
+    assert [dict(r, id=None) for r in rounds] == [dict(r, id=None) for r in before[0]]
+    assert (game, totals) == before[1:]
+    assert snapshot_of_tables(game_b) == game_b_rounds
+
+    # The log has the round's new id; undoing the scores and bids too only touches game A
+    conn = models.get_db_connection()
+    assert replay(conn, game_a)[0]['id'] == round_ids(game_a)[0] != deleted_id
+    conn.close()
+    client.post('/game/{}/undo'.format(game_a))
+    client.post('/game/{}/undo'.format(game_a))
+    assert round_ids(game_a) == [] and snapshot_of_tables(game_b) == game_b_rounds
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Test script for derived-on-read round storage"""
+
+import json
+from contextlib import contextmanager
+
+import pytest
+
+import models
+import recalculate
+from export import stream_export
+from recalculate import CHECKPOINT_INTERVAL, DERIVED_COLUMNS, STATE_COLUMNS, game_rounds
+from rescore import rescore_games
+
+@contextmanager
+def derived_on_read(enabled):
+    saved = recalculate.DERIVED_ON_READ
+    recalculate.DERIVED_ON_READ = enabled
+    try:
+        yield
+    finally:
+        recalculate.DERIVED_ON_READ = saved
+
+def play_and_edit(logged_in_client):
+    """A 20-round game with an edit, a deletion and a rule change, in an empty database.
+    Returns what a reader sees: the spectator JSON, the export and the stats."""
+    client = logged_in_client()
+    seats = ('team1_player1', 'team1_player2', 'team2_player1', 'team2_player2')
+    names = ('Alice', 'Bob', 'Carol', 'Dave')
+    game_id = int(client.post('/new-game', data=dict(zip(seats, names), max_score=2000)).location.rsplit('/', 1)[1])
+    bids = (('4', '0n'), ('5', '6'), ('3n', '9'), ('4b', '7'), ('6', '5'))
+    for n in range(20):
+        team1_bid, team2_bid = bids[n % len(bids)]
+        client.post('/game/{}/round'.format(game_id), data={'team1_bid': team1_bid, 'team2_bid': team2_bid})
+        tricks = 13 if team2_bid == '0n' else 4 + n % 6
+        client.post('/game/{}/scores'.format(game_id), data={
+            'team1_actual': tricks, 'team2_actual': 13 - tricks, 'team1_nil_success': 'on', 'team1_blind_success': 'on'})
+
+    conn = models.get_db_connection()
+    round_ids = [row['id'] for row in conn.execute('SELECT id FROM rounds WHERE game_id = ? ORDER BY round_number',
+                                                   (game_id,))]
+    conn.close()
+    client.post('/game/{}/round/{}/edit'.format(game_id, round_ids[1]), data={'team1_actual': 13, 'team2_actual': 0})
+    client.post('/game/{}/round/{}/delete'.format(game_id, round_ids[2]))
+    client.post('/game/{}/edit'.format(game_id), data=dict(zip(seats, names), max_score=2000, bag_penalty_threshold=5))
+    client.post('/game/{}/round'.format(game_id), data={'team1_bid': '3', 'team2_bid': '4'})
+
+    conn = models.get_db_connection()
+    share_code = conn.execute('SELECT share_code FROM games WHERE id = ?', (game_id,)).fetchone()['share_code']
+    stats = [tuple(row) for row in conn.execute('SELECT * FROM player_stats ORDER BY kind, name')]
+    conn.close()
+    view = client.get('/view/{}/json'.format(share_code)).get_json()
+    for key in ('share_code', 'version', 'created_date', 'completed_date'):
+        del view['game'][key]
+    for r in view['rounds']:
+        for key in ('id', 'created_date'):
+            del r[key]
+    exported = [json.loads(line) for line in ''.join(stream_export(1, 'ndjson')).splitlines()]
+    for game in exported:
+        del game['share_code'], game['created_date'], game['completed_date']
+        for r in game['rounds']:
+            del r['created_date']
+    return game_id, view, exported, stats
+
+def test_reads_match_stored_mode(logged_in_client, switch_database):
+    """Only raw inputs and checkpoints are stored, and every reader sees the same scores"""
+    with derived_on_read(False):
+        _, stored_view, stored_export, stored_stats = play_and_edit(logged_in_client)
+    switch_database('derived.db')
+    with derived_on_read(True):
+        game_id, view, exported, stats = play_and_edit(logged_in_client)
+
+        conn = models.get_db_connection()
+        rows = conn.execute('SELECT * FROM rounds WHERE game_id = ? AND team1_actual IS NOT NULL ORDER BY round_number',
+                            (game_id,)).fetchall()
+        for r in rows:
+            checkpoint = r['round_number'] % CHECKPOINT_INTERVAL == 0
+            kept = [column for column in DERIVED_COLUMNS if r[column] is not None]
+            assert kept == (list(STATE_COLUMNS) if checkpoint else []), (r['round_number'], kept)
+
+        game = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+        first = game_rounds(conn, game)
+        assert game_rounds(conn, game)[0] is first[0], "Replayed once per game version"
+        assert [r['round_number'] for r in game_rounds(conn, game, 18)] == [18, 19, 20]
+        conn.close()
+
+    print(f"  final {view['game']['team1_final_score']}-{view['game']['team2_final_score']}, {len(rows)} rounds")
+    assert view == stored_view
+    assert exported == stored_export
+    assert stats == stored_stats
+
+def test_rescore_converts_between_modes(logged_in_client):
+    """rescore.py rewrites the rounds for whichever mode is configured"""
+    with derived_on_read(False):
+        game_id, view, _, _ = play_and_edit(logged_in_client)
+    conn = models.get_db_connection()
+    with derived_on_read(True):
+        summary = rescore_games(conn)
+        conn.commit()
+        assert summary['rounds_rewritten'] == summary['rounds'] == 19
+        stored = conn.execute('SELECT COUNT(*) FROM rounds WHERE team1_points IS NOT NULL').fetchone()[0]
+        assert stored == 0
+
+    with derived_on_read(False):
+        assert rescore_games(conn)['rounds_rewritten'] == 19
+        conn.commit()
+        game = conn.execute('SELECT * FROM games WHERE id = ?', (game_id,)).fetchone()
+        rounds = [r for r in game_rounds(conn, game) if r['team1_actual'] is not None]
+    assert [r['team1_total'] for r in rounds] == [r['team1_total'] for r in view['rounds'][:-1]]
+    conn.close()
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """Test script for Spades scoring logic"""
 
-from scoring import parse_bid, calculate_round_points, format_bid_display
+from scoring import parse_bid, calculate_round_points, format_bid_display, RuleSet
 
 # Mock game configuration
 mock_game = {
@@ -128,6 +128,26 @@ def test_scoring_scenarios():
     
     print("  ✓ All scenario tests passed!\n")
 
+def test_rule_set_bag_penalties():
+    """Test closed-form bag penalties against one-at-a-time subtraction"""
+    print("Testing bag penalties:")
+
+    rules = RuleSet.for_game(mock_game)
+    assert RuleSet.for_game(dict(mock_game)) is rules, "Games with the same rules should share a RuleSet"
+
+    for bags_total in range(0, 10):
+        for bags_earned in range(0, 27):
+            expected_bags, expected_penalty = bags_total + bags_earned, 0
+            while expected_bags >= mock_game['bag_penalty_threshold']:
+                expected_penalty += mock_game['bag_penalty_points']
+                expected_bags -= mock_game['bag_penalty_threshold']
+            result = rules.apply_bag_penalty(bags_total, bags_earned)
+            assert result == (bags_total + bags_earned, expected_penalty, expected_bags), \
+                f"Failed for {bags_total} + {bags_earned}: {result}"
+
+    print(f"  23 bags -> {rules.apply_bag_penalty(3, 20)}")
+    print("  ✓ All bag penalty tests passed!\n")
+
 if __name__ == '__main__':
     print("🃏 Testing Spades Scoring Logic\n")
     
@@ -135,5 +155,6 @@ if __name__ == '__main__':
     test_calculate_points()
     test_format_display()
     test_scoring_scenarios()
+    test_rule_set_bag_penalties()
     
     print("🎉 All tests passed! The scoring system is working correctly.")
\ No newline at end of file
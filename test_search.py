@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Test script for the games full-text search index and /search"""
+
+import pytest
+
+import models
+from search import search_games
+
+def new_game(client, names, max_score=500):
+    seats = ('team1_player1', 'team1_player2', 'team2_player1', 'team2_player2')
+    response = client.post('/new-game', data=dict(zip(seats, names), max_score=max_score))
+    return int(response.location.rsplit('/', 1)[1])
+
+def found(query, user_id=1, page=1, page_size=20):
+    conn = models.get_db_connection()
+    games, has_more = search_games(conn, user_id, query, page, page_size)
+    conn.close()
+    return [game['id'] for game in games], has_more
+
+def test_matching_and_ranking(logged_in_client):
+    """Prefixes, several words, dates and share codes; only the user's own games"""
+    client = logged_in_client()
+    first = new_game(client, ('Alice', 'Bob', 'Carol', 'Dave'))
+    second = new_game(client, ('Alicia', 'Erin', 'Zoë', 'Bob'))
+    other = logged_in_client('other@example.com')
+    new_game(other, ('Alice', 'Bob', 'Carol', 'Dave'))
+
+    conn = models.get_db_connection()
+    conn.execute("UPDATE games SET created_date = '2024-05-02 20:00:00' WHERE id = ?", (first,))
+    conn.commit()
+    share_code = conn.execute('SELECT share_code FROM games WHERE id = ?', (second,)).fetchone()['share_code']
+    conn.close()
+
+    assert sorted(found('ali')[0]) == [first, second]
+    assert found('ALICE bob')[0] == [first]
+    assert found('zoe')[0] == [second], "Diacritics are folded"
+    assert found('bob 2024-05')[0] == [first]
+    assert found(share_code)[0] == [second]
+    assert found('carol', user_id=2)[0] == [3]
+    assert found('   ') == ([], False)
+    assert found('"') == ([], False)
+
+    page = client.get('/search?q=alic')
+    assert page.status_code == 200 and b'Alicia' in page.data
+
+def test_index_follows_edits_and_pages(logged_in_client):
+    """Renames and deletions update the index; has_more drives pagination"""
+    client = logged_in_client()
+    game_ids = [new_game(client, ('Alice', 'Bob', 'Carol', 'Dave'), max_score=100) for _ in range(5)]
+    assert found('alice', page_size=2) == ([game_ids[4], game_ids[3]], True)
+    assert found('alice', page=3, page_size=2) == ([game_ids[0]], False)
+
+    client.post('/game/{}/edit'.format(game_ids[0]), data={
+        'team1_player1': 'Alice', 'team1_player2': 'Bob', 'team2_player1': 'Carol', 'team2_player2': 'Erin',
+        'max_score': 100})
+    assert found('erin')[0] == [game_ids[0]]
+    assert game_ids[0] not in found('dave')[0]
+
+    # Winning writes the winner column; the old name stays searchable
+    client.post('/game/{}/round'.format(game_ids[1]), data={'team1_bid': '6', 'team2_bid': '6'})
+    client.post('/game/{}/scores'.format(game_ids[1]), data={'team1_actual': '7', 'team2_actual': '6'})
+    assert game_ids[1] in found('alice')[0]
+
+    client.post('/game/{}/delete'.format(game_ids[0]))
+    assert found('erin')[0] == []
+    print(f"  {found('alice')}")
+
+def test_owners_and_punctuation(database):
+    """Words are tagged per owner: user 1 never sees user 11's words; punctuation splits words alike"""
+    conn = models.get_db_connection()
+    for user_id, names in ((1, ('Jean-Luc', 'Bob', 'Carol', 'Dave')), (11, ('Alice', 'Bob', 'Carol', 'Dave'))):
+        conn.execute('''INSERT INTO games (created_by_user_id, team1_player1, team1_player2, team2_player1, team2_player2)
+                        VALUES (?, ?, ?, ?, ?)''', (user_id, *names))
+    conn.commit()
+    conn.close()
+
+    assert found('ali') == ([], False)
+    assert found('ali', user_id=11)[0] == [2]
+    assert found('luc')[0] == found('jean-luc')[0] == found('jean luc')[0] == [1]
+    assert found('1xalice') == ([], False)
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
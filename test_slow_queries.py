@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Test script for the slow-query log"""
+
+import os
+import time
+
+import pytest
+
+import models
+import slow_queries
+from metrics import request_queries
+
+def test_normalize_sql():
+    """Literals, whitespace and IN lists don't split a statement into many"""
+    assert slow_queries.normalize_sql("SELECT *\n  FROM games WHERE id IN (?, ?, ?) AND status = 'active' LIMIT 5") == \
+        'SELECT * FROM games WHERE id IN (?, ...) AND status = ? LIMIT ?'
+    assert slow_queries.normalize_sql('SELECT team1_bid FROM rounds') == 'SELECT team1_bid FROM rounds'
+
+def test_slow_statements_are_logged_with_plan_once(database, tmp_path):
+    """Every slow statement is logged; its query plan only the first time"""
+    path = str(tmp_path / 'slow_queries.log')
+    log = slow_queries.enable(0, path)
+    try:
+        conn = models.get_db_connection()
+        request_queries.start('/game/<int:game_id>')
+        for game_id in (1, 2):
+            conn.execute('SELECT * FROM rounds WHERE game_id = ? ORDER BY round_number', (game_id,)).fetchall()
+        request_queries.stop()
+        conn.executemany('INSERT INTO users (name, email) VALUES (:name, :email)',
+                         [{'name': 'a', 'email': 'a@example.com'}, {'name': 'b', 'email': 'b@example.com'}])
+        conn.commit()
+        conn.close()
+    finally:
+        slow_queries.disable()
+
+    entries = list(slow_queries.read_entries(log.path))
+    rounds = [e for e in entries if e['sql'].startswith('SELECT * FROM rounds')]
+    insert = next(e for e in entries if e['sql'].startswith('INSERT INTO users'))
+    print(f"  {rounds[0]}")
+    assert len(rounds) == 2
+    assert rounds[0]['route'] == '/game/<int:game_id>' and rounds[0]['params'] == ['int']
+    assert any('idx_rounds_game_round' in detail for detail in rounds[0]['plan'])
+    assert 'plan' not in rounds[1], "The plan is captured once per statement"
+    assert insert['params'] == 'many' and insert['route'] == 'MainThread'
+    assert not any(d.startswith('EXPLAIN failed') for d in insert['plan'] or [])
+
+    summary = slow_queries.summarize(entries)
+    top = next(s for s in summary if s['sql'].startswith('SELECT * FROM rounds'))
+    assert top['count'] == 2 and top['plan'] == rounds[0]['plan']
+
+def test_threshold_and_rotation(database, tmp_path):
+    """Fast statements are skipped; rotated files are still summarized"""
+    path = str(tmp_path / 'slow_queries.log')
+    slow_queries.enable(60000, path)
+    conn = models.get_db_connection()
+    conn.execute('SELECT 1').fetchall()
+    slow_queries.disable()
+    assert not os.path.exists(path), "Nothing over a minute, nothing logged"
+
+    log = slow_queries.enable(0, path, max_bytes=1000, backups=3)
+    try:
+        for i in range(100):
+            conn.execute('SELECT {} FROM games'.format(i)).fetchall()
+    finally:
+        conn.close()
+        slow_queries.disable()
+
+    files = slow_queries.log_files(log.path)
+    entries = list(slow_queries.read_entries(log.path))
+    print(f"  {len(files)} files, {len(entries)} entries kept")
+    assert files[-1] == path and files[0] == path + '.3'
+    assert 0 < len(entries) < 100
+    assert slow_queries.summarize(entries)[0]['sql'] == 'SELECT ? FROM games'
+
+def test_fetching_rows_counts_toward_the_threshold(database, tmp_path):
+    """A query whose rows are slow to produce is timed until they are all fetched"""
+    path = str(tmp_path / 'slow_queries.log')
+    log = slow_queries.enable(50, path)
+    try:
+        conn = models.get_db_connection()
+        conn.create_function('slow', 1, lambda i: time.sleep(0.005) or i)
+        request_queries.start('/slow')
+        cursor = conn.execute('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 20) '
+                              'SELECT slow(i) FROM n')
+        assert not os.path.exists(path), "Only the first row was computed by execute()"
+        assert len(list(cursor)) == 20
+        count, seconds = request_queries.stop()
+        conn.close()
+    finally:
+        slow_queries.disable()
+
+    entries = list(slow_queries.read_entries(log.path))
+    print(f"  {entries}")
+    assert len(entries) == 1 and entries[0]['ms'] >= 100
+    assert count == 1 and seconds >= 0.1
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
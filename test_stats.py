@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Test script for the incrementally maintained player statistics"""
+
+import pytest
+
+import models
+import stats
+
+def play_round(client, game_id, bids, tricks, **flags):
+    client.post('/game/{}/round'.format(game_id), data={'team1_bid': bids[0], 'team2_bid': bids[1]})
+    form = {'team1_actual': tricks[0], 'team2_actual': tricks[1]}
+    form.update({flag: 'on' for flag in flags})
+    client.post('/game/{}/scores'.format(game_id), data=form)
+
+def stored_rows():
+    conn = models.get_db_connection()
+    rows = sorted(tuple(row) for row in conn.execute('SELECT * FROM player_stats'))
+    conn.close()
+    return rows
+
+def rebuilt_rows():
+    conn = models.get_db_connection()
+    conn.execute('BEGIN IMMEDIATE')
+    stats.rebuild(conn)
+    rows = sorted(tuple(row) for row in conn.execute('SELECT * FROM player_stats'))
+    conn.rollback()
+    conn.close()
+    return rows
+
+def new_game(client, players, max_score=500):
+    names = dict(zip(('team1_player1', 'team1_player2', 'team2_player1', 'team2_player2'), players))
+    response = client.post('/new-game', data=dict(names, max_score=max_score))
+    return int(response.location.rsplit('/', 1)[1])
+
+def test_round_stats_follow_scores_edits_and_deletes(logged_in_client):
+    """Every scoring change keeps the aggregates equal to a full rebuild"""
+    client = logged_in_client()
+    game_id = new_game(client, ('Ann', 'Bob', 'Cat', 'Dan'))
+
+    play_round(client, game_id, ('4', '0n'), ('6', '7'))               # Cat & Dan's nil fails
+    play_round(client, game_id, ('5', '3'), ('4', '9'))                # Ann & Bob go set
+    play_round(client, game_id, ('3', '4n'), ('5', '8'), team2_nil_success=True)
+    assert stored_rows() == rebuilt_rows()
+
+    conn = models.get_db_connection()
+    round_ids = [row['id'] for row in conn.execute('SELECT id FROM rounds WHERE game_id = ? ORDER BY round_number',
+                                                   (game_id,))]
+    conn.close()
+    client.post('/game/{}/round/{}/edit'.format(game_id, round_ids[1]),
+                data={'team1_bid': '5', 'team2_bid': '3', 'team1_actual': '6', 'team2_actual': '7'})
+    assert stored_rows() == rebuilt_rows()
+    client.post('/game/{}/round/{}/delete'.format(game_id, round_ids[0]))
+    assert stored_rows() == rebuilt_rows()
+
+    conn = models.get_db_connection()
+    data = stats.user_stats(conn, 1)
+    conn.close()
+    ann = next(p for p in data['player'] if p['name'] == 'Ann')
+    cat_dan = next(p for p in data['partnership'] if p['name'] == 'Cat & Dan')
+    print(f"  Ann: {ann}")
+    assert ann['rounds'] == 2 and ann['average_bid'] == 4.0 and ann['bid_made_rate'] == 1.0
+    assert cat_dan['nil_attempts'] == 1 and cat_dan['nil_success_rate'] == 1.0
+    assert ann['games'] == 0, "Games only count once completed"
+
+def test_completion_renames_and_deletion(logged_in_client):
+    """Wins, renamed players and deleted games all land in the same rows a rebuild would give"""
+    client = logged_in_client()
+    game_id = new_game(client, ('Ann', 'Bob', 'Cat', 'Dan'), max_score=100)
+    play_round(client, game_id, ('6', '6'), ('7', '6'))
+    play_round(client, game_id, ('6', '6'), ('7', '6'))
+
+    conn = models.get_db_connection()
+    rows = {(row['kind'], row['name']): row for row in conn.execute('SELECT * FROM player_stats')}
+    conn.close()
+    assert rows[('partnership', 'Ann & Bob')]['wins'] == 1 and rows[('partnership', 'Cat & Dan')]['wins'] == 0
+    assert rows[('player', 'Dan')]['games'] == 1
+
+    # Partners entered in the other order are the same partnership
+    client.post('/game/{}/edit'.format(game_id), data={
+        'team1_player1': 'Bob', 'team1_player2': 'Ann', 'team2_player1': 'Cat', 'team2_player2': 'Eve',
+        'max_score': 100})
+    assert stored_rows() == rebuilt_rows()
+    names = {row[2] for row in stored_rows()}
+    assert 'Eve' in names and 'Dan' not in names and 'Ann & Bob' in names
+
+    client.post('/game/{}/delete'.format(game_id))
+    assert stored_rows() == []
+
+def test_bag_penalties_count_each_set_of_bags(logged_in_client):
+    """A round that takes the bag count over the threshold twice is two penalties"""
+    client = logged_in_client()
+    game_id = new_game(client, ('Ann', 'Bob', 'Cat', 'Dan'))
+    client.post('/game/{}/edit'.format(game_id), data={
+        'team1_player1': 'Ann', 'team1_player2': 'Bob', 'team2_player1': 'Cat', 'team2_player2': 'Dan',
+        'max_score': 500, 'bag_penalty_threshold': 3})
+    play_round(client, game_id, ('2', '4'), ('9', '4'))     # 7 bags: two penalties, 1 left
+    play_round(client, game_id, ('2', '4'), ('4', '9'))     # 2 more: 3, a third penalty
+
+    conn = models.get_db_connection()
+    rows = {(row['kind'], row['name']): row for row in conn.execute('SELECT * FROM player_stats')}
+    penalty = conn.execute('SELECT team1_bag_penalty FROM rounds WHERE round_number = 1').fetchone()[0]
+    conn.close()
+    print(f"  round 1 penalty {penalty}")
+    assert rows[('partnership', 'Ann & Bob')]['bag_penalties'] == 3
+    assert rows[('player', 'Cat')]['bag_penalties'] == 1
+    assert stored_rows() == rebuilt_rows()
+
+    # Fewer bags in round 1 moves the penalty into round 2, which the edit doesn't touch
+    conn = models.get_db_connection()
+    first = conn.execute('SELECT id FROM rounds WHERE round_number = 1').fetchone()[0]
+    conn.close()
+    client.post('/game/{}/round/{}/edit'.format(game_id, first), data={'team1_actual': 4, 'team2_actual': 9})
+    assert stored_rows() == rebuilt_rows()
+    client.post('/game/{}/round/{}/delete'.format(game_id, first))
+    assert stored_rows() == rebuilt_rows()
+    for _ in range(3):
+        client.post('/game/{}/undo'.format(game_id))
+        assert stored_rows() == rebuilt_rows()
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Test script for retried BEGIN IMMEDIATE units of work"""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import models
+from metrics import db_metrics
+
+def hold_write_lock(path, seconds):
+    """Take the write lock from another connection and keep it for `seconds`"""
+    locked = threading.Event()
+
+    def hold():
+        other = sqlite3.connect(path)
+        other.execute('BEGIN IMMEDIATE')
+        locked.set()
+        time.sleep(seconds)
+        other.rollback()
+        other.close()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    locked.wait()
+    return thread
+
+@models.transactional
+def add_user(conn, email):
+    return conn.execute('INSERT INTO users (name, email) VALUES (?, ?)', ('x', email)).lastrowid
+
+def count_users(email):
+    conn = models.get_db_connection()
+    count = conn.execute('SELECT COUNT(*) FROM users WHERE email = ?', (email,)).fetchone()[0]
+    conn.close()
+    return count
+
+def with_settings(attempts, lock_wait, test):
+    saved = models.TRANSACTION_ATTEMPTS, models.TRANSACTION_LOCK_WAIT
+    models.TRANSACTION_ATTEMPTS, models.TRANSACTION_LOCK_WAIT = attempts, lock_wait
+    try:
+        test()
+    finally:
+        models.TRANSACTION_ATTEMPTS, models.TRANSACTION_LOCK_WAIT = saved
+
+def test_retry_succeeds_once_lock_is_released(database):
+    """A lock held longer than one attempt's wait is outlasted by retrying"""
+
+    def test():
+        before = db_metrics.snapshot()['transactions']
+        holder = hold_write_lock(database, 0.3)
+        add_user('retry@example.com')
+        holder.join()
+        after = db_metrics.snapshot()['transactions']
+        print(f"  {after['retries'] - before['retries']} retries")
+        assert count_users('retry@example.com') == 1
+        assert after['total'] == before['total'] + 1
+        assert after['retried'] == before['retried'] + 1 and after['retries'] > before['retries']
+        assert after['failed'] == before['failed']
+
+    with_settings(50, 0.02, test)
+
+def test_gives_up_with_database_busy(database):
+    """Once every attempt has hit the lock, DatabaseBusy and nothing written"""
+
+    def test():
+        before = db_metrics.snapshot()['transactions']['failed']
+        holder = hold_write_lock(database, 1.0)
+        try:
+            add_user('busy@example.com')
+            assert False, "Expected DatabaseBusy"
+        except models.DatabaseBusy as e:
+            print(f"  {e}")
+        holder.join()
+        assert count_users('busy@example.com') == 0
+        assert db_metrics.snapshot()['transactions']['failed'] == before + 1
+
+    with_settings(3, 0.02, test)
+
+def test_other_errors_roll_back_without_retry(database):
+    """Anything but lock contention is raised at once and undoes the unit of work"""
+    calls = []
+
+    @models.transactional
+    def add_then_fail(conn):
+        calls.append(1)
+        conn.execute("INSERT INTO users (name, email) VALUES ('x', 'fail@example.com')")
+        raise ValueError('bad input')
+
+    try:
+        add_then_fail()
+        assert False, "Expected ValueError"
+    except ValueError:
+        pass
+    assert calls == [1]
+    assert count_users('fail@example.com') == 0
+
+    # The connection went back to the pool usable, outside any transaction
+    conn = models.get_db_connection()
+    assert not conn.in_transaction
+    conn.close()
+    assert add_user('after@example.com')
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
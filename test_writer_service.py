@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Test script for the single-writer commit service"""
+
+import threading
+
+import pytest
+
+import models
+import writer_service
+
+def start_writer(directory, **kwargs):
+    """A writer service for the test's database; units go through the socket"""
+    service = writer_service.WriterService(str(directory / 'writer.sock'), **kwargs)
+    service.start()
+    models.WRITER_SOCKET = service.path
+    return service
+
+def stop_writer(service):
+    models.WRITER_SOCKET = None
+    service.stop()
+
+@models.transactional
+def add_user(conn, email):
+    return conn.execute('INSERT INTO users (name, email) VALUES (?, ?)', ('x', email)).lastrowid
+
+def emails():
+    conn = models.get_db_connection()
+    found = sorted(row['email'] for row in conn.execute('SELECT email FROM users'))
+    conn.close()
+    return found
+
+def test_concurrent_units_are_group_committed(database, tmp_path):
+    """Callers in several threads each get their own result from shared commits"""
+    service = start_writer(tmp_path, max_delay=0.05)
+    results = {}
+
+    def call(i):
+        results[i] = add_user('user{}@example.com'.format(i))
+
+    try:
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = service.stats()
+    finally:
+        stop_writer(service)
+
+    print(f"  {stats['units']} units in {stats['batches']['count']} batches")
+    assert len(set(results.values())) == 8
+    assert emails() == sorted('user{}@example.com'.format(i) for i in range(8))
+    assert stats['units'] == 8 and stats['batches']['count'] < 8
+
+def test_failed_unit_only_rolls_back_itself(database, tmp_path):
+    """An error in one unit reaches its caller; the rest of the batch commits"""
+    service = start_writer(tmp_path)
+    try:
+        first = add_user('dup@example.com')
+        try:
+            add_user('dup@example.com')
+            assert False, "Expected IntegrityError"
+        except models.sqlite3.IntegrityError as e:
+            print(f"  {e}")
+        assert add_user('other@example.com') == first + 1
+        assert service.stats()['failed_units'] == 1
+    finally:
+        stop_writer(service)
+    assert emails() == ['dup@example.com', 'other@example.com']
+
+def test_app_units_and_redirects_cross_the_socket(database, tmp_path):
+    """App units take the user explicitly and their redirects come back intact"""
+    from app import Redirect, create_game, set_game_status, game_settings
+
+    service = start_writer(tmp_path)
+    try:
+        user_id = add_user('owner@example.com')
+        form = {'team1_player1': 'A', 'team1_player2': 'B', 'team2_player1': 'C', 'team2_player2': 'D'}
+        game_id = create_game(user_id, game_settings(form))
+        set_game_status(user_id, game_id, 'abandoned')
+        try:
+            set_game_status(user_id + 1, game_id, 'active')
+            assert False, "Expected Redirect"
+        except Redirect as e:
+            assert (e.message, e.endpoint) == ('Game not found', 'dashboard')
+    finally:
+        stop_writer(service)
+
+    conn = models.get_db_connection()
+    status = conn.execute('SELECT status FROM games WHERE id = ?', (game_id,)).fetchone()['status']
+    conn.close()
+    assert status == 'abandoned'
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main(['-s', __file__]))
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Single-writer commit service for multi-worker deployments.
+
+With several gunicorn workers each committing its own writes, SQLite's one
+write lock is the ceiling and workers queue on it for up to the busy
+timeout. In writer mode every @transactional unit of work (models.py) is
+instead sent to this one process over a local Unix socket. Its committer
+thread takes whatever units are waiting, runs each in its own SAVEPOINT
+inside a single BEGIN IMMEDIATE transaction, commits once and then answers
+every caller with its unit's result or exception. A unit that fails rolls
+back only its savepoint; lock contention retries the whole batch.
+
+Reads stay on each worker's own pooled connections. Background writes (the
+janitor, mail delivery bookkeeping and migrations) also stay where they are.
+
+    python writer_service.py --socket /run/spades/writer.sock
+    SPADES_WRITER_SOCKET=/run/spades/writer.sock gunicorn -w 4 app:app
+
+    python writer_service.py --benchmark --processes 4 --writes 300
+
+Frames are pickles, so the socket is created owner-only; only the app's own
+workers should be able to connect to it.
+"""
+import argparse
+import importlib
+import multiprocessing
+import os
+import pickle
+import queue
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+import models
+from metrics import Histogram
+from models import DatabaseBusy, is_busy_error, run_transaction, transactional
+
+DEFAULT_SOCKET = 'writer.sock'
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+_HEADER = struct.Struct('!I')
+
+def send_frame(sock, payload):
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('writer connection closed')
+        data += chunk
+    return data
+
+def recv_frame(sock):
+    size, = _HEADER.unpack(recv_exactly(sock, _HEADER.size))
+    return recv_exactly(sock, size)
+
+class PendingUnit:
+    """One caller's unit of work waiting for its batch to commit"""
+
+    def __init__(self, name, args, kwargs):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.outcome = None
+        self.done = threading.Event()
+
+def resolve(name):
+    """The unit of work registered as `name`, importing its module on first use"""
+    if name not in models.UNITS:
+        importlib.import_module(name.split('.', 1)[0])
+    try:
+        return models.UNITS[name]
+    except KeyError:
+        raise LookupError('Unknown unit of work {}'.format(name)) from None
+
+def apply_batch(conn, batch):
+    """Run each unit in its own savepoint; a failed unit doesn't take the batch down"""
+    for unit in batch:
+        conn.execute('SAVEPOINT unit')
+        try:
+            unit.outcome = (True, resolve(unit.name)(conn, *unit.args, **unit.kwargs))
+        except Exception as e:
+            if is_busy_error(e):
+                raise
+            conn.execute('ROLLBACK TO unit')
+            unit.outcome = (False, e)
+        conn.execute('RELEASE unit')
+
+class WriterService:
+    """Accepts units of work on a Unix socket and group-commits them"""
+
+    def __init__(self, path=DEFAULT_SOCKET, max_batch=64, max_delay=0.0):
+        self.path = path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._listener = None
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.commit_seconds = Histogram()
+        self._counters = {'units': 0, 'failed_units': 0, 'busy_batches': 0, 'connections': 0}
+
+    def listen(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        listener.listen(128)
+        self._listener = listener
+
+    def start(self):
+        """Listen, then accept and commit from background threads"""
+        self.listen()
+        threading.Thread(target=self._accept_loop, name='writer-accept', daemon=True).start()
+        threading.Thread(target=self._commit_loop, name='writer-commit', daemon=True).start()
+
+    def serve_forever(self):
+        self.start()
+        print("Writer service listening on {}".format(self.path))
+        try:
+            self._stop.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stop.set()
+        self._queue.put(None)
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def _accept_loop(self):
+        while not self._stop.is_set():
+            try:
+                sock, _ = self._listener.accept()
+            except OSError:
+                break
+            with self._lock:
+                self._counters['connections'] += 1
+            threading.Thread(target=self._serve_connection, args=(sock,), daemon=True).start()
+
+    def _serve_connection(self, sock):
+        """One worker thread's connection: a unit in, its outcome back, repeat"""
+        with sock:
+            while True:
+                try:
+                    name, args, kwargs = pickle.loads(recv_frame(sock))
+                except (EOFError, OSError):
+                    return
+                unit = PendingUnit(name, args, kwargs)
+                self._queue.put(unit)
+                unit.done.wait()
+                try:
+                    payload = pickle.dumps(unit.outcome)
+                except Exception as e:
+                    payload = pickle.dumps((False, TypeError('Unpicklable result from {}: {}'.format(name, e))))
+                try:
+                    send_frame(sock, payload)
+                except OSError:
+                    return
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                unit = self._queue.get(timeout=max(0.0, deadline - time.monotonic())) \
+                    if self.max_delay else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if unit is None:
+                self._queue.put(None)
+                break
+            batch.append(unit)
+        return batch
+
+    def _commit_loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self.commit(batch)
+
+    def commit(self, batch):
+        """Apply and commit a batch, then release every caller in it"""
+        start = time.perf_counter()
+        try:
+            run_transaction(apply_batch, batch)
+        except Exception as e:
+            # Nothing was committed, whatever the units themselves returned
+            for unit in batch:
+                unit.outcome = (False, e)
+            if isinstance(e, DatabaseBusy):
+                with self._lock:
+                    self._counters['busy_batches'] += 1
+        elapsed = time.perf_counter() - start
+        failed = sum(1 for unit in batch if not unit.outcome[0])
+        with self._lock:
+            self.batch_sizes.observe(len(batch))
+            self.commit_seconds.observe(elapsed)
+            self._counters['units'] += len(batch)
+            self._counters['failed_units'] += failed
+        for unit in batch:
+            unit.done.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['batches'] = self.batch_sizes.snapshot()
+            stats['commit_seconds'] = self.commit_seconds.snapshot()
+        return stats
+
+class WriterClient:
+    """Sends units of work to the writer, one socket per calling thread"""
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _socket(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self._local.sock = sock
+        return sock
+
+    def _drop(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def call(self, name, args, kwargs):
+        payload = pickle.dumps((name, args, kwargs))
+        for attempt in range(2):
+            try:
+                sock = self._socket()
+                send_frame(sock, payload)
+                break
+            except OSError as e:
+                # The writer never saw this unit (e.g. it restarted); a fresh connection is safe
+                self._drop()
+                if attempt:
+                    raise DatabaseBusy('Writer service unavailable: {}'.format(e)) from e
+        try:
+            ok, value = pickle.loads(recv_frame(sock))
+        except (EOFError, OSError) as e:
+            # It may or may not have committed; don't send it again
+            self._drop()
+            raise DatabaseBusy('No answer from writer service for {}: {}'.format(name, e)) from e
+        if ok:
+            return value
+        raise value
+
+_client = None
+
+def client(path):
+    """This process's client for the writer at `path` (recreated after fork)"""
+    global _client
+    if _client is None or _client.path != path or _client.pid != os.getpid():
+        _client = WriterClient(path)
+        _client.pid = os.getpid()
+    return _client
+
+@transactional
+def benchmark_score(conn, game_id, round_number):
+    """Roughly what entering a round costs: insert it and update the game's totals"""
+    conn.execute('''
+        INSERT INTO rounds (game_id, round_number, team1_bid, team2_bid, team1_actual, team2_actual,
+                            team1_points, team2_points, team1_total, team2_total)
+        VALUES (?, ?, '4', '4', 6, 7, 42, 40, ?, ?)
+    ''', (game_id, round_number, 42 * round_number, 40 * round_number))
+    conn.execute('UPDATE games SET team1_final_score = ?, team2_final_score = ? WHERE id = ?',
+                 (42 * round_number, 40 * round_number, game_id))
+
+def benchmark_worker(database, socket_path, game_ids, writes, results):
+    models.configure_database(database)
+    models.WRITER_SOCKET = socket_path
+    latencies = []
+    for i in range(writes):
+        start = time.perf_counter()
+        benchmark_score(game_ids[i % len(game_ids)], i // len(game_ids) + 1)
+        latencies.append(time.perf_counter() - start)
+    results.put(latencies)
+
+def benchmark_run(database, socket_path, processes, writes):
+    conn = models.get_db_connection()
+    game_ids = []
+    for p in range(processes):
+        game_ids.append([conn.execute('''
+            INSERT INTO games (created_by_user_id, team1_player1, team1_player2, team2_player1, team2_player2)
+            VALUES (1, 'a', 'b', 'c', 'd')
+        ''').lastrowid for _ in range(5)])
+    conn.commit()
+    conn.close()
+    models.db_pool.close_idle()
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=benchmark_worker,
+                                       args=(database, socket_path, game_ids[p], writes, results))
+               for p in range(processes)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    latencies = sorted(latency for _ in workers for latency in results.get())
+    elapsed = time.perf_counter() - start
+    for worker in workers:
+        worker.join()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))] * 1000
+    return {'writes': len(latencies), 'seconds': round(elapsed, 3),
+            'writes_per_second': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(pct(50), 2), 'p99_ms': round(pct(99), 2), 'max_ms': round(latencies[-1] * 1000, 2)}
+
+def serve_process(socket_path, database, ready):
+    models.configure_database(database)
+    models.WRITER_SOCKET = None
+    WriterService(socket_path).start()
+    ready.set()
+    threading.Event().wait()
+
+def benchmark(processes=4, writes=300):
+    """Same write mix from several processes, committed directly and via the writer"""
+    directory = tempfile.mkdtemp()
+    report = {}
+    for mode in ('direct', 'writer'):
+        database = os.path.join(directory, mode + '.db')
+        models.configure_database(database)
+        models.init_db()
+        socket_path = None
+        server = None
+        if mode == 'writer':
+            socket_path = os.path.join(directory, 'writer.sock')
+            ready = multiprocessing.Event()
+            server = multiprocessing.Process(target=serve_process, args=(socket_path, database, ready), daemon=True)
+            server.start()
+            ready.wait()
+        report[mode] = benchmark_run(database, socket_path, processes, writes)
+        if server is not None:
+            server.terminate()
+            server.join()
+        print("{:<7} {writes} writes in {seconds}s: {writes_per_second} writes/s, "
+              "p50 {p50_ms} ms, p99 {p99_ms} ms, max {max_ms} ms".format(mode, **report[mode]))
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the single-writer commit service')
+    parser.add_argument('--socket', default=os.environ.get('SPADES_WRITER_SOCKET', DEFAULT_SOCKET))
+    parser.add_argument('--max-batch', type=int, default=64, help='Most units committed together')
+    parser.add_argument('--max-delay-ms', type=float, default=0.0,
+                        help='Wait this long for more units before committing (default: take what is queued)')
+    parser.add_argument('--benchmark', action='store_true', help='Compare direct writes with the writer service')
+    parser.add_argument('--processes', type=int, default=4, help='Writing processes for --benchmark')
+    parser.add_argument('--writes', type=int, default=300, help='Writes per process for --benchmark')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.processes, args.writes)
+    else:
+        # Units run here directly; never forward them to ourselves
+        models.WRITER_SOCKET = None
+        models.init_db()
+        WriterService(args.socket, args.max_batch, args.max_delay_ms / 1000.0).serve_forever()